@@ -0,0 +1,436 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Generates a Python decoder specialised for one Avro schema. The generated code reads
+# a whole container block (already decompressed) from a bytes object with a running
+# position, so there is no file object, no per datum dispatch on the schema and,
+# for most records, no function call per field. Records and fields are decoded the
+# same way the spavro C extension decodes them (logical types are not interpreted).
+# Validators, which tell whether a datum can be written with a schema, are generated
+# the same way.
+
+from struct import Struct
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List
+)
+
+_FLOAT = Struct('<f')
+_DOUBLE = Struct('<d')
+
+_PRIMITIVES = {'null', 'boolean', 'int', 'long', 'float', 'double', 'bytes', 'string'}
+
+# the ranges spavro.io.validate accepts
+_INT_RANGE = (-(1 << 31), (1 << 31) - 1)
+_LONG_RANGE = (-(1 << 63), (1 << 63) - 1)
+
+
+def _read_long(buf, pos):
+    # the slow path of the zig-zag varint, for values that take more than a byte
+    b = buf[pos]
+    n = b & 0x7F
+    shift = 7
+    while b & 0x80:
+        pos += 1
+        b = buf[pos]
+        n |= (b & 0x7F) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1), pos + 1
+
+
+def _skip_long(buf, pos):
+    while buf[pos] & 0x80:
+        pos += 1
+    return pos + 1
+
+
+class _Compiler(object):
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.consts: Dict[str, Any] = {}
+        self.counter = 0
+        self.named: Dict[str, Any] = {}        # full name -> writer definition
+        self.functions: Dict[str, str] = {}    # full name -> generated function name
+        self.pending: List[str] = []           # records needing a function of their own
+
+    def var(self, prefix='v'):
+        self.counter += 1
+        return f'{prefix}{self.counter}'
+
+    def const(self, value, prefix='c'):
+        name = self.var(prefix)
+        self.consts[name] = value
+        return name
+
+    def emit(self, indent, line):
+        self.lines.append('    ' * indent + line)
+
+    # names
+
+    def register(self, _type, namespace):
+        name = _type['name']
+        namespace = _type.get('namespace', namespace)
+        if '.' in name:
+            namespace = name.rsplit('.', 1)[0]
+        names = {name, f'{namespace}.{name}' if namespace and '.' not in name else name}
+        for _name in names:
+            self.named[_name] = _type
+        return names, namespace
+
+    def resolve(self, _type, namespace):
+        if _type in self.named:
+            return self.named[_type]
+        if namespace and f'{namespace}.{_type}' in self.named:
+            return self.named[f'{namespace}.{_type}']
+        raise ValueError(f'Unknown type {_type}')
+
+    # reading
+
+    def read_long(self, indent, target):
+        b = self.var('b')
+        self.emit(indent, f'{b} = buf[pos]')
+        self.emit(indent, f'if {b} < 128:')
+        self.emit(indent + 1, 'pos += 1')
+        self.emit(indent + 1, f'{target} = ({b} >> 1) ^ -({b} & 1)')
+        self.emit(indent, 'else:')
+        self.emit(indent + 1, f'{target}, pos = _read_long(buf, pos)')
+
+    def read(self, indent, target, wtype, rtype, namespace, in_progress):
+        # decodes a datum of writer type {wtype} into {target}. {rtype} is the same type,
+        # or a projection of it (records with fewer fields), see avro_utils.project_schema
+        if isinstance(wtype, str) and wtype not in _PRIMITIVES:
+            definition = self.resolve(wtype, namespace)
+            if definition.get('type') in ('record', 'error'):
+                name = definition.get('_fullname')
+                if name in in_progress:  # recursive reference, call the record function
+                    if name not in self.functions:
+                        self.functions[name] = self.var('read_record')
+                        self.pending.append(name)
+                    self.emit(indent, f'{target}, pos = {self.functions[name]}(buf, pos)')
+                    return
+            wtype = definition
+            rtype = definition if isinstance(rtype, str) else rtype
+        if isinstance(wtype, list):
+            return self.read_union(indent, target, wtype, rtype, namespace, in_progress)
+        kind = wtype if isinstance(wtype, str) else wtype.get('type')
+        if isinstance(wtype, dict) and kind in _PRIMITIVES:  # i.e. {'type': 'long', ...}
+            return self.read(indent, target, kind, kind, namespace, in_progress)
+        if kind == 'null':
+            self.emit(indent, f'{target} = None')
+        elif kind == 'boolean':
+            self.emit(indent, f'{target} = buf[pos] == 1')
+            self.emit(indent, 'pos += 1')
+        elif kind in ('int', 'long'):
+            self.read_long(indent, target)
+        elif kind == 'float':
+            self.emit(indent, f'{target}, = _FLOAT.unpack_from(buf, pos)')
+            self.emit(indent, 'pos += 4')
+        elif kind == 'double':
+            self.emit(indent, f'{target}, = _DOUBLE.unpack_from(buf, pos)')
+            self.emit(indent, 'pos += 8')
+        elif kind in ('bytes', 'string'):
+            size = self.var('n')
+            self.read_long(indent, size)
+            end = '' if kind == 'bytes' else ".decode('utf-8')"
+            self.emit(indent, f'{target} = buf[pos:pos + {size}]{end}')
+            self.emit(indent, f'pos += {size}')
+        elif kind == 'enum':
+            self.register(wtype, namespace)
+            symbols = self.const(tuple(wtype['symbols']), 'symbols')
+            index = self.var('i')
+            self.read_long(indent, index)
+            self.emit(indent, f'{target} = {symbols}[{index}]')
+        elif kind == 'fixed':
+            self.register(wtype, namespace)
+            self.emit(indent, f'{target} = buf[pos:pos + {int(wtype["size"])}]')
+            self.emit(indent, f'pos += {int(wtype["size"])}')
+        elif kind in ('record', 'error'):
+            self.read_record(indent, target, wtype, rtype, namespace, in_progress)
+        elif kind == 'array':
+            self.read_blocks(
+                indent, target, '[]', wtype['items'], rtype['items'], namespace, in_progress)
+        elif kind == 'map':
+            self.read_blocks(
+                indent, target, '{}', wtype['values'], rtype['values'], namespace, in_progress)
+        else:
+            raise ValueError(f'Unsupported Avro type {wtype}')
+
+    def read_union_index(self, indent, wtype):
+        # Returns the generated name of the union index, and how branch x is written in
+        # it. Indices of unions with up to 64 branches fit in a single byte, so we
+        # compare the raw byte (the zig-zag encoding of x is 2 * x) instead of decoding it.
+        index = self.var('u')
+        if len(wtype) <= 64:
+            self.emit(indent, f'{index} = buf[pos]')
+            self.emit(indent, 'pos += 1')
+            return index, [2 * x for x in range(len(wtype))]
+        self.read_long(indent, index)
+        return index, list(range(len(wtype)))
+
+    def read_union(self, indent, target, wtype, rtype, namespace, in_progress):
+        index, values = self.read_union_index(indent, wtype)
+        for x, (w_branch, r_branch) in enumerate(zip(wtype, rtype)):
+            self.emit(indent, f'{"if" if x == 0 else "elif"} {index} == {values[x]}:')
+            self.read(indent + 1, target, w_branch, r_branch, namespace, in_progress)
+        self.emit(indent, 'else:')
+        self.emit(indent + 1, f'raise ValueError(f"Invalid union index {{{index}}}")')
+
+    def read_record(self, indent, target, wtype, rtype, namespace, in_progress):
+        names, namespace = self.register(wtype, namespace)
+        wtype.setdefault('_fullname', sorted(names, key=len)[-1])
+        wtype.setdefault('_namespace', namespace)
+        in_progress = in_progress | {wtype['_fullname']}
+        selected = {f['name']: f['type'] for f in rtype['fields']}
+        values = []
+        for _field in wtype['fields']:
+            name = _field['name']
+            if name in selected:
+                value = self.var()
+                self.read(indent, value, _field['type'], selected[name], namespace, in_progress)
+                values.append(f'{name!r}: {value}')
+            else:
+                self.skip(indent, _field['type'], namespace)
+        self.emit(indent, f'{target} = {{{", ".join(values)}}}')
+
+    def read_blocks(self, indent, target, empty, witems, ritems, namespace, in_progress):
+        # arrays and maps are written as blocks of items, ended by an empty block
+        count = self.var('n')
+        self.emit(indent, f'{target} = {empty}')
+        self.emit(indent, 'while True:')
+        self.read_long(indent + 1, count)
+        self.emit(indent + 1, f'if {count} == 0:')
+        self.emit(indent + 2, 'break')
+        self.emit(indent + 1, f'if {count} < 0:  # followed by the size of the block')
+        self.emit(indent + 2, f'{count} = -{count}')
+        self.emit(indent + 2, 'pos = _skip_long(buf, pos)')
+        self.emit(indent + 1, f'for _ in range({count}):')
+        item = self.var()
+        if empty == '{}':
+            key = self.var('k')
+            self.read(indent + 2, key, 'string', 'string', namespace, in_progress)
+            self.read(indent + 2, item, witems, ritems, namespace, in_progress)
+            self.emit(indent + 2, f'{target}[{key}] = {item}')
+        else:
+            self.read(indent + 2, item, witems, ritems, namespace, in_progress)
+            self.emit(indent + 2, f'{target}.append({item})')
+
+    # skipping, for fields outside of a projection
+
+    def skip(self, indent, wtype, namespace):
+        if isinstance(wtype, str) and wtype not in _PRIMITIVES:
+            wtype = self.resolve(wtype, namespace)
+        if isinstance(wtype, list):
+            index, values = self.read_union_index(indent, wtype)
+            for x, branch in enumerate(wtype):
+                self.emit(indent, f'{"if" if x == 0 else "elif"} {index} == {values[x]}:')
+                self.emit(indent + 1, 'pass')
+                self.skip(indent + 1, branch, namespace)
+            return
+        kind = wtype if isinstance(wtype, str) else wtype.get('type')
+        if kind in ('int', 'long', 'enum'):
+            if kind == 'enum':
+                self.register(wtype, namespace)
+            self.emit(indent, 'pos = _skip_long(buf, pos)')
+        elif kind == 'boolean':
+            self.emit(indent, 'pos += 1')
+        elif kind == 'float':
+            self.emit(indent, 'pos += 4')
+        elif kind == 'double':
+            self.emit(indent, 'pos += 8')
+        elif kind in ('bytes', 'string'):
+            size = self.var('n')
+            self.read_long(indent, size)
+            self.emit(indent, f'pos += {size}')
+        elif kind == 'fixed':
+            self.register(wtype, namespace)
+            self.emit(indent, f'pos += {int(wtype["size"])}')
+        elif kind in ('record', 'error'):
+            _, namespace = self.register(wtype, namespace)
+            for _field in wtype['fields']:
+                self.skip(indent, _field['type'], namespace)
+        elif kind in ('array', 'map'):
+            count = self.var('n')
+            self.emit(indent, 'while True:')
+            self.read_long(indent + 1, count)
+            self.emit(indent + 1, f'if {count} == 0:')
+            self.emit(indent + 2, 'break')
+            self.emit(indent + 1, f'if {count} < 0:')
+            size = self.var('n')
+            self.read_long(indent + 2, size)
+            self.emit(indent + 2, f'pos += {size}')
+            self.emit(indent + 2, 'continue')
+            self.emit(indent + 1, f'for _ in range({count}):')
+            self.emit(indent + 2, 'pass')
+            if kind == 'map':
+                self.skip(indent + 2, 'string', namespace)
+                self.skip(indent + 2, wtype['values'], namespace)
+            else:
+                self.skip(indent + 2, wtype['items'], namespace)
+        # null takes no space
+
+
+def compile_block_reader(
+    writer_schema: Any,
+    reader_schema: Any = None
+) -> Callable[..., List[Any]]:
+    # Returns read_block(buf, count, pos=0), which decodes {count} datums from {buf}
+    # starting at offset {pos}, so a block can be read in place from its payload. With a
+    # {reader_schema} (a projection of the writer schema, as built by
+    # avro_utils.project_schema) fields outside of the projection are skipped.
+    compiler = _Compiler()
+    # the compiler annotates records with their full name, work on private copies
+    writer_schema = _copy(writer_schema)
+    reader_schema = writer_schema if reader_schema is None else _copy(reader_schema)
+    compiler.emit(0, 'def read_block(buf, count, pos=0):')
+    compiler.emit(1, 'out = []')
+    compiler.emit(1, 'append = out.append')
+    compiler.emit(1, 'for _ in range(count):')
+    compiler.read(2, 'datum', writer_schema, reader_schema, None, frozenset())
+    compiler.emit(2, 'append(datum)')
+    compiler.emit(1, 'return out')
+    done = set()
+    while compiler.pending:  # functions for recursive records
+        name = compiler.pending.pop()
+        if name in done:
+            continue
+        done.add(name)
+        definition = compiler.named[name]
+        compiler.emit(0, '')
+        compiler.emit(0, f'def {compiler.functions[name]}(buf, pos):')
+        compiler.read_record(
+            1, 'datum', definition, definition, definition['_namespace'], frozenset())
+        compiler.emit(1, 'return datum, pos')
+    namespace = {
+        '_read_long': _read_long,
+        '_skip_long': _skip_long,
+        '_FLOAT': _FLOAT,
+        '_DOUBLE': _DOUBLE,
+        **compiler.consts
+    }
+    source = '\n'.join(compiler.lines)
+    exec(compile(source, '<avro decoder>', 'exec'), namespace)
+    read_block = namespace['read_block']
+    read_block.source = source
+    return read_block
+
+
+class _ValidatorCompiler(_Compiler):
+    # Builds one function per record, which checks each field with an inline expression.
+    # The checks are those of spavro.io.validate.
+
+    def check(self, _type, subject, namespace) -> str:
+        # a boolean expression telling whether {subject} (a variable) is a valid {_type}
+        if isinstance(_type, str) and _type not in _PRIMITIVES:
+            _type = self.resolve(_type, namespace)
+        if isinstance(_type, list):
+            return '(' + ' or '.join(self.check(t, subject, namespace) for t in _type) + ')'
+        kind = _type if isinstance(_type, str) else _type.get('type')
+        if isinstance(_type, dict) and kind in _PRIMITIVES:  # i.e. logical types
+            return self.check(kind, subject, namespace)
+        if kind == 'null':
+            return f'{subject} is None'
+        if kind == 'boolean':
+            return f'isinstance({subject}, bool)'
+        if kind == 'string':
+            return f'isinstance({subject}, str)'
+        if kind == 'bytes':
+            return f'isinstance({subject}, bytes)'
+        if kind in ('int', 'long'):
+            low, high = _INT_RANGE if kind == 'int' else _LONG_RANGE
+            return f'(isinstance({subject}, int) and {low} <= {subject} <= {high})'
+        if kind in ('float', 'double'):
+            return f'isinstance({subject}, (int, float))'
+        if kind == 'fixed':
+            self.register(_type, namespace)
+            return f'(isinstance({subject}, bytes) and len({subject}) == {int(_type["size"])})'
+        if kind == 'enum':
+            self.register(_type, namespace)
+            symbols = self.const(frozenset(_type['symbols']), 'symbols')
+            return f'(isinstance({subject}, str) and {subject} in {symbols})'
+        if kind == 'array':
+            item = self.var('x')
+            check = self.check(_type['items'], item, namespace)
+            return f'(isinstance({subject}, list) and all({check} for {item} in {subject}))'
+        if kind == 'map':
+            key, item = self.var('k'), self.var('x')
+            check = self.check(_type['values'], item, namespace)
+            return (
+                f'(isinstance({subject}, dict) and '
+                f'all(isinstance({key}, str) for {key} in {subject}) and '
+                f'all({check} for {item} in {subject}.values()))'
+            )
+        if kind in ('record', 'error'):
+            return f'{self.record_function(_type, namespace)}({subject})'
+        raise ValueError(f'Unsupported Avro type {_type}')
+
+    def record_function(self, _type, namespace) -> str:
+        if '_fullname' not in _type:
+            names, namespace = self.register(_type, namespace)
+            _type['_fullname'] = sorted(names, key=len)[-1]
+            _type['_namespace'] = namespace
+        name = _type['_fullname']
+        if name not in self.functions:
+            self.functions[name] = self.var('valid_record')
+            self.pending.append(name)
+        return self.functions[name]
+
+    def emit_record(self, name):
+        definition = self.named[name]
+        namespace = definition['_namespace']
+        self.emit(0, '')
+        self.emit(0, f'def {self.functions[name]}(datum):')
+        self.emit(1, 'if not isinstance(datum, dict):')
+        self.emit(2, 'return False')
+        for _field in definition['fields']:
+            value = self.var()
+            self.emit(1, f'{value} = datum.get({_field["name"]!r})')
+            self.emit(1, f'if not {self.check(_field["type"], value, namespace)}:')
+            self.emit(2, 'return False')
+        self.emit(1, 'return True')
+
+
+def compile_validator(schema: Any) -> Callable[[Any], bool]:
+    # Returns validate(datum), the equivalent of spavro.io.validate(schema, datum) for
+    # the schema given as parsed JSON.
+    compiler = _ValidatorCompiler()
+    schema = _copy(schema)
+    compiler.emit(0, 'def validate(datum):')
+    compiler.emit(1, f'return {compiler.check(schema, "datum", None)}')
+    done = set()
+    while compiler.pending:
+        name = compiler.pending.pop()
+        if name not in done:
+            done.add(name)
+            compiler.emit_record(name)
+    namespace = dict(compiler.consts)
+    source = '\n'.join(compiler.lines)
+    exec(compile(source, '<avro validator>', 'exec'), namespace)
+    validate = namespace['validate']
+    validate.source = source
+    return validate
+
+
+def _copy(_type):
+    if isinstance(_type, dict):
+        return {k: _copy(v) for k, v in _type.items()}
+    if isinstance(_type, list):
+        return [_copy(v) for v in _type]
+    return _type
@@ -0,0 +1,523 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from dataclasses import dataclass, field
+import hashlib
+import io
+from itertools import islice
+import json
+import lzma
+import re
+import zlib
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple
+)
+
+from spavro.datafile import (
+    CODEC_KEY,
+    DataFileException,
+    DataFileReader,
+    DataFileWriter,
+    MAGIC,
+    META_SCHEMA,
+    SCHEMA_KEY,
+    VALID_CODECS
+)
+from spavro.io import BinaryDecoder, DatumReader
+from spavro.schema import AvroException, parse as parse_schema
+
+try:
+    from spavro.fast_binary import get_reader
+    from spavro.schema_resolve import resolve
+except ImportError:  # pragma: no cover  (spavro without its C extension)
+    get_reader = resolve = None
+
+from .avro_codegen import compile_block_reader, compile_validator
+from .helpers import LRUCache
+
+# The container header layout never changes, so we prepare its reader once instead of
+# letting spavro resolve and compile META_SCHEMA for every Kafka message.
+_HEADER_READER = DatumReader(META_SCHEMA)
+
+_END = object()  # marks an exhausted iterator
+
+# the block count, block size (longs of at most 10 bytes) and sync marker of a block
+_BLOCK_FRAMING = 10 + 10 + 16
+_CODEC_OVERHEAD = {'deflate': 16, 'xz': 128}
+
+
+def schema_fingerprint(raw_schema: bytes) -> str:
+    # fingerprint of the raw `avro.schema` header bytes, not of the canonical form.
+    # Identical writers produce identical bytes, which is all the cache needs.
+    return hashlib.md5(raw_schema).hexdigest()
+
+
+@dataclass
+class SchemaCacheEntry:
+    fingerprint: str
+    schema: Dict[str, Any]                                         # schema as a python dict
+    datum_reader: Any                                              # prepared for this schema
+    masks: Dict[str, Callable] = field(default_factory=dict)       # topic -> mask
+    plans: Dict[str, Any] = field(default_factory=dict)            # topic -> MaskPlan
+    filters: Dict[str, Callable] = field(default_factory=dict)     # topic -> approval filter
+    readers: Dict[str, Tuple] = field(default_factory=dict)        # topic -> (schema, reader)
+
+
+# Decoder backends
+
+class CompiledDatumReader(object):
+    # Decodes whole container blocks with a decoder generated for the schema, see
+    # avro_codegen. A reader schema (a projection of the writer schema) skips fields.
+
+    def __init__(self, writer_schema: Dict[str, Any], reader_schema: Dict[str, Any] = None):
+        self.read_block = compile_block_reader(writer_schema, reader_schema)
+
+
+def _spavro_datum_reader(writer_schema, reader_schema=None):
+    if reader_schema is None:
+        datum_reader = DatumReader()
+        datum_reader.writers_schema = parse_schema(json.dumps(writer_schema))
+        return datum_reader
+    if get_reader is None:
+        raise ValueError('Projection requires the spavro C extension')
+    return ProjectedDatumReader(resolve(writer_schema, reader_schema))
+
+
+def _compiled_datum_reader(writer_schema, reader_schema=None):
+    if reader_schema is None:
+        # fails on invalid schemas, as spavro does. Projections work on expanded schemas,
+        # with named types repeated, which spavro would refuse.
+        parse_schema(json.dumps(writer_schema))
+    return CompiledDatumReader(writer_schema, reader_schema)
+
+
+# name -> function(writer schema, reader schema=None) returning a datum reader.
+# Datum readers either implement read(decoder) like spavro's DatumReader, or
+# read_block(buf, count, pos=0) to decode a whole block at once.
+DECODER_BACKENDS: Dict[str, Callable] = {
+    'spavro': _spavro_datum_reader,
+    'compiled': _compiled_datum_reader
+}
+
+
+def get_datum_reader(
+    writer_schema: Dict[str, Any],
+    reader_schema: Dict[str, Any] = None,
+    backend: str = 'spavro'
+):
+    if backend not in DECODER_BACKENDS:
+        raise ValueError(f'Unknown Avro decoder backend {backend}, '
+                         f'expected one of {sorted(DECODER_BACKENDS)}')
+    return DECODER_BACKENDS[backend](writer_schema, reader_schema)
+
+
+def build_schema_entry(
+    raw_schema: bytes,
+    fingerprint: str = None,
+    backend: str = 'spavro'
+) -> SchemaCacheEntry:
+    fingerprint = fingerprint or schema_fingerprint(raw_schema)
+    schema = json.loads(raw_schema)
+    return SchemaCacheEntry(
+        fingerprint=fingerprint,
+        schema=schema,
+        datum_reader=get_datum_reader(schema, backend=backend)
+    )
+
+
+# Validators
+
+_VALIDATORS = LRUCache(256)         # schema fingerprint -> validate(datum)
+_SCHEMA_VALIDATORS = LRUCache(256)  # id(schema) -> (schema, validate(datum))
+
+
+def get_validator(schema) -> Callable[[Any], bool]:
+    # validate(datum) for a spavro schema, a JSON string or a parsed schema, which
+    # accepts the datums spavro.io.validate accepts. Validators are compiled once per
+    # schema fingerprint; the same schema object finds its validator without hashing.
+    original = schema
+    cached = _SCHEMA_VALIDATORS.get(id(schema))
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+    if isinstance(schema, (str, bytes)):
+        schema = json.loads(schema)
+        raw_schema = json.dumps(schema)
+    elif isinstance(schema, (dict, list)):
+        raw_schema = json.dumps(schema)
+    else:
+        raw_schema = str(schema)
+        schema = json.loads(raw_schema)
+    fingerprint = schema_fingerprint(raw_schema.encode('utf-8'))
+    validator = _VALIDATORS.get(fingerprint)
+    if validator is None:
+        validator = compile_validator(schema)
+        _VALIDATORS.put(fingerprint, validator)
+    _SCHEMA_VALIDATORS.put(id(original), (original, validator))
+    return validator
+
+
+def validate_all(schema, docs: Iterable[Any]) -> List[bool]:
+    # whether each of {docs} is valid for {schema}, in one call
+    return list(map(get_validator(schema), docs))
+
+
+class CachedDataFileReader(DataFileReader):
+    # A DataFileReader that looks up the writer schema of the container in a
+    # cache (keyed on the fingerprint of the raw schema bytes) instead of parsing
+    # it and building a new DatumReader for every container. Datum readers of the
+    # compiled backend decode a block at a time.
+
+    def __init__(self, reader, cache: LRUCache, backend: str = 'spavro'):
+        self._reader = reader
+        self._raw_decoder = BinaryDecoder(reader)
+        self._datum_decoder = None
+        self._read_header()
+
+        self.codec = self._meta.get(CODEC_KEY, b'null').decode('utf-8')
+        if self.codec not in VALID_CODECS:
+            raise DataFileException('Unknown codec: %s.' % self.codec)
+        self._file_length = self.determine_file_length()
+        self._block_count = 0
+
+        raw_schema = self._meta[SCHEMA_KEY]
+        fingerprint = schema_fingerprint(raw_schema)
+        entry = cache.get(fingerprint)
+        if entry is None:
+            entry = build_schema_entry(raw_schema, fingerprint, backend)
+            cache.put(fingerprint, entry)
+        self.schema_entry = entry
+        self._block_records = iter(())
+        self.set_datum_reader(entry.datum_reader)
+
+    def set_datum_reader(self, datum_reader):
+        # i.e. a ProjectedDatumReader for the same writer schema
+        self._datum_reader = datum_reader
+        self._read_block = getattr(datum_reader, 'read_block', None)
+
+    def __next__(self):
+        if self._read_block is None:
+            return super(CachedDataFileReader, self).__next__()
+        datum = next(self._block_records, _END)
+        while datum is _END:
+            block = self.next_block()
+            if block is None:
+                raise StopIteration
+            self._block_records = iter(block)
+            datum = next(self._block_records, _END)
+        return datum
+
+    def iter_blocks(self) -> Iterator[List[Any]]:
+        # the records of the container, a block at a time
+        if self._read_block is None:
+            # spavro decodes record by record, the rest of the block is block_count long
+            datum = next(self, _END)
+            while datum is not _END:
+                block = [datum]
+                block.extend(islice(self, self.block_count))
+                yield block
+                datum = next(self, _END)
+            return
+        block = self.next_block()
+        while block is not None:
+            yield block
+            block = self.next_block()
+
+    def next_block(self) -> List[Any]:
+        # Decodes the next block of the container at once, None at the end of the
+        # container. Only available with datum readers that implement read_block.
+        if self.is_EOF():
+            return None
+        self._skip_sync()
+        if self.is_EOF():
+            return None
+        if self.codec == 'null':
+            count = self.raw_decoder.read_long()
+            size = self.raw_decoder.read_long()
+            payload = getattr(self.reader, 'payload', None)
+            if payload is not None:  # decoded in place
+                start = self.reader.tell()
+                self.reader.seek(start + size)
+                return self._read_block(payload, count, start)
+            return self._read_block(self.reader.read(size), count)
+        self._read_block_header()  # decompresses the block
+        count, self.block_count = self.block_count, 0
+        # a BytesIO made from bytes shares them, getvalue() does not copy
+        return self._read_block(self.datum_decoder.reader.getvalue(), count)
+
+    def _read_block_header(self):
+        # Deflated blocks are decompressed from a view of the payload, instead of from a
+        # copy of the compressed bytes.
+        if self.codec != 'deflate' or not hasattr(self.reader, 'read_view'):
+            return super(CachedDataFileReader, self)._read_block_header()
+        self.block_count = self.raw_decoder.read_long()
+        data = self.reader.read_view(self.raw_decoder.read_long())
+        self._datum_decoder = BinaryDecoder(io.BytesIO(zlib.decompress(data, -15)))
+
+    def _read_header(self):
+        # check the magic before decoding the header, garbage could otherwise be read
+        # as very large map / bytes lengths.
+        self.reader.seek(0, 0)
+        magic = self.reader.read(len(MAGIC))
+        if magic != MAGIC:
+            raise AvroException(f'Not an Avro data file: {magic} does not match {MAGIC}.')
+        self.reader.seek(0, 0)
+        header = _HEADER_READER.read(self.raw_decoder)
+        self._meta = header['meta']
+        self._sync_marker = header['sync']
+
+
+class WireFormatReader(object):
+    # Reads the single datum of a Schema Registry wire format payload (see
+    # schema_registry), with the interface of CachedDataFileReader. The datum starts
+    # at {offset} in {data}.
+
+    def __init__(self, data: bytes, entry: SchemaCacheEntry, offset: int = 0):
+        self.schema_entry = entry
+        self._data = data
+        self._offset = offset
+        self.set_datum_reader(entry.datum_reader)
+
+    def set_datum_reader(self, datum_reader):
+        self._datum_reader = datum_reader
+
+    def __iter__(self):
+        return iter(next(self.iter_blocks()))
+
+    def iter_blocks(self) -> Iterator[List[Any]]:
+        yield [decode_datum(self._datum_reader, self._data, self._offset)]
+
+    def close(self):
+        pass
+
+
+def decode_datum(datum_reader, data: bytes, offset: int = 0) -> Any:
+    # decodes the datum at {offset} in {data}, with any datum reader of the decoder
+    # backends. {data} is not copied.
+    read_block = getattr(datum_reader, 'read_block', None)
+    if read_block is not None:
+        return read_block(data, 1, offset)[0]
+    reader = PayloadReader(data)
+    reader.seek(offset)
+    return datum_reader.read(BinaryDecoder(reader))
+
+
+class PayloadReader(io.BytesIO):
+    # A read-only reader over a Kafka payload. A BytesIO made from a bytes object
+    # shares it until written to, so reading does not copy the payload. read_view
+    # returns parts of it as memoryviews, which do not copy either.
+
+    def __init__(self, payload: bytes):
+        super(PayloadReader, self).__init__(payload)
+        self.payload = payload
+        self._view = memoryview(payload)
+
+    def writable(self):
+        return False
+
+    def write(self, b):
+        raise io.UnsupportedOperation('PayloadReader is read-only')
+
+    def read_view(self, size: int = -1) -> memoryview:
+        start = self.tell()
+        end = len(self._view) if size < 0 else min(start + size, len(self._view))
+        self.seek(end)
+        return self._view[start:end]
+
+
+class ContainerWriter(DataFileWriter):
+    # A DataFileWriter with a compression level: 0-9 for deflate (zlib levels) and for
+    # xz (presets). None keeps the default of the codec. Blocks are compressed straight
+    # to raw deflate, without the zlib wrapper spavro slices off. The written size and
+    # the pending block give a bound on the final size.
+
+    def __init__(
+        self,
+        writer,
+        datum_writer,
+        writers_schema,
+        codec: str = 'deflate',
+        compression_level: int = None
+    ):
+        super(ContainerWriter, self).__init__(writer, datum_writer, writers_schema, codec)
+        self.codec = codec
+        self.compression_level = compression_level
+        self.raw_bytes = 0  # of the written blocks, before compression
+
+    @property
+    def size(self) -> int:
+        # bytes written so far, the pending block uncompressed
+        return self.writer.tell() + self.buffer_writer.tell()
+
+    def estimated_size(self, extra: int = 0) -> int:
+        # The most the container could take once flushed, were {extra} more bytes of
+        # encoded datums appended. Pending bytes are counted uncompressed, plus what
+        # stored blocks of deflate, and xz headers, add.
+        if not self._header_written:
+            self._write_header()
+        pending = self.buffer_writer.tell() + extra
+        pending += pending // 1000 + _CODEC_OVERHEAD.get(self.codec, 0)
+        return self.writer.tell() + pending + _BLOCK_FRAMING
+
+    def _write_block(self):
+        if not self._header_written:
+            self._write_header()
+        raw, start = self.buffer_writer.tell(), self.writer.tell()
+        self._write_compressed_block()
+        if self.writer.tell() > start:
+            self.raw_bytes += raw
+
+    def _write_compressed_block(self):
+        if self.compression_level is None or self.codec == 'null' or not self.block_count:
+            return super(ContainerWriter, self)._write_block()
+        data = self.buffer_writer.getvalue()
+        if self.codec == 'deflate':
+            compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+            data = compressor.compress(data) + compressor.flush()
+        else:
+            data = lzma.compress(data, format=lzma.FORMAT_XZ, preset=self.compression_level)
+        self.encoder.write_long(self.block_count)
+        self.encoder.write_long(len(data))
+        self.writer.write(data)
+        self.writer.write(self.sync_marker)
+        self.buffer_writer.truncate(0)
+        self.buffer_writer.seek(0)
+        self.block_count = 0
+
+
+# Projection
+
+_PROJECTION_PATH = re.compile(r'^\$?(?:\.?[A-Za-z_][\w\-]*(?:\[(?:\d+|\*)\])*)+$')
+_PROJECTION_STEP = re.compile(r'[A-Za-z_][\w\-]*')
+
+
+class ProjectedDatumReader(object):
+    # Reads records written with the writer schema into the shape of a projected reader
+    # schema. Fields outside of the projection are skipped by the decoder, not built.
+
+    def __init__(self, resolved_schema: Dict[str, Any]):
+        self.read_datum = get_reader(resolved_schema)
+
+    def read(self, decoder):
+        return self.read_datum(decoder.reader)
+
+
+def projection_steps(path: str) -> List[str]:
+    # 'a.b', '$.a.b' and '$.a[*].b' all select field b of the record(s) in field a
+    if not _PROJECTION_PATH.match(path):
+        raise ValueError(f'Cannot project on path {path}')
+    return _PROJECTION_STEP.findall(re.sub(r'\[(?:\d+|\*)\]', '', path))
+
+
+def expand_named_types(schema: Dict[str, Any]) -> Dict[str, Any]:
+    # Replaces references to named types with their definitions, so that parts of the
+    # schema can be dropped without leaving dangling references. Schema resolution in
+    # spavro also expects both sides to be written out in full.
+    named: Dict[str, Any] = {}
+
+    def names_of(_type, namespace):
+        name = _type.get('name')
+        namespace = _type.get('namespace', namespace)
+        names = {name}
+        if namespace and '.' not in name:
+            names.add(f'{namespace}.{name}')
+        return names, namespace
+
+    def expand(_type, in_progress, namespace):
+        if isinstance(_type, str):
+            if _type in in_progress:
+                raise ValueError(f'Recursive type {_type} cannot be expanded')
+            return named.get(_type, _type)
+        if isinstance(_type, list):
+            return [expand(t, in_progress, namespace) for t in _type]
+        if not isinstance(_type, dict):
+            return _type
+        kind = _type.get('type')
+        if kind in ('record', 'error'):
+            names, namespace = names_of(_type, namespace)
+            in_progress = in_progress | names
+            _type = {**_type, 'fields': [
+                {**f, 'type': expand(f['type'], in_progress, namespace)}
+                for f in _type['fields']
+            ]}
+            for name in names:
+                named[name] = _type
+        elif kind in ('enum', 'fixed'):
+            names, _ = names_of(_type, namespace)
+            for name in names:
+                named[name] = _type
+        elif kind == 'array':
+            _type = {**_type, 'items': expand(_type['items'], in_progress, namespace)}
+        elif kind == 'map':
+            _type = {**_type, 'values': expand(_type['values'], in_progress, namespace)}
+        return _type
+
+    return expand(schema, frozenset(), None)
+
+
+def project_schema(schema: Dict[str, Any], paths: List[str]) -> Dict[str, Any]:
+    # Builds a reader schema holding only the fields at {paths}. Records in unions and
+    # arrays are projected as well. The schema is expected to be expanded.
+    tree: Dict[str, Any] = {}  # field -> sub tree, None keeps the whole field
+    for path in paths:
+        node = tree
+        steps = projection_steps(path)
+        for x, step in enumerate(steps):
+            if x == len(steps) - 1:
+                node[step] = None
+            else:
+                if step in node and node[step] is None:
+                    break  # the whole field is already selected
+                node = node.setdefault(step, {})
+
+    def project(_type, sub):
+        if sub is None:
+            return _type
+        if isinstance(_type, list):
+            return [project(t, sub) for t in _type]
+        if isinstance(_type, dict):
+            kind = _type.get('type')
+            if kind in ('record', 'error'):
+                return {**_type, 'fields': [
+                    {**f, 'type': project(f['type'], sub[f['name']])}
+                    for f in _type['fields'] if f['name'] in sub
+                ]}
+            if kind == 'array':
+                return {**_type, 'items': project(_type['items'], sub)}
+            if kind == 'map':
+                return {**_type, 'values': project(_type['values'], sub)}
+        return _type
+
+    return project(schema, tree)
+
+
+def build_projected_reader(
+    schema: Dict[str, Any],
+    paths: List[str],
+    backend: str = 'spavro'
+) -> Tuple[Dict[str, Any], Any]:
+    # returns the projected reader schema, and a datum reader resolving the writer
+    # {schema} against it.
+    writer_schema = expand_named_types(schema)
+    reader_schema = project_schema(writer_schema, paths)
+    return reader_schema, get_datum_reader(writer_schema, reader_schema, backend)
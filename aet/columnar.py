@@ -0,0 +1,175 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from dataclasses import dataclass, field
+from itertools import compress
+from operator import itemgetter
+from typing import (
+    Any,
+    Dict,
+    FrozenSet,
+    List,
+    Sequence
+)
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, columns are then plain lists
+    np = None
+
+from .filters import MaskPlan
+
+# numpy dtypes for top level fields of these (non nullable) Avro types
+_NUMERIC_TYPES = {
+    'boolean': 'bool',
+    'int': 'int64',
+    'long': 'int64',
+    'float': 'float64',
+    'double': 'float64'
+}
+
+# the column holding payloads that are not JSON objects (or Avro records)
+VALUE_COLUMN = '_value'
+
+
+def numeric_fields(schema: Dict[str, Any]) -> Dict[str, str]:
+    # field name -> numpy dtype, for the top level fields of a record schema
+    fields = {}
+    for _field in (schema or {}).get('fields', []):
+        _type = _field.get('type')
+        if isinstance(_type, dict) and not _type.get('logicalType'):
+            _type = _type.get('type')
+        if isinstance(_type, str) and _type in _NUMERIC_TYPES:
+            fields[_field['name']] = _NUMERIC_TYPES[_type]
+    return fields
+
+
+def _array(values: List[Any], dtype: str):
+    if np is None:
+        return values
+    return np.array(values, dtype=dtype)
+
+
+@dataclass
+class ColumnarBatch:
+    # The records of one (topic, schema) from a poll, stored by column. Numeric fields
+    # are numpy arrays when numpy is installed, other fields are lists. offsets,
+    # partitions and keys hold the Kafka position of each row.
+    topic: str
+    schema: Dict[str, Any]
+    fingerprint: str
+    columns: Dict[str, Sequence[Any]] = field(default_factory=dict)
+    offsets: Sequence[int] = field(default_factory=list)
+    partitions: Sequence[int] = field(default_factory=list)
+    keys: List[Any] = field(default_factory=list)
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_rows(
+        cls,
+        topic: str,
+        schema: Dict[str, Any],
+        fingerprint: str,
+        rows: List[Any],
+        offsets: List[int],
+        partitions: List[int],
+        keys: List[Any],
+        exclude: FrozenSet[str] = frozenset()
+    ) -> 'ColumnarBatch':
+        # Column names come from the schema, or from the rows when there is none.
+        # Rows that are not dicts are kept in VALUE_COLUMN. Fields in {exclude} get
+        # no column at all.
+        columns = {}
+        if schema and schema.get('fields'):
+            # records decoded with the schema hold every field
+            for name in [f['name'] for f in schema['fields'] if f['name'] not in exclude]:
+                columns[name] = list(map(itemgetter(name), rows))
+        else:
+            names = {}  # insertion ordered set
+            for row in rows:
+                if isinstance(row, dict):
+                    names.update(dict.fromkeys(row))
+                else:
+                    names[VALUE_COLUMN] = None
+            for name in [name for name in names if name not in exclude]:
+                if name == VALUE_COLUMN:
+                    columns[name] = [None if isinstance(r, dict) else r for r in rows]
+                else:
+                    columns[name] = [r.get(name) if isinstance(r, dict) else None for r in rows]
+        for name, dtype in numeric_fields(schema).items():
+            if name in columns:
+                columns[name] = _array(columns[name], dtype)
+        return cls(
+            topic=topic,
+            schema=schema,
+            fingerprint=fingerprint,
+            columns=columns,
+            offsets=_array(offsets, 'int64'),
+            partitions=_array(partitions, 'int32'),
+            keys=keys
+        )
+
+    def filter(self, keep: Sequence[bool]) -> 'ColumnarBatch':
+        # returns the batch of the rows where {keep} is True
+        if np is not None:
+            keep = np.asarray(keep, dtype=bool)
+            if keep.all():
+                return self
+
+        def take(values):
+            if np is not None and isinstance(values, np.ndarray):
+                return values[keep]
+            return list(compress(values, keep))
+
+        return ColumnarBatch(
+            topic=self.topic,
+            schema=self.schema,
+            fingerprint=self.fingerprint,
+            columns={name: take(values) for name, values in self.columns.items()},
+            offsets=take(self.offsets),
+            partitions=take(self.partitions),
+            keys=take(self.keys)
+        )
+
+    def mask(self, plan: MaskPlan) -> 'ColumnarBatch':
+        # Fields dropped by the plan are removed as whole columns, nested plans are
+        # applied to the values of their column. Works in place.
+        if not plan or plan.is_empty:
+            return self
+        for name in plan.drop:
+            self.columns.pop(name, None)
+        for name, sub_plan in plan.nested:
+            for value in self.columns.get(name, []):
+                if isinstance(value, dict):
+                    sub_plan.apply(value)
+                elif isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, dict):
+                            sub_plan.apply(item)
+        return self
+
+    def to_records(self) -> List[Dict[str, Any]]:
+        # one dict per row, for consumers that need them after all
+        names = list(self.columns)
+        values = [
+            v.tolist() if np is not None and isinstance(v, np.ndarray) else v
+            for v in self.columns.values()
+        ]
+        return [dict(zip(names, row)) for row in zip(*values)]
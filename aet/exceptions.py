@@ -42,3 +42,11 @@ class MessageHandlingException(Exception):
     def __init__(self, message: str, details=None, **kwargs):
         super().__init__(message)
         self.details = details or {}
+
+
+class SchemaRegistryException(Exception):
+    '''
+    Raised when a schema cannot be found in, or registered with, a schema registry,
+    or when a payload is not framed in the registry wire format.
+    '''
+    pass
@@ -0,0 +1,497 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+from abc import ABCMeta, abstractmethod
+from dataclasses import dataclass
+from functools import reduce
+from operator import and_, itemgetter, or_
+import re
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    FrozenSet,
+    List,
+    Sequence,
+    Tuple,
+    Union
+)
+
+from jsonpath_ng import parse
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, values are then checked as lists
+    np = None
+
+# returned by accessors when nothing is found at the path
+MISSING = object()
+
+# paths made only of field names and list indices, i.e. $.a.b, $.a[0].b or $['a']
+_SIMPLE_PATH = re.compile(r'''^\$(?:\.[A-Za-z_][\w\-]*|\[\d+\]|\['[^']+'\])*$''')
+_PATH_STEP = re.compile(r'''\.([A-Za-z_][\w\-]*)|\[(\d+)\]|\['([^']+)'\]''')
+
+
+@dataclass(frozen=True)
+class MaskPlan:
+    # The result of compiling a schema against a masking configuration. Plans are
+    # immutable so one plan can be shared by every topic using the same schema.
+    drop: FrozenSet[str] = frozenset()                  # fields removed from the record
+    nested: Tuple[Tuple[str, 'MaskPlan'], ...] = ()     # plans for record / array fields
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.drop and not self.nested
+
+    def apply(self, msg):
+        for name in self.drop:
+            # fields without a value are left in place, as they have always been
+            if msg.get(name) is not None:
+                del msg[name]
+        for name, plan in self.nested:
+            value = msg.get(name)
+            if isinstance(value, dict):
+                plan.apply(value)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        plan.apply(item)
+        return msg
+
+
+def compile_mask_plan(
+    schema: Dict[str, Any],
+    mask_query: str,
+    mask_levels: List[Any],
+    emit_level: Any
+) -> MaskPlan:
+    # A field is dropped when the classification found under {mask_query} in its
+    # definition ranks above {emit_level} in {mask_levels}. Nested records, and arrays
+    # of records, get their own plan. Recursive references to a record that is still
+    # being compiled are not masked a second time.
+    try:
+        emit_index = mask_levels.index(emit_level)
+    except ValueError:
+        emit_index = -1  # emit level is off the scale, so we don't emit any classified data
+    named: Dict[str, Any] = {}
+
+    def record_plan(record: Dict[str, Any], in_progress: FrozenSet[str]) -> MaskPlan:
+        name = record.get('name')
+        if name:
+            names = {name}
+            if record.get('namespace'):
+                names.add(f'{record["namespace"]}.{name}')
+            for _name in names:
+                named[_name] = record
+            in_progress = in_progress | names
+        drop = set()
+        nested = []
+        for obj in record.get('fields', []):
+            field_name = obj.get('name')
+            level = obj.get(mask_query)
+            if level is not None and mask_levels.index(level) > emit_index:
+                drop.add(field_name)
+                continue
+            plan = type_plan(obj.get('type'), in_progress)
+            if plan and not plan.is_empty:
+                nested.append((field_name, plan))
+        return MaskPlan(frozenset(drop), tuple(nested))
+
+    def type_plan(_type: Any, in_progress: FrozenSet[str]) -> MaskPlan:
+        if isinstance(_type, str):
+            if _type in in_progress or _type not in named:
+                return None
+            return record_plan(named[_type], in_progress)
+        if isinstance(_type, list):  # union, merge the plans of all branches
+            plans = [type_plan(t, in_progress) for t in _type]
+            return merge_plans([p for p in plans if p])
+        if isinstance(_type, dict):
+            if _type.get('type') == 'record':
+                return record_plan(_type, in_progress)
+            if _type.get('type') == 'array':
+                return type_plan(_type.get('items'), in_progress)
+        return None
+
+    return record_plan(schema, frozenset())
+
+
+def merge_plans(plans: List[MaskPlan]) -> MaskPlan:
+    if not plans:
+        return None
+    if len(plans) == 1:
+        return plans[0]
+    drop = frozenset().union(*[p.drop for p in plans])
+    nested: Dict[str, List[MaskPlan]] = {}
+    for plan in plans:
+        for name, sub in plan.nested:
+            nested.setdefault(name, []).append(sub)
+    return MaskPlan(
+        drop,
+        tuple((name, merge_plans(subs)) for name, subs in nested.items() if name not in drop)
+    )
+
+
+def compile_accessor(path: str) -> Callable[[Any], Any]:
+    # Returns a function that reads the first value found at {path} in a message, or
+    # MISSING. Simple dotted / indexed paths are turned into direct dict and list lookups,
+    # anything else is handed to jsonpath_ng.
+    if not _SIMPLE_PATH.match(path):
+        expr = parse(path)
+
+        def find_first(msg):
+            matches = expr.find(msg)
+            if not matches:
+                return MISSING
+            return matches[0].value
+        return find_first
+
+    steps = [
+        (field or key, None) if (field or key) else (None, int(index))
+        for field, index, key in _PATH_STEP.findall(path)
+    ]
+    if len(steps) == 1 and steps[0][0] is not None:
+        name = steps[0][0]
+
+        def get_field(msg):
+            if isinstance(msg, dict):
+                return msg.get(name, MISSING)
+            return MISSING
+        return get_field
+
+    def get_path(msg):
+        value = msg
+        for name, index in steps:
+            if name is not None:
+                if not isinstance(value, dict) or name not in value:
+                    return MISSING
+                value = value[name]
+            else:
+                if not isinstance(value, list) or index >= len(value):
+                    return MISSING
+                value = value[index]
+        return value
+    return get_path
+
+
+def top_level_field(path: str) -> str:
+    # the field name of paths like $.a or $['a'], None for any other path
+    if not path or not _SIMPLE_PATH.match(path):
+        return None
+    steps = _PATH_STEP.findall(path)
+    if len(steps) != 1 or steps[0][1]:
+        return None
+    return steps[0][0] or steps[0][2]
+
+
+def compile_check(pass_conditions: Union[Any, List[Any]]) -> Callable[[Any], bool]:
+    # A list of pass conditions is a set of accepted values; a frozenset is used for the
+    # membership test whenever the values allow it. A Predicate is compiled as such.
+    # Anything else must match exactly.
+    if isinstance(pass_conditions, Predicate):
+        return pass_conditions.compile()
+    if not isinstance(pass_conditions, list):
+        def equals(value):
+            return value == pass_conditions
+        return equals
+    try:
+        accepted = frozenset(pass_conditions)
+    except TypeError:  # unhashable pass conditions
+        def contained(value):
+            return value in pass_conditions
+        return contained
+
+    def member(value):
+        try:
+            return value in accepted
+        except TypeError:  # unhashable value, i.e. a list or a record
+            return value in pass_conditions
+    return member
+
+
+def compile_batch_check(
+    pass_conditions: Union[Any, List[Any]]
+) -> Callable[[Sequence[Any]], Sequence[bool]]:
+    # As compile_check, but the returned function checks a sequence of values at once
+    # and returns a list (or a NumPy array) of booleans.
+    if isinstance(pass_conditions, Predicate):
+        return pass_conditions.compile_batch()
+    if isinstance(pass_conditions, list):
+        return In(tuple(pass_conditions)).compile_batch()
+    return In((pass_conditions,)).compile_batch()
+
+
+def _is_numeric_array(values) -> bool:
+    return np is not None and isinstance(values, np.ndarray) and values.dtype.kind in 'biuf'
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (bool, int, float))
+
+
+def _combine(op, results):
+    # element wise {op} of lists and / or arrays of booleans
+    if all(np is not None and isinstance(r, np.ndarray) for r in results):
+        return reduce(op, results)
+    return reduce(lambda a, b: list(map(op, a, b)), results)
+
+
+class Predicate(metaclass=ABCMeta):
+    # An emit condition richer than a set of accepted values, used as the
+    # pass_conditions of a FilterConfig. compile returns a check of a single value,
+    # compile_batch a check of a sequence of values. Records without a value at the
+    # checked path never pass, whatever the predicate. Predicates combine with &, | and ~.
+
+    @abstractmethod
+    def compile(self) -> Callable[[Any], bool]:
+        pass
+
+    def compile_batch(self) -> Callable[[Sequence[Any]], Sequence[bool]]:
+        check = self.compile()
+
+        def check_values(values):
+            return list(map(check, values))
+        return check_values
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+
+@dataclass(frozen=True)
+class In(Predicate):
+    # the value is one of {values}, the same as a list of pass conditions
+    values: Tuple[Any, ...]
+
+    def compile(self):
+        return compile_check(list(self.values))
+
+    def compile_batch(self):
+        check = self.compile()
+        try:
+            accepted = frozenset(self.values)
+        except TypeError:  # unhashable pass conditions
+            return super().compile_batch()
+        numbers = [v for v in accepted if _is_number(v)]
+
+        def member(values):
+            if _is_numeric_array(values):
+                return np.isin(values, numbers)
+            try:
+                return list(map(accepted.__contains__, values))
+            except TypeError:  # unhashable value, i.e. a list or a record
+                return list(map(check, values))
+        return member
+
+
+@dataclass(frozen=True)
+class Range(Predicate):
+    # low <= value <= high, or value < high if not {inclusive}. None is unbounded.
+    # Values that do not compare with the bounds, None included, do not pass.
+    low: Any = None
+    high: Any = None
+    inclusive: bool = True
+
+    def compile(self):
+        low, high, inclusive = self.low, self.high, self.inclusive
+
+        def in_range(value):
+            if value is None:
+                return False
+            try:
+                if low is not None and value < low:
+                    return False
+                if high is not None:
+                    return value <= high if inclusive else value < high
+                return value == value  # NaN is in no range
+            except TypeError:
+                return False
+        return in_range
+
+    def compile_batch(self):
+        check_values = super().compile_batch()
+        low, high, inclusive = self.low, self.high, self.inclusive
+        if not all(_is_number(b) for b in (low, high) if b is not None):
+            return check_values
+
+        def in_range(values):
+            if not _is_numeric_array(values):
+                return check_values(values)
+            keep = values == values
+            if low is not None:
+                keep &= values >= low
+            if high is not None:
+                keep &= values <= high if inclusive else values < high
+            return keep
+        return in_range
+
+
+@dataclass(frozen=True)
+class Regex(Predicate):
+    # the value is a string matching {pattern}, searched as re.search does,
+    # so anchor it with ^ and $ to match the whole value
+    pattern: str
+
+    def compile(self):
+        search = re.compile(self.pattern).search
+
+        def matches(value):
+            return isinstance(value, str) and search(value) is not None
+        return matches
+
+
+@dataclass(frozen=True)
+class IsNull(Predicate):
+    # the value is null, as opposed to a missing path, which never passes
+
+    def compile(self):
+        def is_null(value):
+            return value is None
+        return is_null
+
+    def compile_batch(self):
+        def is_null(values):
+            if _is_numeric_array(values):
+                return np.zeros(len(values), dtype=bool)
+            return [v is None for v in values]
+        return is_null
+
+
+@dataclass(frozen=True, init=False)
+class And(Predicate):
+    predicates: Tuple[Predicate, ...]
+
+    def __init__(self, *predicates: Predicate):
+        object.__setattr__(self, 'predicates', predicates)
+
+    def compile(self):
+        checks = [p.compile() for p in self.predicates]
+
+        def all_of(value):
+            return all(check(value) for check in checks)
+        return all_of
+
+    def compile_batch(self):
+        checks = [p.compile_batch() for p in self.predicates]
+        if not checks:
+            return super().compile_batch()
+
+        def all_of(values):
+            return _combine(and_, [check(values) for check in checks])
+        return all_of
+
+
+@dataclass(frozen=True, init=False)
+class Or(Predicate):
+    predicates: Tuple[Predicate, ...]
+
+    def __init__(self, *predicates: Predicate):
+        object.__setattr__(self, 'predicates', predicates)
+
+    def compile(self):
+        checks = [p.compile() for p in self.predicates]
+
+        def any_of(value):
+            return any(check(value) for check in checks)
+        return any_of
+
+    def compile_batch(self):
+        checks = [p.compile_batch() for p in self.predicates]
+        if not checks:
+            return super().compile_batch()
+
+        def any_of(values):
+            return _combine(or_, [check(values) for check in checks])
+        return any_of
+
+
+@dataclass(frozen=True)
+class Not(Predicate):
+    predicate: Predicate
+
+    def compile(self):
+        check = self.predicate.compile()
+
+        def negated(value):
+            return not check(value)
+        return negated
+
+    def compile_batch(self):
+        check = self.predicate.compile_batch()
+
+        def negated(values):
+            keep = check(values)
+            if np is not None and isinstance(keep, np.ndarray):
+                return ~keep
+            return [not k for k in keep]
+        return negated
+
+
+class ApprovalFilter(object):
+    '''
+    An emit filter compiled from a FilterConfig. Called with a record, it returns
+    whether the record is emitted. keep() checks a list of records at once: the
+    values at the path are pulled from every record first (with a single itemgetter
+    for top level fields), then checked together. check_values() takes the values
+    directly, e.g. a NumPy column of a ColumnarBatch. Without a path, every record
+    is emitted.
+    '''
+
+    def __init__(self, path: str = None, pass_conditions: Union[Any, List[Any]] = None):
+        self.accepts_all = path is None
+        self.field = top_level_field(path)
+        if not self.accepts_all:
+            self._get_value = compile_accessor(path)
+            self._check = compile_check(pass_conditions)
+            self._check_values = compile_batch_check(pass_conditions)
+            self._strict = isinstance(pass_conditions, Predicate)
+
+    def __call__(self, msg) -> bool:
+        if self.accepts_all:
+            return True
+        value = self._get_value(msg)
+        if value is MISSING:
+            return False
+        return self._check(value)
+
+    def keep(self, rows: Sequence[Any]) -> Sequence[bool]:
+        if self.accepts_all:
+            return [True] * len(rows)
+        return self.check_values(self.values(rows))
+
+    def values(self, rows: Sequence[Any]) -> List[Any]:
+        # the value at the path in each of {rows}, MISSING where there is none
+        if self.field is not None:
+            try:
+                return list(map(itemgetter(self.field), rows))
+            except (KeyError, TypeError, IndexError):  # not all rows are records with it
+                pass
+        return list(map(self._get_value, rows))
+
+    def check_values(self, values: Sequence[Any]) -> Sequence[bool]:
+        if self.accepts_all:
+            return [True] * len(values)
+        keep = self._check_values(values)
+        # sets of values never hold MISSING, predicates like Not(IsNull()) may pass it
+        if self._strict and isinstance(values, list) and MISSING in values:
+            keep = [bool(k) and v is not MISSING for k, v in zip(keep, values)]
+        return keep
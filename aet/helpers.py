@@ -16,7 +16,12 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from collections import OrderedDict
+from fnmatch import translate
 from itertools import islice
+import math
+import re
+from threading import Lock
 
 
 class ClassPropertyDescriptor(object):
@@ -64,3 +69,259 @@ def chunk_iterable(_iter, size):
     while sub:
         yield sub
         sub = list(islice(i, size))
+
+
+class LRUCache(object):
+    '''
+    A bounded, thread-safe mapping that evicts the least recently used entry
+    once max_size is reached. Hits and misses are counted for reporting.
+    '''
+
+    def __init__(self, max_size=128):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+_NOT_FOUND = object()
+_GLOB_CHARACTERS = re.compile(r'[*?\[]')
+
+
+def is_topic_pattern(key: str) -> bool:
+    # Kafka topic names are made of [a-zA-Z0-9._-] only, so a key with glob characters,
+    # or starting with ^ (a regular expression, as in subscribe), is never a topic name.
+    return key.startswith('^') or bool(_GLOB_CHARACTERS.search(key))
+
+
+def _pattern_expression(pattern: str) -> str:
+    if pattern.startswith('^'):
+        # anchored at the start only, the way librdkafka matches subscription patterns
+        return pattern[1:]
+    return translate(pattern)  # globs match the whole topic name
+
+
+class TopicConfigMap(object):
+    '''
+    Values keyed by topic name or by topic pattern, either a glob ('tenant-*.events')
+    or a regular expression starting with ^. An exact name wins over patterns, patterns
+    are tried in the order they were first set. Patterns are compiled when set, so an
+    invalid one raises re.error there. Patterns without groups are joined into a single
+    expression, and the value resolved for each topic is memoized, so a lookup after
+    the first is one dict hit. Setting any rule forgets the memoized resolutions.
+    '''
+
+    def __init__(self):
+        self._exact = {}
+        self._patterns = {}  # insertion ordered
+        self._compiled = {}  # the compiled expression of each pattern
+        self._matcher = None
+        self._resolved = {}
+        self._lock = Lock()
+
+    def set(self, key: str, value):
+        pattern = re.compile(_pattern_expression(key)) if is_topic_pattern(key) else None
+        with self._lock:
+            if pattern is not None:
+                self._patterns[key] = value
+                self._compiled[key] = pattern
+                self._matcher = None  # compiled again on the next miss
+                self._resolved.clear()
+            else:
+                self._exact[key] = value
+                self._resolved.pop(key, None)
+
+    def _compile(self):
+        # Returns a function of a topic, to the value of the first pattern it matches.
+        # Named groups tell which alternative of the joined expression matched. Joining
+        # would renumber the groups of the patterns (and so their back references) and
+        # may clash their names, so patterns with groups are matched one by one.
+        values = list(self._patterns.values())
+        patterns = list(self._compiled.values())
+        if not any(p.groups for p in patterns):
+            try:
+                joined = re.compile('|'.join(
+                    f'(?P<_topic_rule_{x}>{p.pattern})' for x, p in enumerate(patterns)
+                ))
+            except re.error:  # e.g. inline flags, only allowed at the start
+                joined = None
+            if joined is not None:
+                def match_joined(topic):
+                    match = joined.match(topic)
+                    if not match:
+                        return _NOT_FOUND
+                    return values[int(match.lastgroup[len('_topic_rule_'):])]
+                return match_joined
+
+        def match_each(topic):
+            for pattern, value in zip(patterns, values):
+                if pattern.match(topic):
+                    return value
+            return _NOT_FOUND
+        return match_each
+
+    def get(self, topic: str, default=None):
+        # {default} is a callable, called once per topic that matches no rule
+        try:
+            return self._resolved[topic]
+        except KeyError:
+            pass
+        with self._lock:
+            value = self._exact.get(topic, _NOT_FOUND)
+            if value is _NOT_FOUND and self._patterns:
+                if self._matcher is None:
+                    self._matcher = self._compile()
+                value = self._matcher(topic)
+            if value is _NOT_FOUND:
+                value = default() if default else None
+            self._resolved[topic] = value
+            return value
+
+    def matches(self, key: str, topic: str) -> bool:
+        # whether the rule {key} applies to {topic}, whichever rule wins
+        if not is_topic_pattern(key):
+            return key == topic
+        pattern = self._compiled.get(key) or re.compile(_pattern_expression(key))
+        return pattern.match(topic) is not None
+
+    def items(self):
+        # the rules, exact names first, in a form accepted back by set
+        with self._lock:
+            return list(self._exact.items()) + list(self._patterns.items())
+
+    def __contains__(self, key):
+        return key in self._exact or key in self._patterns
+
+    def __len__(self):
+        return len(self._exact) + len(self._patterns)
+
+
+_BLOOM_SALT = 0x5bd1e995  # for the second hash of an id
+
+
+class LRUIdSet(LRUCache):
+    '''
+    The last max_size distinct ids added, as a set. Adding an id again makes it
+    the most recent one. Exact, at the cost of keeping every id.
+    '''
+
+    def add_all(self, ids):
+        with self._lock:
+            for _id in ids:
+                self._data[_id] = None
+                self._data.move_to_end(_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def contains_all(self, ids) -> bool:
+        with self._lock:
+            return all(_id in self._data for _id in ids)
+
+
+class RotatingBloomFilter(object):
+    '''
+    A set of ids in bounded memory, that remembers at least the last capacity ids
+    added, and at most twice as many. Ids go to the current of two Bloom filters,
+    each sized for capacity ids; a full current filter replaces the previous one.
+    contains_all may wrongly say yes, at about false_positive_rate per id, never
+    wrongly no. Ids are hashed with hash(), so the filter only holds in one process.
+    At most four bits are set per id, which takes more memory than the optimal
+    number of bits for the rate, but keeps lookups quick in Python.
+    '''
+
+    MAX_HASHES = 4
+
+    def __init__(self, capacity: int = 100000, false_positive_rate: float = 0.001):
+        self.capacity = max(int(capacity), 1)
+        self.false_positive_rate = false_positive_rate
+        # each of the two filters gets half the rate, as a lookup checks both
+        rate = false_positive_rate / 2
+        optimal = -math.log(rate) / math.log(2)
+        self.hashes = max(min(int(round(optimal)), self.MAX_HASHES), 1)
+        # bits per id for {rate} with {hashes} bits set per id
+        per_id = -self.hashes / math.log(1 - rate ** (1 / self.hashes))
+        self.bits = max(int(math.ceil(self.capacity * per_id)), 8)
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._count = 0  # ids added to the current filter
+        self._lock = Lock()
+
+    def add_all(self, ids):
+        bits, hashes = self.bits, range(self.hashes)
+        with self._lock:
+            for _id in ids:
+                if self._count >= self.capacity:
+                    self._previous = self._current
+                    self._current = bytearray(len(self._previous))
+                    self._count = 0
+                current = self._current
+                h1, h2 = hash(_id), hash((_id, _BLOOM_SALT)) | 1
+                for i in hashes:
+                    position = (h1 + i * h2) % bits
+                    current[position >> 3] |= 1 << (position & 7)
+                self._count += 1
+
+    def contains_all(self, ids) -> bool:
+        bits, hashes = self.bits, range(self.hashes)
+        with self._lock:
+            current, previous = self._current, self._previous
+            for _id in ids:
+                h1, h2 = hash(_id), hash((_id, _BLOOM_SALT)) | 1
+                for table in (current, previous):
+                    for i in hashes:
+                        position = (h1 + i * h2) % bits
+                        if not table[position >> 3] & (1 << (position & 7)):
+                            break
+                    else:
+                        break  # every bit set in this table
+                else:
+                    return False
+            return True
+
+    def stats(self):
+        return {
+            'capacity': self.capacity,
+            'bytes': 2 * len(self._current),
+            'hashes': self.hashes
+        }
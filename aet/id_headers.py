@@ -0,0 +1,247 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# The contains_id header lists the ids of the documents of a Kafka message. It is a JSON
+# list, or, opted into by the producer, a compact binary form:
+#
+#   a 0 byte (never the start of JSON), a flags byte, then the body, zlib compressed
+#   when flag 1 is set. The body is the number of ids as a varint, then each id as a
+#   tag byte and its data:
+#     _STR         varint bytes shared with the previous string id, varint length and
+#                  the remaining UTF-8 bytes
+#     _INT         zigzag varint
+#     _JSON        varint length and the JSON of anything else (floats, booleans, null)
+#     _UUID + n    lowercase UUID strings: the 16 - n bytes after the n it shares with
+#                  the previous UUID id
+#
+# Readers accept both forms, so consumers need no configuration.
+
+from collections.abc import Sequence
+import json
+import re
+from typing import (
+    Any,
+    Iterator,
+    List,
+    Tuple,
+    Union
+)
+import zlib
+
+ID_HEADER = 'contains_id'
+ID_FORMATS = ('json', 'binary', 'binary+zlib')
+
+_MAGIC = 0
+_COMPRESSED = 1
+
+_STR = 0
+_INT = 1
+_JSON = 2
+_UUID = 16
+
+_UUID_PATTERN = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    n = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _shared(a: bytes, b: bytes) -> int:
+    # the length of the prefix {a} and {b} share, by bisection on slices
+    if not a or not b or a[0] != b[0]:
+        return 0
+    lo, hi = 1, min(len(a), len(b))
+    if a[:hi] == b[:hi]:
+        return hi
+    while hi - lo > 1:  # a[:lo] == b[:lo], a[:hi] != b[:hi]
+        mid = (lo + hi) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def encode_ids(ids: List[Any], id_format: str = 'json') -> Union[str, bytes]:
+    # the value of the contains_id header for {ids}, in one of ID_FORMATS
+    if id_format == 'json':
+        return json.dumps(ids)
+    if id_format not in ID_FORMATS:
+        raise ValueError(f'Unknown id header format {id_format}, expected one of {ID_FORMATS}')
+    body = bytearray(_varint(len(ids)))
+    append, match = body.append, _UUID_PATTERN.match
+    last_str, last_uuid = b'', b''
+    for _id in ids:
+        if isinstance(_id, str):
+            if len(_id) == 36 and match(_id):
+                raw = bytes.fromhex(_id.replace('-', ''))
+                n = _shared(raw, last_uuid)
+                append(_UUID + n)
+                body += raw[n:]
+                last_uuid = raw
+                continue
+            raw = _id.encode('utf-8')
+            n = _shared(raw, last_str)
+            append(_STR)
+            for size in (n, len(raw) - n):
+                if size < 0x80:
+                    append(size)
+                else:
+                    body += _varint(size)
+            body += raw[n:]
+            last_str = raw
+        elif type(_id) is int:
+            append(_INT)
+            body += _varint(_id * 2 if _id >= 0 else -_id * 2 - 1)
+        else:
+            raw = json.dumps(_id).encode('utf-8')
+            append(_JSON)
+            body += _varint(len(raw)) + raw
+    body = bytes(body)
+    if id_format == 'binary+zlib':
+        compressed = zlib.compress(body)
+        if len(compressed) < len(body):
+            return bytes([_MAGIC, _COMPRESSED]) + compressed
+    return bytes([_MAGIC, 0]) + body
+
+
+def encoded_id_size(_id: Any, id_format: str = 'json') -> int:
+    # the most bytes {_id} adds to the header, with its separator in JSON
+    if id_format == 'json':
+        return len(json.dumps(_id)) + 2
+    if isinstance(_id, str):
+        if len(_id) == 36 and _UUID_PATTERN.match(_id):
+            return 17
+        size = len(_id.encode('utf-8'))
+        return 1 + 2 * len(_varint(size)) + size
+    if type(_id) is int:
+        return 1 + len(_varint(abs(_id) * 2))
+    return 1 + len(json.dumps(_id)) + 5
+
+
+def is_binary(value: Union[str, bytes]) -> bool:
+    return isinstance(value, bytes) and value[:1] == bytes([_MAGIC])
+
+
+def _body(value: bytes) -> bytes:
+    if value[1] & _COMPRESSED:
+        return zlib.decompress(value[2:])
+    return value[2:]
+
+
+def iter_ids(value: Union[str, bytes]) -> Iterator[Any]:
+    # the ids of a contains_id header value, in either form, one at a time
+    if not value:
+        return
+    if not is_binary(value):
+        yield from json.loads(value)
+        return
+    body = _body(value)
+    count, pos = _read_varint(body, 0)
+    last_str, last_uuid = b'', b''
+    for _ in range(count):
+        tag = body[pos]
+        pos += 1
+        if tag >= _UUID:
+            end = pos + 16 - (tag - _UUID)
+            raw = last_uuid[:tag - _UUID] + body[pos:end]
+            pos = end
+            last_uuid = raw
+            h = raw.hex()
+            yield f'{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}'
+        elif tag == _STR:
+            n = body[pos]
+            if n < 0x80:
+                pos += 1
+            else:
+                n, pos = _read_varint(body, pos)
+            size = body[pos]
+            if size < 0x80:
+                pos += 1
+            else:
+                size, pos = _read_varint(body, pos)
+            raw = last_str[:n] + body[pos:pos + size]
+            pos += size
+            last_str = raw
+            yield raw.decode('utf-8')
+        elif tag == _INT:
+            n, pos = _read_varint(body, pos)
+            yield n // 2 if not n & 1 else -(n + 1) // 2
+        else:
+            size, pos = _read_varint(body, pos)
+            yield json.loads(body[pos:pos + size])
+            pos += size
+
+
+def decode_ids(value: Union[str, bytes]) -> List[Any]:
+    return list(iter_ids(value))
+
+
+class ContainedIds(Sequence):
+    '''
+    The ids of a contains_id header value, decoded when first read. The length of a
+    binary header is read from its count, without decoding the ids.
+    '''
+
+    __slots__ = ('value', '_ids')
+
+    def __init__(self, value: Union[str, bytes]):
+        self.value = value
+        self._ids = None
+
+    def _decoded(self) -> List[Any]:
+        if self._ids is None:
+            self._ids = decode_ids(self.value)
+        return self._ids
+
+    def __len__(self):
+        if self._ids is None and is_binary(self.value):
+            return _read_varint(_body(self.value), 0)[0]
+        return len(self._decoded())
+
+    def __getitem__(self, index):
+        return self._decoded()[index]
+
+    def __iter__(self):
+        if self._ids is not None:
+            return iter(self._ids)
+        return iter_ids(self.value)
+
+    def __eq__(self, other):
+        if isinstance(other, ContainedIds):
+            other = list(other)
+        return list(self) == other
+
+    def __repr__(self):
+        return f'ContainedIds({list(self)!r})'
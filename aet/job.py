@@ -76,6 +76,9 @@ class BaseJob(AbstractResource):
     # the configuration schema for instances of this job
     tenant: str  # tenant for this job
     validator: Any = None  # jsonschema validation object
+    # set to the commit_manager of the job's KafkaConsumer to commit the offsets of
+    # handled messages: after each _handle_messages, and synchronously on stop.
+    commit_manager: Any = None
 
     public_actions = AbstractResource.public_actions + [
         # These are only valid for jobs
@@ -180,17 +183,24 @@ class BaseJob(AbstractResource):
                     # config changed in flight, try again
                     self.safe_sleep(self.sleep_delay)  # wait for the status to change
                     continue
+                messages = None
                 try:
                     self.log.debug(f'{self._id} -> {self.status}')
                     messages = self._get_messages(config)
                     if messages:
                         self._handle_messages(config, messages)
+                        self._mark_handled(messages)
                 except MessageHandlingException as mhe:
                     self._on_message_handle_exception(mhe)
+                    self._mark_handled(messages)
                 except RuntimeError as rer:
                     self.log.critical(f'RuntimeError: {self._id} | {rer}')
+                    self._mark_handled(messages)
                     self.safe_sleep(self.sleep_delay)
 
+            if self.commit_manager is not None:
+                # on the job thread, which owns the consumer
+                self.commit_manager.commit(asynchronous=False)
             self.context.set_inactive(self._id)
             self.log.debug(f'Job {self._id} stopped normally.')
         except Exception as fatal:
@@ -219,6 +229,12 @@ class BaseJob(AbstractResource):
     def _on_message_handle_exception(self, mhe: MessageHandlingException):
         pass
 
+    def _mark_handled(self, messages):
+        # The job moves on from a batch once it was handled, or failed, so a failed batch
+        # must not hold back the commits of its partitions.
+        if messages and self.commit_manager is not None:
+            self.commit_manager.mark_handled(messages)
+
     def _cause_exception(self, exception: Exception = ValueError) -> None:
         # intentionally cause the thread to crash for testing purposes
         # should yield status.DEAD and throw a critical message for TypeError
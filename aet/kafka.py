@@ -16,39 +16,155 @@
 # specific language governing permissions and limitations
 # under the License.
 
-import ast
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
 from dataclasses import dataclass
-import io
+from itertools import compress, islice
 import json
+from queue import Queue
+from threading import Condition, Lock, Thread
+from time import monotonic
 from typing import (
     Any,
+    Callable,
+    Deque,
     Dict,
+    Iterator,
     List,
+    Optional,
+    Set,
+    Tuple,
     Union
 )
 
 
 import confluent_kafka
-from spavro.datafile import DataFileReader
-from spavro.io import DatumReader
+from requests.exceptions import RequestException
+from spavro.datafile import MAGIC
 from spavro.schema import AvroException
 
-from jsonpath_ng import parse
-
+from .avro_utils import (
+    DECODER_BACKENDS,
+    CachedDataFileReader,
+    PayloadReader,
+    SchemaCacheEntry,
+    WireFormatReader,
+    build_projected_reader,
+    build_schema_entry,
+    schema_fingerprint
+)
+from .columnar import ColumnarBatch
+from .exceptions import SchemaRegistryException
+from .filters import ApprovalFilter, MaskPlan, compile_mask_plan
+from .helpers import LRUCache, LRUIdSet, RotatingBloomFilter, TopicConfigMap
+from .id_headers import ID_HEADER, ContainedIds
 from .logger import get_logger
+from .schema_registry import (
+    WIRE_HEADER_SIZE,
+    SchemaRegistry,
+    get_schema_registry,
+    read_schema_id
+)
 
 LOG = get_logger('Kafka')
 
+_END = object()  # marks an exhausted iterator
 
-@dataclass
+
+# Payload formats, told apart by the first bytes of the payload
+PAYLOAD_AVRO = 'avro'             # Avro object container file
+PAYLOAD_CONFLUENT = 'confluent'   # Confluent wire format: a 0 byte and a 4 byte schema id
+PAYLOAD_JSON = 'json'             # JSON object or array
+PAYLOAD_TEXT = 'text'             # anything else
+PAYLOAD_FORMATS = (PAYLOAD_AVRO, PAYLOAD_CONFLUENT, PAYLOAD_JSON, PAYLOAD_TEXT)
+
+_JSON_START = frozenset(b'{[')
+_JSON_SCALAR_START = frozenset('"-0123456789tfnNI')  # json.loads also reads NaN, Infinity
+_WHITESPACE = frozenset(b' \t\r\n')
+
+
+def sniff_payload(value: bytes) -> str:
+    # Tells the format of a payload from its first bytes, without decoding it.
+    if value[:4] == MAGIC:
+        return PAYLOAD_AVRO
+    if value[:1] == b'\x00' and len(value) >= 5:
+        return PAYLOAD_CONFLUENT
+    pos = 0
+    while pos < len(value) and value[pos] in _WHITESPACE:  # without copying the payload
+        pos += 1
+    if pos < len(value) and value[pos] in _JSON_START:
+        return PAYLOAD_JSON
+    return PAYLOAD_TEXT
+
+
+class MessageMeta(object):
+    # The Kafka metadata of one container, shared by every record decoded from it.
+    __slots__ = ('key', 'offset', 'topic', 'partition', 'schema', 'headers')
+
+    def __init__(
+        self, key=None, offset=None, topic=None, partition=None, schema=None, headers=None
+    ):
+        self.key = key
+        self.offset = offset
+        self.topic = topic
+        self.partition = partition
+        self.schema = schema
+        self.headers = headers
+
+
+def _meta_property(name):
+    def fget(self):
+        return getattr(self._meta, name)
+
+    def fset(self, value):
+        # copy on write, the metadata may be shared with other records
+        meta = self._meta
+        self._meta = MessageMeta(*[getattr(meta, f) for f in MessageMeta.__slots__])
+        setattr(self._meta, name, value)
+    return property(fget, fset)
+
+
+@dataclass(init=False)
 class Message:
-    key: str = None
-    value: str = None
-    offset: int = None
-    topic: str = None
-    partition: int = None
-    schema: str = None
-    headers: List = None
+    # A decoded record and its Kafka metadata. Records of the same container share one
+    # MessageMeta; key, offset, topic, partition, schema and headers are properties
+    # that read it, and copy it on write. A record keeps value and _meta, plus the
+    # __dict__ and __weakref__ slots (16 bytes) that other attributes and weak
+    # references of the former dataclass need.
+    __slots__ = ('value', '_meta', '__dict__', '__weakref__')
+
+    key: str
+    value: str
+    offset: int
+    topic: str
+    partition: int
+    schema: str
+    headers: List
+
+    def __init__(
+        self,
+        key: str = None,
+        value: str = None,
+        offset: int = None,
+        topic: str = None,
+        partition: int = None,
+        schema: str = None,
+        headers: List = None
+    ):
+        self.value = value
+        self._meta = MessageMeta(key, offset, topic, partition, schema, headers)
+
+    @classmethod
+    def with_meta(cls, value, meta: MessageMeta) -> 'Message':
+        msg = cls.__new__(cls)
+        msg.value = value
+        msg._meta = meta
+        return msg
+
+
+for _name in MessageMeta.__slots__:
+    setattr(Message, _name, _meta_property(_name))
 
 
 @dataclass
@@ -65,35 +181,96 @@ class MaskConfig:
     emit_level: Any                         # chosen emit level
 
 
-class KafkaConsumer(confluent_kafka.Consumer):
+@dataclass
+class ProjectionConfig:
+    fields: List[str]                       # field names / paths to decode, i.e. ['id', '$.a.b']
 
-    # Adding these key/ value pairs to those handled by vanilla KafkaConsumer
+
+class MessageDeserializer(object):
+    # Deserialization, emit filtering and masking of raw Kafka payloads. KafkaConsumer
+    # builds on this class; on its own it needs no broker connection, which lets worker
+    # processes decode payloads with the same configuration as their consumer.
+
+    # Configuration handled by the deserializer, with defaults
     ADDITIONAL_CONFIG = {
         'aether_masking_schema_annotation': 'aetherMaskingLevel',
         'aether_masking_schema_levels': [0, 1, 2, 3, 4, 5],
         'aether_masking_schema_emit_level': 0,
         'aether_emit_flag_required': False,
         'aether_emit_flag_field_path': '$.approved',
-        'aether_emit_flag_values': [True]
+        'aether_emit_flag_values': [True],
+        'aether_projection_fields': None,
+        'aether_schema_cache_size': 256,
+        'aether_avro_decoder': 'spavro',      # or 'compiled', see avro_utils.DECODER_BACKENDS
+        'aether_schema_registry_url': None,   # http(s) url, or file:// url of a file registry
+        'aether_schema_registry_cache_dir': None
     }
-    _topic_mask_configs: Dict[str, MaskConfig]
-    _topic_filter_configs: Dict[str, FilterConfig]
+    _topic_mask_configs: TopicConfigMap
+    _topic_filter_configs: TopicConfigMap
+    _topic_projection_configs: TopicConfigMap
+    _schema_cache: LRUCache
 
-    def __init__(self, **kwargs):
-        self.config = {}
-        self._topic_mask_configs = {}
-        self._topic_filter_configs = {}
-        # Items not in either default or additional config raise KafkaConfigurationError on super
-        for k, v in KafkaConsumer.ADDITIONAL_CONFIG.items():
-            if k in kwargs:
-                self.config[k] = kwargs[k]
-                del kwargs[k]
-            else:
-                self.config[k] = v
-        super(KafkaConsumer, self).__init__(**kwargs)
+    def __init__(self, config: Dict[str, Any] = None, **kwargs):
+        self.config = {k: config.get(k, v) for k, v in self.ADDITIONAL_CONFIG.items()} \
+            if config is not None else deepcopy(self.ADDITIONAL_CONFIG)
+        self._init_caches()
+        super(MessageDeserializer, self).__init__(**kwargs)
+
+    def _init_caches(self):
+        # state that depends only on self.config, kept apart from __init__ so it can be
+        # (re)built without a broker connection.
+        self._payload_formats = Counter()
+        # guards the counters, as PartitionedConsumer decodes on several threads at once
+        self._stats_lock = Lock()
+        self._decoder = self.config.get('aether_avro_decoder') or 'spavro'
+        if self._decoder not in DECODER_BACKENDS:
+            raise ValueError(f'Unknown aether_avro_decoder {self._decoder}, '
+                             f'expected one of {sorted(DECODER_BACKENDS)}')
+        # configurations keyed by topic name or topic pattern, see TopicConfigMap
+        self._topic_mask_configs = TopicConfigMap()
+        self._topic_filter_configs = TopicConfigMap()
+        self._topic_projection_configs = TopicConfigMap()
+        # Avro container schemas by fingerprint, each entry also holds the per-topic
+        # mask and approval filter built for that schema.
+        self._schema_cache = LRUCache(self.config.get('aether_schema_cache_size'))
+        # compiled MaskPlans by (schema fingerprint, mask configuration)
+        self._mask_plans = LRUCache(self.config.get('aether_schema_cache_size'))
+        # (reader schema, datum reader) by (schema fingerprint, projected fields)
+        self._projected_readers = LRUCache(self.config.get('aether_schema_cache_size'))
+        # schemas of wire format payloads, and their fingerprints by registry id
+        self._registry_fingerprints = LRUCache(self.config.get('aether_schema_cache_size'))
+        self._schema_registry = None
+        self._custom_registry = None  # set with set_schema_registry
+        if self.config.get('aether_schema_registry_url'):
+            self._schema_registry = get_schema_registry(
+                self.config.get('aether_schema_registry_url'),
+                cache_dir=self.config.get('aether_schema_registry_cache_dir')
+            )
+
+    def get_schema_cache_stats(self) -> Dict[str, int]:
+        return self._schema_cache.stats()
+
+    def set_schema_registry(self, registry: SchemaRegistry):
+        # The registry used to resolve the schema ids of wire format payloads. It
+        # replaces the one built from {aether_schema_registry_url}; wrap it in a
+        # CachedSchemaRegistry unless it caches by itself.
+        self._schema_registry = self._custom_registry = registry
+        self._registry_fingerprints.clear()
 
     def set_topic_filter_config(self, topic, config: FilterConfig):
-        self._topic_filter_configs[topic] = config
+        # {topic} is a topic name, a glob like 'tenant-*' or a regular expression like
+        # '^tenant-[0-9]+$', see TopicConfigMap for the order in which rules apply.
+        self._topic_filter_configs.set(topic, config)
+        # a projection always includes the filter field
+        self._forget_topics(self._topic_filter_configs, topic, 'filters', 'readers')
+
+    def _forget_topics(self, configs: TopicConfigMap, key, *attrs):
+        # drops what the schema cache entries built for the topics matching {key}
+        for entry in self._schema_cache.values():
+            for attr in attrs:
+                built = getattr(entry, attr)
+                for topic in [t for t in built if configs.matches(key, t)]:
+                    built.pop(topic, None)
 
     def _default_filter_config(self) -> FilterConfig:
         return FilterConfig(
@@ -102,9 +279,7 @@ class KafkaConsumer(confluent_kafka.Consumer):
             pass_conditions=self.config.get('aether_emit_flag_values'))
 
     def _get_topic_filter_config(self, topic) -> FilterConfig:
-        if topic not in self._topic_filter_configs:
-            self.set_topic_filter_config(topic, self._default_filter_config())
-        return self._topic_filter_configs.get(topic)
+        return self._topic_filter_configs.get(topic, self._default_filter_config)
 
     def get_approval_filter(self, config: FilterConfig):
         # If {aether_emit_flag_required} is True, each message is checked for a passing value.
@@ -113,29 +288,18 @@ class KafkaConsumer(confluent_kafka.Consumer):
         # value found at path {aether_emit_flag_field_path} is not a member of the set configured
         # at {aether_emit_flag_values}, then the message will not be published. If the value is in
         # the set {aether_emit_flag_values}, it will be published. These rules resolve to a simple
-        # boolean filter which is returned by this function.
+        # boolean filter which is returned by this function. pass_conditions can also be a
+        # Predicate (see aet.filters) for ranges, patterns, null checks and their combinations.
+        # The ApprovalFilter can check a whole block of records at once.
         if not config.requires_approval:
-            def approval_filter(obj):
-                return True
-            return approval_filter
-        check = None
-        if isinstance(config.pass_conditions, list):
-            def check(x):
-                return x in config.pass_conditions
-        else:
-            def check(x):
-                return x == config.pass_conditions
-        expr = parse(config.check_condition_path)
-
-        def approval_filter(msg):
-            values = [match.value for match in expr.find(msg)]
-            if not len(values) > 0:
-                return False
-            return check(values[0])  # We only check the first matching path/ value
-        return approval_filter
+            return ApprovalFilter()
+        # Simple paths are compiled to direct lookups, jsonpath_ng handles the rest.
+        # We only check the first matching path / value.
+        return ApprovalFilter(config.check_condition_path, config.pass_conditions)
 
     def set_topic_mask_config(self, topic, config: MaskConfig):
-        self._topic_mask_configs[topic] = config
+        self._topic_mask_configs.set(topic, config)
+        self._forget_topics(self._topic_mask_configs, topic, 'masks', 'plans')
 
     def _default_mask_config(self):
         return MaskConfig(
@@ -144,11 +308,9 @@ class KafkaConsumer(confluent_kafka.Consumer):
             emit_level=self.config.get('aether_masking_schema_emit_level'))
 
     def _get_topic_mask_config(self, topic):
-        if topic not in self._topic_mask_configs:
-            self.set_topic_mask_config(topic, self._default_mask_config())
-        return self._topic_mask_configs.get(topic, None)
+        return self._topic_mask_configs.get(topic, self._default_mask_config)
 
-    def get_mask_from_schema(self, schema, config: MaskConfig):
+    def get_mask_from_schema(self, schema, config: MaskConfig, fingerprint: str = None):
         # This creates a masking function that will be applied to all messages emitted
         # in poll_and_deserialize, *IF a topic override does not exist..*
         # Fields that may need to be masked must have in their
@@ -158,28 +320,72 @@ class KafkaConsumer(confluent_kafka.Consumer):
         # level classification. That classification should match one of the levels passes to
         # the consumer (mask_levels). Fields over the approved classification (emit_level) as
         # ordered in (mask_levels) will be removed from the message before being emitted.
-        if not config or not config.mask_query:
+        # The rules are compiled once into an immutable MaskPlan. When the schema fingerprint
+        # is known, the plan is cached and shared by every topic using the same schema and
+        # configuration.
+        plan = self.get_mask_plan(schema, config, fingerprint)
+        if plan is None:
             return
+        return plan.apply
+
+    def get_mask_plan(self, schema, config: MaskConfig, fingerprint: str = None) -> MaskPlan:
+        # the compiled MaskPlan behind get_mask_from_schema, None without masking
+        if not config or not config.mask_query:
+            return None
+        key = self._mask_plan_key(fingerprint, config)
+        plan = self._mask_plans.get(key) if key else None
+        if plan is None:
+            plan = compile_mask_plan(
+                schema, config.mask_query, config.mask_levels, config.emit_level)
+            if key:
+                self._mask_plans.put(key, plan)
+        return plan
+
+    def _mask_plan_key(self, fingerprint, config: MaskConfig):
+        if not fingerprint:
+            return None
+        key = (fingerprint, config.mask_query, tuple(config.mask_levels), config.emit_level)
         try:
-            emit_index = config.mask_levels.index(config.emit_level)
-        except ValueError:
-            emit_index = -1  # emit level is off the scale, so we don't emit any classified data
-        # parent node of matching field
-        query_string = '$.fields.[*].%s.`parent`' % config.mask_query
-        expr = parse(query_string)
-        restricted_fields = [(match.value) for match in expr.find(schema)]
-        restriction_map = [
-            [obj.get('name'), obj.get(config.mask_query)] for obj in restricted_fields]
-        failing_values = [
-            i[1] for i in restriction_map if config.mask_levels.index(i[1]) > emit_index]
-
-        def mask(msg):
-            for name, field_level in restriction_map:
-                if msg.get(name, None) is not None:  # message has a field with classification
-                    if field_level in failing_values:  # classification is above threshold
-                        msg.pop(name, None)
-            return msg
-        return mask
+            hash(key)
+        except TypeError:  # unhashable classification levels, compile without caching
+            return None
+        return key
+
+    def set_topic_projection_config(self, topic, config: ProjectionConfig):
+        self._topic_projection_configs.set(topic, config)
+        self._forget_topics(self._topic_projection_configs, topic, 'readers')
+
+    def _default_projection_config(self) -> ProjectionConfig:
+        fields = self.config.get('aether_projection_fields')
+        if not fields:
+            return None
+        return ProjectionConfig(fields=fields)
+
+    def _get_topic_projection_config(self, topic) -> ProjectionConfig:
+        return self._topic_projection_configs.get(topic, self._default_projection_config)
+
+    def get_projected_reader(self, entry: SchemaCacheEntry, topic) -> Tuple[Dict, Any]:
+        # Many jobs only need a few fields of a wide schema. With a projection configured
+        # for the topic, we build a reader schema with just those fields (plus the field
+        # checked by the emit filter), and let Avro schema resolution skip the others while
+        # decoding. Returns the schema of the decoded records and the datum reader to use.
+        config = self._get_topic_projection_config(topic)
+        if not config or not config.fields:
+            return entry.schema, entry.datum_reader
+        fields = list(config.fields)
+        filter_config = self._get_topic_filter_config(topic)
+        if filter_config.requires_approval:
+            fields.append(filter_config.check_condition_path)
+        key = (entry.fingerprint, tuple(fields))
+        projected = self._projected_readers.get(key)
+        if projected is None:
+            try:
+                projected = build_projected_reader(entry.schema, fields, self._decoder)
+            except (AvroException, ValueError) as err:
+                LOG.error(f'Cannot project {fields} on {topic}, decoding all fields: {err}')
+                projected = (entry.schema, entry.datum_reader)
+            self._projected_readers.put(key, projected)
+        return projected
 
     def mask_message(self, msg, mask=None):
         # this applies a mask created from get_mask_from_schema()
@@ -188,125 +394,186 @@ class KafkaConsumer(confluent_kafka.Consumer):
         else:
             return mask(msg)
 
-    def poll_and_deserialize(self, num_messages=1, timeout=1):
-        # None of the methods in the Python Kafka library deserialize messages, which is a
-        # required step in order to filter fields which may be masked, or to only publish
-        # messages which meet a certain condition. For this reason, we extend the poll() method
-        # from the Kafka library to handle deserialization in a fast and reliable way. We also
-        # implement masking and field filtering in this method, based on the consumer configuration
-        # passed in __init__ and the schema of each message.
+    def deserialize_value(self, topic: str, value: bytes) -> Dict[str, Any]:
+        # Decodes, filters and masks the payload of a single Kafka message.
+        # Avro containers yield any number of records, other payloads a single JSON
+        # document or string.
+        package_result = self._open_value(topic, value)
+        package_result['messages'] = list(package_result['messages'])
+        return package_result
 
-        last_schema = {}
-        mask = None
-        approval_filter = None
-        result = []
-        incoming = self.consume(num_messages=num_messages, timeout=timeout)
-        for m in incoming:
-            key = m.key()
-            partition = m.partition()
-            offset = m.offset()
-            headers = m.headers()
-            topic = m.topic()
-            obj = io.BytesIO()
-            obj.write(m.value())
-            LOG.debug(f'{topic} | {offset}')
-            try:
-                reader = DataFileReader(obj, DatumReader())
-                (
-                    package_result,
-                    last_schema,
-                    mask,
-                    approval_filter
-                ) = \
-                    self._reader_to_messages(
-                        reader,
-                        last_schema,
-                        mask,
-                        approval_filter,
-                        topic
-                )
-                obj.close()  # don't forget to close your open IO object.
-                if package_result.get('schema') or len(package_result['messages']) > 0:
-                    schema = package_result.get('schema')
-                    for message_body in package_result['messages']:
-                        result.append(Message(
-                            key,
-                            message_body,
-                            offset,
-                            topic,
-                            partition,
-                            schema,
-                            headers
-                        ))
-            except AvroException:
-                reader = None
-                (
-                    package_result,
-                    last_schema,
-                    mask,
-                    approval_filter
-                ) = (
-                    self._unpack_bytes_message(obj),
-                    None,
-                    None,
-                    None
-                )
-                obj.close()  # don't forget to close your open IO object.
-                if len(package_result['messages']) > 0:
-                    for message_body in package_result['messages']:
-                        result.append(Message(
-                            key,
-                            message_body,
-                            offset,
-                            topic,
-                            partition,
-                            None,
-                            headers
-                        ))
-        return result
-
-    def _reader_to_messages(self, reader, last_schema, mask, approval_filter, topic):
+    def get_payload_format_stats(self) -> Dict[str, int]:
+        # payloads seen by format, see sniff_payload
+        with self._stats_lock:
+            return {f: self._payload_formats[f] for f in PAYLOAD_FORMATS}
+
+    def _open_value(self, topic: str, value: bytes) -> Dict[str, Any]:
+        # As deserialize_value, but the records of an Avro container are decoded lazily
+        # as package_result['messages'] is iterated.
+        payload_format, reader = self._open_container(value)
+        if reader is None:
+            return self._unpack_bytes_message(value, payload_format)
+        return self._reader_to_messages(reader, topic)
+
+    def _open_container(self, value: bytes) -> Tuple[str, CachedDataFileReader]:
+        # Payloads are routed on their first bytes. Returns the payload format and, for
+        # Avro containers, a reader.
+        payload_format, reader = self._open_reader(value, sniff_payload(value))
+        # counted as read, e.g. a damaged container as text, as the workers report it
+        with self._stats_lock:
+            self._payload_formats[payload_format] += 1
+        return payload_format, reader
+
+    def _open_reader(self, value: bytes, payload_format: str):
+        if payload_format == PAYLOAD_CONFLUENT:
+            reader = self._open_wire_format(value)
+            return (payload_format if reader else PAYLOAD_TEXT), reader
+        if payload_format != PAYLOAD_AVRO:
+            return payload_format, None
+        try:
+            return payload_format, CachedDataFileReader(
+                PayloadReader(value), self._schema_cache, self._decoder)
+        except AvroException as aex:  # a damaged container, read as text as it always was
+            LOG.debug(f'Could not read Avro container: {aex}')
+            return PAYLOAD_TEXT, None
+
+    def _open_wire_format(self, value: bytes) -> WireFormatReader:
+        # Without a registry, or if the schema cannot be resolved, wire format payloads
+        # are read as text, as any payload that is not an Avro container.
+        if self._schema_registry is None:
+            return None
+        try:
+            entry = self._registry_entry(read_schema_id(value))
+            return WireFormatReader(value, entry, WIRE_HEADER_SIZE)
+        except (SchemaRegistryException, RequestException, AvroException, ValueError) as err:
+            LOG.error(f'Could not resolve the schema of a wire format payload: {err}')
+            return None
+
+    def _registry_entry(self, schema_id: int) -> SchemaCacheEntry:
+        # Registry schemas share the schema cache (and so masks, filters and
+        # projections) with the schemas of Avro containers.
+        fingerprint = self._registry_fingerprints.get(schema_id)
+        entry = self._schema_cache.get(fingerprint) if fingerprint else None
+        if entry is None:
+            raw_schema = self._schema_registry.get_schema(schema_id).encode('utf-8')
+            fingerprint = schema_fingerprint(raw_schema)
+            entry = self._schema_cache.get(fingerprint) or \
+                build_schema_entry(raw_schema, fingerprint, self._decoder)
+            self._schema_cache.put(fingerprint, entry)
+            self._registry_fingerprints.put(schema_id, fingerprint)
+        return entry
+
+    def _reader_to_messages(self, reader: CachedDataFileReader, topic):
+        approval_filter, mask, schema = self._prepare_reader(reader, topic)
         package_result = {
-            'schema': None,
-            'messages': []
+            'schema': schema,
+            'fingerprint': reader.schema_entry.fingerprint,
+            'format': self._reader_format(reader),
+            'messages': self._iter_reader(reader, approval_filter, mask)
         }
-        # We can get the schema directly from the reader.
-        # we get a mess of unicode that can't be json parsed so we need ast
-        raw_schema = ast.literal_eval(str(reader.meta))
-        schema = json.loads(raw_schema.get('avro.schema'))
-        filter_config = self._get_topic_filter_config(topic)
-        mask_config = self._get_topic_mask_config(topic)
-
-        if schema != last_schema.get(topic):
-            last_schema[topic] = schema
-            package_result['schema'] = schema
-            # prepare mask and filter
-            approval_filter = self.get_approval_filter(filter_config)
-            mask = self.get_mask_from_schema(schema, mask_config)
+        return package_result
+
+    def _reader_format(self, reader) -> str:
+        return PAYLOAD_CONFLUENT if isinstance(reader, WireFormatReader) else PAYLOAD_AVRO
+
+    def _prepare_reader(self, reader: CachedDataFileReader, topic):
+        # The reader has already resolved the container schema against the schema cache,
+        # so a repeated schema costs a single lookup. The mask and approval filter for
+        # this topic are built once per schema and kept on the cache entry.
+        # Returns the approval filter, the mask and the schema of the decoded records.
+        entry = reader.schema_entry
+        approval_filter = entry.filters.get(topic)
+        if approval_filter is None:
+            approval_filter = self.get_approval_filter(self._get_topic_filter_config(topic))
+            entry.filters[topic] = approval_filter
+        if topic in entry.masks:
+            mask = entry.masks[topic]
+        else:
+            mask = self.get_mask_from_schema(
+                entry.schema, self._get_topic_mask_config(topic), entry.fingerprint)
+            entry.masks[topic] = mask
+        if topic in entry.readers:
+            schema, datum_reader = entry.readers[topic]
         else:
-            package_result['schema'] = last_schema
-        for x, msg in enumerate(reader):
-            # is message is ready for consumption, process it
-            if approval_filter(msg):
-                # apply masking
-                processed_message = self.mask_message(msg, mask)
-                package_result['messages'].append(processed_message)
+            schema, datum_reader = entry.readers[topic] = self.get_projected_reader(entry, topic)
+        if datum_reader is not entry.datum_reader:
+            reader.set_datum_reader(datum_reader)
+        return approval_filter, mask, schema
 
-        return package_result, last_schema, mask, approval_filter
+    def _open_rows(self, topic: str, value: bytes) -> Dict[str, Any]:
+        # As deserialize_value, but records are neither filtered nor masked. Instead the
+        # package holds the approval filter ('filter', None if not required) and the
+        # MaskPlan ('mask_plan') of the topic, to be applied to a whole batch at once.
+        payload_format, reader = self._open_container(value)
+        if reader is None:
+            package_result = self._unpack_bytes_message(value, payload_format)
+            package_result.update({'filter': None, 'mask_plan': None})
+            return package_result
+        entry = reader.schema_entry
+        try:
+            approval_filter, _, schema = self._prepare_reader(reader, topic)
+            rows = [row for block in reader.iter_blocks() for row in block]
+        finally:
+            reader.close()
+        if not self._get_topic_filter_config(topic).requires_approval:
+            approval_filter = None
+        if topic in entry.plans:
+            mask_plan = entry.plans[topic]
+        else:
+            mask_plan = entry.plans[topic] = self.get_mask_plan(
+                entry.schema, self._get_topic_mask_config(topic), entry.fingerprint)
+        return {
+            'schema': schema,
+            'fingerprint': entry.fingerprint,
+            'format': self._reader_format(reader),
+            'messages': rows,
+            'filter': approval_filter,
+            'mask_plan': mask_plan
+        }
+
+    def _iter_reader(self, reader: CachedDataFileReader, approval_filter, mask):
+        # records are decoded and checked a block at a time
+        keep = getattr(approval_filter, 'keep', None)  # None for plain callables
+        try:
+            for block in reader.iter_blocks():
+                if keep is None:
+                    block = filter(approval_filter, block)
+                elif not approval_filter.accepts_all:
+                    block = compress(block, keep(block))
+                for msg in block:
+                    # apply masking
+                    yield self.mask_message(msg, mask)
+        finally:
+            reader.close()  # also closes the underlying IO object
 
-    def _unpack_bytes_message(self, reader):
+    def _unpack_bytes_message(self, value: bytes, payload_format: str = PAYLOAD_TEXT):
+        # JSON documents and text. Text is only parsed as JSON if it could be a JSON
+        # scalar, so plain text does not cost a failed parse.
+        text = self._decode_text(value)
+        start = text[:1]
+        if start.isspace():
+            start = text.lstrip()[:1]
+        if payload_format == PAYLOAD_JSON or start in _JSON_SCALAR_START:
+            document = self._read_json(text)
+        else:
+            document = text
         package_result = {
             'schema': None,
-            'messages': [self._read_json(self._decode_text(reader))]
+            'fingerprint': None,
+            'format': payload_format,
+            'messages': [document]
         }
         return package_result
 
     def _decode_text(self, reader):
+        # {reader} is the payload (any bytes-like object), or an IO object holding it
+        value = reader if isinstance(reader, (bytes, bytearray, memoryview)) \
+            else reader.getvalue()
         try:
-            return reader.getvalue().decode('utf-8', 'strict')
+            return str(value, 'utf-8', 'strict')
         except UnicodeDecodeError:
             pass
-        return reader.getvalue().decode('ascii', 'strict')  # raises UnicodeDecodeError
+        return str(value, 'ascii', 'strict')  # raises UnicodeDecodeError
 
     def _read_json(self, raw_text):
         try:
@@ -314,6 +581,670 @@ class KafkaConsumer(confluent_kafka.Consumer):
         except json.decoder.JSONDecodeError:
             return raw_text
 
+
+class _PartitionOffsets(object):
+    # consumed offsets of a partition, in order, until they are handled
+    __slots__ = ('inflight', 'done', 'held', 'next', 'committed')
+
+    def __init__(self):
+        self.inflight: Deque[int] = deque()
+        self.done: Set[int] = set()
+        self.held: Set[int] = set()   # not handled until released, whatever is marked
+        self.next: int = None       # offset to commit: all messages before it are handled
+        self.committed: int = None  # last offset sent to the broker
+
+
+class CommitManager(object):
+    # Commits the offsets of handled messages, coalesced. Consumed Kafka messages are
+    # tracked per partition in the order they arrive. A partition can be committed up to
+    # the first message not handled yet, so messages may be marked handled out of order
+    # without a later one committing past an earlier one (at least once delivery).
+    #
+    # Offsets are committed asynchronously once {every_messages} messages were handled or
+    # {interval_ms} passed since the last commit, and synchronously by commit(False).
+
+    def __init__(
+        self,
+        consumer: confluent_kafka.Consumer,
+        every_messages: int = 1000,
+        interval_ms: int = 5000,
+        clock: Callable[[], float] = monotonic
+    ):
+        self.consumer = consumer
+        self.every_messages = every_messages
+        self.interval_ms = interval_ms
+        self._clock = clock
+        self._lock = Lock()
+        self._partitions: Dict[Tuple[str, int], _PartitionOffsets] = {}
+        self._pending = 0  # messages handled since the last commit
+        self._last_commit = clock()
+        self.commits = 0
+
+    def track(self, topic: str, partition: int, offset: int, handled: bool = False):
+        # Registers a consumed Kafka message. Messages that yield no records (all were
+        # filtered out) are {handled} as soon as they are read.
+        with self._lock:
+            offsets = self._partitions.get((topic, partition))
+            if offsets is None:
+                offsets = self._partitions[(topic, partition)] = _PartitionOffsets()
+            if offsets.inflight and offset <= offsets.inflight[-1]:
+                self._truncate(offsets, offset)  # delivered again after a rewind
+            offsets.inflight.append(offset)
+            if handled:
+                self._mark(offsets, offset)
+
+    def rewind(self, topic: str, partition: int, offset: int):
+        # forgets messages from {offset} on, they will be consumed again
+        with self._lock:
+            offsets = self._partitions.get((topic, partition))
+            if offsets is not None:
+                self._truncate(offsets, offset)
+
+    def hold(self, topic: str, partition: int, offset: int):
+        # Keeps a Kafka message from being handled, i.e. a container whose records are
+        # delivered over several polls, until it is released.
+        with self._lock:
+            offsets = self._partitions.get((topic, partition))
+            if offsets is not None:
+                offsets.held.add(offset)
+
+    def release(self, topic: str, partition: int, offset: int):
+        # the message is handled again once marked, marks made while it was held are lost
+        with self._lock:
+            offsets = self._partitions.get((topic, partition))
+            if offsets is not None:
+                offsets.held.discard(offset)
+
+    def _truncate(self, offsets: _PartitionOffsets, offset: int):
+        while offsets.inflight and offsets.inflight[-1] >= offset:
+            dropped = offsets.inflight.pop()
+            offsets.done.discard(dropped)
+            offsets.held.discard(dropped)
+
+    def _mark(self, offsets: _PartitionOffsets, offset: int):
+        if not offsets.inflight or not offsets.inflight[0] <= offset <= offsets.inflight[-1]:
+            return  # not tracked, or rewound since
+        if offset in offsets.held:
+            return
+        offsets.done.add(offset)
+        while offsets.inflight and offsets.inflight[0] in offsets.done:
+            done = offsets.inflight.popleft()
+            offsets.done.discard(done)
+            offsets.next = done + 1
+
+    def mark_handled(self, messages: Union[List[Message], ColumnarBatch]):
+        # Marks Messages, or the rows of a ColumnarBatch, handled. The records of an Avro
+        # container share the offset of their Kafka message, which is handled once any of
+        # them is marked: mark containers as a whole. May commit.
+        if isinstance(messages, ColumnarBatch):
+            positions = [
+                (messages.topic, int(p), int(o))
+                for p, o in zip(messages.partitions, messages.offsets)
+            ]
+        else:
+            positions = [(m.topic, m.partition, m.offset) for m in messages]
+        with self._lock:
+            for topic, partition, offset in positions:
+                offsets = self._partitions.get((topic, partition))
+                if offsets is not None:
+                    self._mark(offsets, offset)
+            self._pending += len(positions)
+        self.maybe_commit()
+
+    def maybe_commit(self):
+        # commits asynchronously once enough messages were handled, or enough time passed
+        due = self._pending >= self.every_messages or \
+            (self._clock() - self._last_commit) * 1000 >= self.interval_ms
+        if due:
+            self.commit(asynchronous=True)
+
+    def committable(self) -> Dict[Tuple[str, int], int]:
+        # the offset each partition can be committed to, where it moved since the last commit
+        with self._lock:
+            return {
+                tp: offsets.next for tp, offsets in self._partitions.items()
+                if offsets.next is not None and offsets.next != offsets.committed
+            }
+
+    def commit(self, asynchronous: bool = True, partitions: List[Tuple[str, int]] = None):
+        # commits the handled offsets of all partitions, or of {partitions}
+        offsets = self.committable()
+        if partitions is not None:
+            offsets = {tp: offset for tp, offset in offsets.items() if tp in partitions}
+        with self._lock:
+            self._pending = 0
+            self._last_commit = self._clock()
+            for tp, offset in offsets.items():
+                self._partitions[tp].committed = offset
+        if not offsets:
+            return None
+        self.commits += 1
+        try:
+            return self.consumer.commit(
+                offsets=_topic_partitions(offsets), asynchronous=asynchronous)
+        except confluent_kafka.KafkaException as ker:
+            with self._lock:  # tried again with the next commit
+                for tp in offsets:
+                    if tp in self._partitions:
+                        self._partitions[tp].committed = None
+            LOG.error(f'Could not commit offsets {offsets}: {ker}')
+            return None
+
+    def forget(self, partitions: List[Tuple[str, int]]):
+        # drops the state of partitions that were revoked or lost
+        with self._lock:
+            for tp in partitions:
+                self._partitions.pop(tp, None)
+
+
+class KafkaConsumer(MessageDeserializer, confluent_kafka.Consumer):
+
+    # Adding these key/ value pairs to those handled by vanilla KafkaConsumer
+    ADDITIONAL_CONFIG = {
+        **MessageDeserializer.ADDITIONAL_CONFIG,
+        'aether_deserialize_workers': 0,      # > 0 decodes in a process pool of this size
+        'aether_deserialize_chunk_size': 8,   # Kafka messages sent to a worker per task
+        'aether_commit_manager': False,       # commit handled offsets, see CommitManager
+        'aether_commit_every_messages': 1000,
+        'aether_commit_interval_ms': 5000,
+        'aether_poll_max_bytes': None,        # defaults of the poll_and_deserialize budgets
+        'aether_poll_max_records': None,
+        'aether_dedup_window': 0,             # > 0 skips containers whose ids were all seen
+        'aether_dedup_store': 'bloom',        # or 'lru', see _dedup_store
+        'aether_dedup_false_positive_rate': 0.001
+    }
+
+    def __init__(self, **kwargs):
+        config = {}
+        # Items not in either default or additional config raise KafkaConfigurationError on super
+        for k, v in KafkaConsumer.ADDITIONAL_CONFIG.items():
+            if k in kwargs:
+                config[k] = kwargs[k]
+                del kwargs[k]
+            else:
+                config[k] = v
+        if config.get('aether_commit_manager'):
+            # only offsets of handled messages may be committed
+            if kwargs.get('enable.auto.commit'):
+                LOG.warning('enable.auto.commit is on, offsets are committed before they '
+                            'are handled, whatever the commit manager does')
+            kwargs.setdefault('enable.auto.commit', False)
+        super(KafkaConsumer, self).__init__(config, **kwargs)
+
+    def _init_caches(self):
+        super(KafkaConsumer, self)._init_caches()
+        self._pool = None
+        self._pool_lock = Lock()  # PartitionedConsumer workers may all ask for the pool
+        self._pool_schemas = {}
+        # what a budgeted poll_and_deserialize left for the next call: Kafka messages not
+        # opened yet, the records of those being decoded, and a container split between
+        # two polls, held from being committed.
+        self._carried_incoming = []
+        self._carried_stream = None
+        self._carried_peek = None   # read from the stream to find out if it was done
+        self._split_position = None
+        self._seen_ids = _dedup_store(self.config)
+        self._duplicates = Counter()
+        self.commit_manager = None
+        if self.config.get('aether_commit_manager'):
+            self.commit_manager = CommitManager(
+                self,
+                every_messages=self.config.get('aether_commit_every_messages'),
+                interval_ms=self.config.get('aether_commit_interval_ms')
+            )
+
+    def subscribe(self, topics, on_assign=None, on_revoke=None, on_lost=None):
+        # With a commit manager, revoked partitions commit their handled offsets
+        # synchronously, after {on_revoke}, before they move to another consumer.
+        return super(KafkaConsumer, self).subscribe(
+            topics, **self._rebalance_callbacks(on_assign, on_revoke, on_lost))
+
+    def _rebalance_callbacks(self, on_assign=None, on_revoke=None, on_lost=None):
+        # Records carried over by a budgeted poll are dropped when partitions move, the
+        # partitions that stay are rewound to consume them again.
+        commits = self.commit_manager
+
+        def assigned(consumer, partitions):
+            if commits is not None:
+                commits.forget([(p.topic, p.partition) for p in partitions])
+            if on_assign:
+                on_assign(consumer, partitions)
+
+        def revoked(consumer, partitions):
+            if on_revoke:
+                on_revoke(consumer, partitions)
+            self._drop_carried()
+            if commits is not None:
+                tps = [(p.topic, p.partition) for p in partitions]
+                commits.commit(asynchronous=False, partitions=tps)
+                commits.forget(tps)
+
+        def lost(consumer, partitions):
+            # the partitions may already belong to another consumer, nothing is committed
+            if on_lost or on_revoke:
+                (on_lost or on_revoke)(consumer, partitions)
+            self._drop_carried()
+            if commits is not None:
+                commits.forget([(p.topic, p.partition) for p in partitions])
+
+        return {'on_assign': assigned, 'on_revoke': revoked, 'on_lost': lost}
+
+    def mark_handled(self, messages: Union[List[Message], ColumnarBatch]):
+        # see CommitManager.mark_handled, does nothing without a commit manager
+        if self.commit_manager is not None:
+            self.commit_manager.mark_handled(messages)
+
+    @staticmethod
+    def get_contained_ids(message) -> Optional[ContainedIds]:
+        # The ids a producer listed in the contains_id header of {message}, a Message or
+        # a confluent_kafka Message. JSON and binary headers are both read, when the
+        # ids are first used. None without the header.
+        headers = message.headers
+        if callable(headers):
+            headers = headers()
+        for key, value in headers or []:
+            if key == ID_HEADER:
+                return ContainedIds(value)
+        return None
+
+    def set_schema_registry(self, registry: SchemaRegistry):
+        # With aether_deserialize_workers, the workers are restarted with {registry}, which
+        # must be picklable unless processes are forked.
+        super(KafkaConsumer, self).set_schema_registry(registry)
+        self._shutdown_pool()
+
+    def set_topic_filter_config(self, topic, config: FilterConfig):
+        super(KafkaConsumer, self).set_topic_filter_config(topic, config)
+        self._shutdown_pool()  # workers hold a copy of the topic configurations
+
+    def set_topic_mask_config(self, topic, config: MaskConfig):
+        super(KafkaConsumer, self).set_topic_mask_config(topic, config)
+        self._shutdown_pool()
+
+    def set_topic_projection_config(self, topic, config: ProjectionConfig):
+        super(KafkaConsumer, self).set_topic_projection_config(topic, config)
+        self._shutdown_pool()
+
+    def poll_and_deserialize(self, num_messages=1, timeout=1, max_bytes=None, max_records=None):
+        # None of the methods in the Python Kafka library deserialize messages, which is a
+        # required step in order to filter fields which may be masked, or to only publish
+        # messages which meet a certain condition. For this reason, we extend the poll() method
+        # from the Kafka library to handle deserialization in a fast and reliable way. We also
+        # implement masking and field filtering in this method, based on the consumer configuration
+        # passed in __init__ and the schema of each message.
+        # {max_bytes} bounds the payload bytes of the Kafka messages opened by a call and
+        # {max_records} the records it returns (defaults: aether_poll_max_bytes and
+        # aether_poll_max_records). What is left is carried over to the next call.
+        if max_bytes is None:
+            max_bytes = self.config.get('aether_poll_max_bytes')
+        if max_records is None:
+            max_records = self.config.get('aether_poll_max_records')
+        if max_bytes is None and max_records is None and not self._has_carried():
+            return list(self.iter_deserialize(num_messages=num_messages, timeout=timeout))
+        return self._poll_budgeted(num_messages, timeout, max_bytes, max_records)
+
+    def _has_carried(self) -> bool:
+        return bool(self._carried_incoming) or self._carried_stream is not None \
+            or self._carried_peek is not None
+
+    def _poll_budgeted(self, num_messages, timeout, max_bytes, max_records) -> List[Message]:
+        # Consumes only once nothing is carried over. Containers are decoded a block at a
+        # time, so a call holds at most the records it returns, one block ahead, and the
+        # payloads of the Kafka messages it consumed.
+        messages: List[Message] = []
+        budget = max_bytes
+        opened = 0  # Kafka messages opened by this call
+        consumed = False
+        while max_records is None or len(messages) < max_records:
+            if self._carried_stream is None:
+                if not self._carried_incoming:
+                    if consumed or messages:
+                        break
+                    self._carried_incoming = list(
+                        self.consume(num_messages=num_messages, timeout=timeout) or [])
+                    consumed = True
+                taken = []
+                for m in self._carried_incoming:
+                    size = len(m.value() or b'')
+                    # a message larger than the budget is still opened, on its own
+                    if budget is not None and size > budget and (taken or opened):
+                        break
+                    taken.append(m)
+                    if budget is not None:
+                        budget = max(budget - size, 0)
+                if not taken:
+                    break
+                opened += len(taken)
+                self._carried_incoming = self._carried_incoming[len(taken):]
+                self._carried_stream = self._iter_messages(taken)
+            if self._carried_peek is not None:
+                messages.append(self._carried_peek)
+                self._carried_peek = None
+            limit = None if max_records is None else max_records - len(messages)
+            chunk = list(islice(self._carried_stream, limit))
+            messages.extend(chunk)
+            if limit is None or len(chunk) < limit:
+                self._carried_stream = None
+        self._hold_split_container(messages)
+        return messages
+
+    def _hold_split_container(self, messages: List[Message]):
+        # The records of a container share its offset. When the container goes on in the
+        # next call, marking this call's records handled must not commit past it.
+        split = None
+        if messages and self._carried_stream is not None:
+            following = next(self._carried_stream, _END)
+            if following is _END:
+                self._carried_stream = None
+            else:
+                self._carried_peek = following
+                last = messages[-1]
+                if (following.topic, following.partition, following.offset) == \
+                        (last.topic, last.partition, last.offset):
+                    split = (last.topic, last.partition, last.offset)
+        if self.commit_manager is not None and split != self._split_position:
+            if self._split_position is not None:
+                self.commit_manager.release(*self._split_position)
+            if split is not None:
+                self.commit_manager.hold(*split)
+        self._split_position = split
+
+    def _drop_carried(self):
+        # Rewinds the partitions of what was carried over, to be consumed again. Later
+        # messages of a partition are rewound first, the last seek wins.
+        if self._carried_incoming:
+            self._rewind(self._carried_incoming)
+            self._carried_incoming = []
+        if self._carried_stream is not None:
+            self._carried_stream.close()  # a started _iter_messages rewinds on close
+            self._carried_stream = None
+        if self._carried_peek is not None:
+            peek = self._carried_peek
+            self._rewind_to(peek.topic, peek.partition, peek.offset)
+            self._carried_peek = None
+        if self._split_position is not None and self.commit_manager is not None:
+            self.commit_manager.release(*self._split_position)
+        self._split_position = None
+
+    def iter_deserialize(self, num_messages=1, timeout=1) -> Iterator[Message]:
+        # The streaming version of poll_and_deserialize. Messages are yielded as each
+        # container is decoded, so at most one container is held in memory at a time.
+        # If the caller stops early, the partitions are rewound to the first Kafka message
+        # that was not completely yielded, so nothing consumed is lost. That message will
+        # be delivered again in full by the next poll. Nothing is consumed before the
+        # first message is asked for. What a budgeted poll carried over is yielded first,
+        # instead of consuming.
+        if self._has_carried():
+            yield from self._iter_carried()
+            return
+        incoming = self.consume(num_messages=num_messages, timeout=timeout)
+        yield from self._iter_messages(incoming)
+
+    def _iter_carried(self) -> Iterator[Message]:
+        # Yields what budgeted polls carried over, in order. A container split by the last
+        # poll is released, as its remaining records follow. If the caller stops early,
+        # the rest stays carried over, and a container split again is held.
+        self._hold_split_container([])
+        last = None
+        try:
+            while True:
+                if self._carried_peek is not None:
+                    msg, self._carried_peek = self._carried_peek, None
+                else:
+                    if self._carried_stream is None:
+                        if not self._carried_incoming:
+                            return
+                        self._carried_stream = self._iter_messages(self._carried_incoming)
+                        self._carried_incoming = []
+                    msg = next(self._carried_stream, _END)
+                    if msg is _END:
+                        self._carried_stream = None
+                        continue
+                last = msg
+                yield msg
+        finally:
+            self._hold_split_container([last] if last is not None else [])
+
+    def _iter_messages(self, incoming) -> Iterator[Message]:
+        contained, duplicates = self._find_duplicates(incoming)
+        fresh = [m for m, duplicate in zip(incoming, duplicates) if not duplicate]
+        if self.config.get('aether_deserialize_workers'):
+            packages = self._deserialize_in_pool(fresh)
+        else:
+            packages = (self._open_value(m.topic(), m.value()) for m in fresh)
+        delivered = 0  # index of the first Kafka message not completely yielded
+        commits = self.commit_manager
+        try:
+            for m, ids, duplicate in zip(incoming, contained, duplicates):
+                if duplicate:
+                    if commits is not None:
+                        commits.track(m.topic(), m.partition(), m.offset(), True)
+                    delivered += 1
+                    continue
+                package_result = next(packages)
+                meta = MessageMeta(
+                    m.key(),
+                    m.offset(),
+                    m.topic(),
+                    m.partition(),
+                    package_result.get('schema'),
+                    m.headers()
+                )
+                LOG.debug(f'{meta.topic} | {meta.offset}')
+                # we read one record ahead, to know the container is done before the
+                # last of its records is handed over.
+                bodies = iter(package_result['messages'])
+                message_body = next(bodies, _END)
+                if commits is not None:
+                    commits.track(meta.topic, meta.partition, meta.offset, message_body is _END)
+                if message_body is _END:
+                    delivered += 1
+                    self._remember_ids(ids)
+                while message_body is not _END:
+                    current = message_body
+                    message_body = next(bodies, _END)
+                    if message_body is _END:
+                        delivered += 1
+                        self._remember_ids(ids)
+                    yield Message.with_meta(current, meta)
+        except GeneratorExit:
+            self._rewind(incoming[delivered:])
+            raise
+
+    def poll_and_deserialize_columnar(self, num_messages=1, timeout=1) -> List[ColumnarBatch]:
+        # Like poll_and_deserialize, but returns one ColumnarBatch per (topic, schema), in the
+        # order they were first seen, instead of one Message per record. Bulk sinks that
+        # load data column by column can then skip the per record objects. The emit
+        # filter is applied to the batch as a boolean mask and masked fields are dropped
+        # as whole columns. Payloads are decoded in this process, even with workers set.
+        # What a budgeted poll carried over is rewound and consumed again, so partitions
+        # keep their order. A container split by that poll is delivered again in full.
+        self._drop_carried()
+        incoming = self.consume(num_messages=num_messages, timeout=timeout)
+        contained, duplicates = self._find_duplicates(incoming)
+        groups: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        for m, duplicate in zip(incoming, duplicates):
+            if duplicate:
+                continue
+            topic = m.topic()
+            package_result = self._open_rows(topic, m.value())
+            rows = package_result['messages']
+            group = groups.get((topic, package_result['fingerprint']))
+            if group is None:
+                group = groups[(topic, package_result['fingerprint'])] = {
+                    'package': package_result,
+                    'rows': [],
+                    'offsets': [],
+                    'partitions': [],
+                    'keys': []
+                }
+            group['rows'].extend(rows)
+            group['offsets'].extend([m.offset()] * len(rows))
+            group['partitions'].extend([m.partition()] * len(rows))
+            group['keys'].extend([m.key()] * len(rows))
+        batches = []
+        for (topic, fingerprint), group in groups.items():
+            package_result = group['package']
+            plan = package_result['mask_plan']
+            batch = ColumnarBatch.from_rows(
+                topic,
+                package_result['schema'],
+                fingerprint,
+                group['rows'],
+                group['offsets'],
+                group['partitions'],
+                group['keys'],
+                exclude=plan.drop if plan else frozenset()
+            )
+            if package_result['filter']:
+                batch = batch.filter(_keep_rows(package_result['filter'], batch, group['rows']))
+            batches.append(batch.mask(plan))
+        for ids, duplicate in zip(contained, duplicates):
+            if not duplicate:
+                self._remember_ids(ids)
+        if self.commit_manager is not None:
+            # Kafka messages without rows left in a batch are handled already
+            kept = {
+                (b.topic, int(p), int(o))
+                for b in batches for p, o in zip(b.partitions, b.offsets)
+            }
+            for m in incoming:
+                position = (m.topic(), m.partition(), m.offset())
+                self.commit_manager.track(*position, position not in kept)
+        return batches
+
+    def _find_duplicates(self, incoming) -> Tuple[List[Any], List[bool]]:
+        # The (topic, ids) listed in the header of each Kafka message, and whether the
+        # ids were all seen in the topic already, in which case the message is not
+        # decoded. A message repeated in the batch, with the same header, is a duplicate
+        # too. Messages without ids, or whose avro_size header is malformed or disagrees
+        # with them, are never duplicates.
+        if self._seen_ids is None:
+            return [None] * len(incoming), [False] * len(incoming)
+        contained, duplicates, batch = [], [], set()
+        for m in incoming:
+            ids = self.get_contained_ids(m)
+            if ids is not None:
+                size = dict(m.headers() or []).get('avro_size')
+                try:
+                    if size is not None and int(size) != len(ids):
+                        ids = None
+                except ValueError:  # a malformed header, the message is decoded
+                    ids = None
+            duplicate = False
+            if ids:
+                key = (m.topic(), ids.value)
+                try:
+                    duplicate = key in batch or self._seen_ids.contains_all(
+                        (m.topic(), _id) for _id in ids)
+                except TypeError:  # unhashable ids, e.g. JSON objects
+                    ids = None
+                batch.add(key)
+            if duplicate:
+                with self._stats_lock:
+                    self._duplicates['containers'] += 1
+                    self._duplicates['documents'] += len(ids)
+                LOG.debug(f'{m.topic()} | {m.offset()} skipped, its ids were all seen')
+            contained.append((m.topic(), ids) if ids else None)
+            duplicates.append(duplicate)
+        return contained, duplicates
+
+    def _remember_ids(self, contained):
+        # the (topic, ids) of a container handed over completely
+        if contained and self._seen_ids is not None:
+            topic, ids = contained
+            self._seen_ids.add_all((topic, _id) for _id in ids)
+
+    def get_dedup_stats(self) -> Dict[str, int]:
+        # the containers skipped as duplicates, and their documents
+        with self._stats_lock:
+            return {
+                'containers': self._duplicates['containers'],
+                'documents': self._duplicates['documents']
+            }
+
+    def _rewind(self, remaining):
+        # seek each partition back to the lowest offset among the remaining messages
+        offsets = {}
+        for m in remaining:
+            tp = (m.topic(), m.partition())
+            if tp not in offsets or m.offset() < offsets[tp]:
+                offsets[tp] = m.offset()
+        for (topic, partition), offset in offsets.items():
+            self._rewind_to(topic, partition, offset)
+
+    def _rewind_to(self, topic, partition, offset):
+        if self.commit_manager is not None:
+            self.commit_manager.rewind(topic, partition, offset)
+        try:
+            self.seek(confluent_kafka.TopicPartition(topic, partition, offset))
+        except confluent_kafka.KafkaException as ker:
+            LOG.error(f'Could not rewind {topic}:{partition} to {offset}: {ker}')
+
+    def _deserialize_in_pool(self, incoming):
+        # Spreads the payloads of a batch over the worker processes. map() hands the
+        # results back in the order of the batch, so partition order is kept.
+        # Workers send each (topic, schema) once; we keep them by fingerprint.
+        pool = self._get_pool()
+        tasks = [(m.topic(), m.value()) for m in incoming]
+        chunk_size = self.config.get('aether_deserialize_chunk_size') or 1
+        results = pool.map(_deserialize_in_worker, tasks, chunksize=chunk_size)
+        for (topic, value), package_result in zip(tasks, results):
+            with self._stats_lock:
+                self._payload_formats[package_result['format']] += 1
+            fingerprint = package_result.get('fingerprint')
+            if package_result.get('schema') is not None:
+                self._pool_schemas[(topic, fingerprint)] = package_result['schema']
+            elif fingerprint:
+                schema = self._pool_schemas.get((topic, fingerprint))
+                if schema is None:
+                    # sent with a result another thread has not read yet, read it here
+                    schema = self._schema_of(topic, value, package_result['format'])
+                package_result['schema'] = schema
+            yield package_result
+
+    def _schema_of(self, topic: str, value: bytes, payload_format: str):
+        # the schema of the records decoded from {value}, after projection
+        _, reader = self._open_reader(value, payload_format)
+        try:
+            return self._prepare_reader(reader, topic)[2]
+        finally:
+            reader.close()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        # Configurations are shipped once, when the workers start. A change of topic
+        # configuration replaces the pool.
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.config.get('aether_deserialize_workers'),
+                    initializer=_init_deserialize_worker,
+                    initargs=(
+                        self.config,
+                        self._topic_filter_configs.items(),
+                        self._topic_mask_configs.items(),
+                        self._topic_projection_configs.items(),
+                        self._custom_registry
+                    )
+                )
+            return self._pool
+
+    def _shutdown_pool(self):
+        if getattr(self, '_pool', None) is None:
+            return
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+            self._pool_schemas = {}
+        if pool is not None:
+            pool.shutdown(wait=True)
+
+    def close(self, *args, **kwargs):
+        self._shutdown_pool()
+        self._drop_carried()
+        if self.commit_manager is not None:
+            self.commit_manager.commit(asynchronous=False)
+        return super(KafkaConsumer, self).close(*args, **kwargs)
+
     def seek_to_beginning(self):
         # We override this method to allow for seeking before any messages have been consumed
         # as poll consumes a message. Since we're going to change offset, we don't care.
@@ -322,3 +1253,493 @@ class KafkaConsumer(confluent_kafka.Consumer):
         for p in partitions:
             p.offset = confluent_kafka.OFFSET_BEGINNING
             super(KafkaConsumer, self).seek(p)
+
+
+class PrefetchBatch(object):
+    # The decoded messages of one consume() call, with what is needed to commit or
+    # rewind the partitions it covers.
+    __slots__ = ('messages', 'size', 'sizes', 'first_offsets', 'next_offsets')
+
+    def __init__(self, incoming, messages: List[Message]):
+        self.messages = messages
+        self.size = 0
+        self.sizes: Dict[Tuple[str, int], int] = {}  # raw payload bytes, by tp
+        self.first_offsets: Dict[Tuple[str, int], int] = {}
+        self.next_offsets: Dict[Tuple[str, int], int] = {}
+        for m in incoming:
+            tp = (m.topic(), m.partition())
+            size = len(m.value() or b'')
+            self.size += size
+            self.sizes[tp] = self.sizes.get(tp, 0) + size
+            if tp not in self.first_offsets:
+                self.first_offsets[tp] = m.offset()
+            self.next_offsets[tp] = max(self.next_offsets.get(tp, 0), m.offset() + 1)
+
+    def drop(self, tps: Set[Tuple[str, int]]) -> int:
+        # drops the messages of the partitions {tps}, returns the bytes freed
+        if not tps.intersection(self.first_offsets):
+            return 0
+        self.messages = [m for m in self.messages if (m.topic, m.partition) not in tps]
+        freed = 0
+        for tp in tps:
+            freed += self.sizes.pop(tp, 0)
+            self.first_offsets.pop(tp, None)
+            self.next_offsets.pop(tp, None)
+        self.size -= freed
+        return freed
+
+
+class PrefetchingConsumer(object):
+    # Wraps a KafkaConsumer with a background thread that keeps consuming and decoding
+    # into a bounded queue of batches, so the next batch is ready while the job handles
+    # the current one. The queue holds at most {queue_depth} batches and, unless it is
+    # empty, at most {max_bytes} of raw payloads.
+    #
+    # Offsets are only committed for batches handed out by poll_and_deserialize, never
+    # for batches still queued. The wrapped consumer should be created with
+    # 'enable.auto.commit': False, or with 'enable.auto.offset.store': False and
+    # store_offsets=True here, as librdkafka otherwise commits whatever was consumed.
+    # After start(), the wrapped consumer belongs to the prefetch thread: only commit
+    # through this class, and subscribe through it, so that revoked partitions commit
+    # what was handed out and drop what is still queued.
+
+    def __init__(
+        self,
+        consumer: KafkaConsumer,
+        num_messages: int = 100,
+        timeout: float = 1,
+        queue_depth: int = 4,
+        max_bytes: int = 64 * 1024 * 1024,
+        store_offsets: bool = False
+    ):
+        if queue_depth < 1:
+            raise ValueError('queue_depth must be at least 1')
+        self.consumer = consumer
+        self.num_messages = num_messages
+        self.timeout = timeout
+        self.queue_depth = queue_depth
+        self.max_bytes = max_bytes
+        self.store_offsets = store_offsets
+        self._queue: Deque[PrefetchBatch] = deque()
+        self._queued_bytes = 0
+        self._lock = Condition()
+        self._delivered: Dict[Tuple[str, int], int] = {}  # next offset to commit, by tp
+        self._error: Exception = None
+        self._stopped = False
+        self._thread: Thread = None
+
+    def start(self) -> 'PrefetchingConsumer':
+        if self._thread is None:
+            self._stopped = False
+            self._thread = Thread(target=self._run, name='aet-prefetch', daemon=True)
+            self._thread.start()
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def subscribe(self, topics: List[str], on_assign=None, on_revoke=None, on_lost=None):
+        # as Consumer.subscribe, the callbacks are called after the queue is updated
+
+        def revoked(consumer, partitions):
+            self._revoke(partitions)
+            if on_revoke:
+                on_revoke(consumer, partitions)
+
+        def lost(consumer, partitions):
+            self._revoke(partitions, lost=True)
+            if on_lost:
+                on_lost(consumer, partitions)
+
+        self.consumer.subscribe(topics, on_assign=on_assign, on_revoke=revoked, on_lost=lost)
+
+    def _revoke(self, partitions, lost=False):
+        # Called from consume() on the prefetch thread. Revoked partitions commit the
+        # offsets handed out, synchronously, before they move on. Lost partitions may
+        # already belong to another consumer, nothing is committed. Either way their
+        # queued batches are dropped, as the next owner consumes them again.
+        tps = {(p.topic, p.partition) for p in partitions}
+        with self._lock:
+            for batch in self._queue:
+                self._queued_bytes -= batch.drop(tps)
+            self._queue = deque(batch for batch in self._queue if batch.first_offsets)
+            self._lock.notify_all()
+        if not lost:
+            self.commit(asynchronous=False, partitions=list(tps))
+        with self._lock:
+            for tp in tps:
+                self._delivered.pop(tp, None)
+
+    def _has_room(self) -> bool:
+        if not self._queue:
+            return True
+        return len(self._queue) < self.queue_depth and self._queued_bytes < self.max_bytes
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopped and not self._has_room():
+                    self._lock.wait()
+                if self._stopped:
+                    return
+            try:
+                incoming = self.consumer.consume(
+                    num_messages=self.num_messages, timeout=self.timeout)
+                if not incoming:
+                    continue
+                batch = PrefetchBatch(incoming, list(self.consumer._iter_messages(incoming)))
+            except Exception as err:
+                LOG.error(f'Prefetch failed: {err}')
+                with self._lock:
+                    self._error = err
+                    self._stopped = True
+                    self._lock.notify_all()
+                return
+            with self._lock:
+                self._queue.append(batch)
+                self._queued_bytes += batch.size
+                self._lock.notify_all()
+
+    def poll_and_deserialize(self, timeout: float = 1) -> List[Message]:
+        # Returns the messages of the next prefetched batch, waiting up to {timeout}
+        # seconds for one. The offsets of the batch become committable.
+        with self._lock:
+            if not self._queue and self._error is None:
+                self._lock.wait_for(lambda: self._queue or self._error, timeout=timeout)
+            if not self._queue:
+                if self._error is not None:
+                    err, self._error = self._error, None
+                    raise err
+                return []
+            batch = self._queue.popleft()
+            self._queued_bytes -= batch.size
+            self._delivered.update(batch.next_offsets)
+            self._lock.notify_all()
+        if self.store_offsets:
+            self.consumer.store_offsets(offsets=_topic_partitions(batch.next_offsets))
+        return batch.messages
+
+    def commit(self, asynchronous: bool = True, partitions: List[Tuple[str, int]] = None):
+        # commits the offsets of the batches handed out so far, of all partitions or of
+        # {partitions}
+        with self._lock:
+            if partitions is None:
+                offsets, self._delivered = self._delivered, {}
+            else:
+                offsets = {
+                    tp: self._delivered.pop(tp) for tp in partitions if tp in self._delivered
+                }
+        if not offsets:
+            return None
+        return self.consumer.commit(
+            offsets=_topic_partitions(offsets), asynchronous=asynchronous)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'batches': len(self._queue), 'bytes': self._queued_bytes}
+
+    def stop(self):
+        # Stops the prefetch thread and drops the queued batches, rewinding their
+        # partitions so the next poll of the consumer delivers them again.
+        with self._lock:
+            self._stopped = True
+            self._lock.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            first_offsets: Dict[Tuple[str, int], int] = {}
+            for batch in self._queue:
+                for tp, offset in batch.first_offsets.items():
+                    first_offsets.setdefault(tp, offset)
+            self._queue.clear()
+            self._queued_bytes = 0
+        for (topic, partition), offset in first_offsets.items():
+            self.consumer._rewind_to(topic, partition, offset)
+
+    def close(self):
+        # commits what was handed out, then closes the wrapped consumer
+        self.stop()
+        self.commit(asynchronous=False)
+        self.consumer.close()
+
+
+class _PartitionWorker(object):
+    # A thread that decodes and handles the chunks of the partitions mapped to it, one
+    # at a time in the order they were submitted. See PartitionedConsumer.
+
+    def __init__(self, owner: 'PartitionedConsumer', name: str, max_queued: int):
+        self.owner = owner
+        self.partitions: Set[Tuple[str, int]] = set()
+        self.queue: Queue = Queue(maxsize=max_queued)
+        self.thread = Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.owner._handle_chunk(*item)
+            finally:
+                self.queue.task_done()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class PartitionedConsumer(object):
+    # Decodes and handles the messages of each assigned partition on a worker thread,
+    # so partitions make progress in parallel while each keeps its order. The calling
+    # thread only consumes and hands each partition's part of a batch to its worker,
+    # which decodes it and calls handler(messages).
+    #
+    # With max_workers=None every partition gets a worker of its own; otherwise the
+    # partitions share at most {max_workers} workers, each partition staying on one.
+    # Workers are started when partitions are assigned and stopped when their last
+    # partition is revoked. A worker holds at most {max_queued} chunks; when it is
+    # behind, poll() waits for it.
+    #
+    # Offsets are committed for handled messages only: by commit(), and synchronously
+    # for revoked partitions once their queued chunks are handled. If the handler
+    # fails, the rest of that partition is dropped, the partition is rewound to the
+    # failed chunk and the next poll() raises the error.
+
+    def __init__(
+        self,
+        consumer: KafkaConsumer,
+        handler: Callable[[List[Message]], Any],
+        max_workers: int = None,
+        num_messages: int = 100,
+        timeout: float = 1,
+        max_queued: int = 4
+    ):
+        if max_workers is not None and max_workers < 1:
+            raise ValueError('max_workers must be at least 1')
+        self.consumer = consumer
+        self.handler = handler
+        self.max_workers = max_workers
+        self.num_messages = num_messages
+        self.timeout = timeout
+        self.max_queued = max_queued
+        self._workers: Dict[Tuple[str, int], _PartitionWorker] = {}
+        self._worker_count = 0
+        self._lock = Lock()
+        # bumped when a partition is rewound or lost, older chunks are dropped
+        self._epochs: Dict[Tuple[str, int], int] = {}
+        self._handled: Dict[Tuple[str, int], int] = {}  # next offset to commit, by tp
+        self._failures: Dict[Tuple[str, int], Tuple[int, Exception]] = {}
+
+    def subscribe(self, topics: List[str], on_assign=None, on_revoke=None, on_lost=None):
+        # as Consumer.subscribe, the callbacks are called after the workers are updated
+
+        def assigned(consumer, partitions):
+            self._assign(partitions)
+            if on_assign:
+                on_assign(consumer, partitions)
+
+        def revoked(consumer, partitions):
+            self._revoke(partitions)
+            if on_revoke:
+                on_revoke(consumer, partitions)
+
+        def lost(consumer, partitions):
+            self._revoke(partitions, lost=True)
+            if on_lost:
+                on_lost(consumer, partitions)
+
+        self.consumer.subscribe(topics, on_assign=assigned, on_revoke=revoked, on_lost=lost)
+
+    def _assign(self, partitions):
+        for p in partitions:
+            tp = (p.topic, p.partition)
+            if tp in self._workers:
+                continue
+            live = set(self._workers.values())
+            if self.max_workers is None or len(live) < self.max_workers:
+                self._worker_count += 1
+                worker = _PartitionWorker(
+                    self, f'aet-partition-{self._worker_count}', self.max_queued)
+            else:
+                worker = min(live, key=lambda w: len(w.partitions))
+            worker.partitions.add(tp)
+            self._workers[tp] = worker
+            with self._lock:
+                self._epochs.setdefault(tp, 0)
+
+    def _revoke(self, partitions, lost=False):
+        # Revoked partitions finish their queued chunks and commit them before they move
+        # on. Lost partitions may already belong to another consumer: their queued
+        # chunks are dropped and nothing is committed.
+        tps = [(p.topic, p.partition) for p in partitions]
+        tps = [tp for tp in tps if tp in self._workers]
+        if lost:
+            with self._lock:
+                for tp in tps:
+                    self._epochs[tp] += 1
+        for worker in {self._workers[tp] for tp in tps}:
+            worker.queue.join()
+        if not lost:
+            self.commit(asynchronous=False, partitions=tps)
+        with self._lock:
+            for tp in tps:
+                self._handled.pop(tp, None)
+                self._failures.pop(tp, None)
+        for tp in tps:
+            worker = self._workers.pop(tp)
+            worker.partitions.discard(tp)
+            if not worker.partitions:
+                worker.stop()
+
+    def poll(self) -> int:
+        # Consumes a batch and hands it to the workers, returns the number of Kafka
+        # messages consumed. Raises the error of a failed handler, once.
+        self._raise_failures()
+        incoming = self.consumer.consume(num_messages=self.num_messages, timeout=self.timeout)
+        chunks: Dict[Tuple[str, int], List[Any]] = {}
+        for m in incoming:
+            chunks.setdefault((m.topic(), m.partition()), []).append(m)
+        for tp, chunk in chunks.items():
+            if tp not in self._workers:  # i.e. partitions set with assign()
+                self._assign([confluent_kafka.TopicPartition(*tp)])
+            with self._lock:
+                epoch = self._epochs[tp]
+            self._workers[tp].queue.put((tp, epoch, chunk))
+        return len(incoming)
+
+    def _handle_chunk(self, tp, epoch, chunk):
+        # runs on the worker of partition {tp}
+        with self._lock:
+            if self._epochs.get(tp) != epoch or tp in self._failures:
+                return
+        try:
+            self.handler(list(self.consumer._iter_messages(chunk)))
+        except Exception as err:
+            LOG.error(f'Could not handle {tp[0]}:{tp[1]} from {chunk[0].offset()}: {err}')
+            with self._lock:
+                self._failures[tp] = (chunk[0].offset(), err)
+            return
+        with self._lock:
+            if self._epochs.get(tp) == epoch:
+                self._handled[tp] = chunk[-1].offset() + 1
+
+    def _raise_failures(self):
+        with self._lock:
+            failures, self._failures = self._failures, {}
+            for tp in failures:
+                self._epochs[tp] += 1
+        for (topic, partition), (offset, _) in failures.items():
+            self.consumer._rewind_to(topic, partition, offset)
+        if failures:
+            raise next(iter(failures.values()))[1]
+
+    def flush(self):
+        # waits for the workers to handle everything submitted so far
+        for worker in set(self._workers.values()):
+            worker.queue.join()
+
+    def handled_offsets(self) -> Dict[Tuple[str, int], int]:
+        # the next offset of each partition, for the messages handled and not committed
+        with self._lock:
+            return dict(self._handled)
+
+    def commit(self, asynchronous: bool = True, partitions: List[Tuple[str, int]] = None):
+        # commits the handled offsets of all partitions, or of {partitions}
+        with self._lock:
+            if partitions is None:
+                offsets, self._handled = self._handled, {}
+            else:
+                offsets = {tp: self._handled.pop(tp) for tp in partitions if tp in self._handled}
+        if not offsets:
+            return None
+        return self.consumer.commit(offsets=_topic_partitions(offsets), asynchronous=asynchronous)
+
+    def stats(self) -> Dict[str, int]:
+        workers = set(self._workers.values())
+        return {
+            'workers': len(workers),
+            'partitions': len(self._workers),
+            'queued': sum(w.queue.qsize() for w in workers)
+        }
+
+    def stop(self):
+        # handles what was submitted, stops the workers and commits
+        self.flush()
+        for worker in set(self._workers.values()):
+            worker.stop()
+        self._workers = {}
+        self.commit(asynchronous=False)
+
+    def close(self):
+        self.stop()
+        self.consumer.close()
+
+
+def _keep_rows(approval_filter, batch: ColumnarBatch, rows: List[Any]):
+    # Records decoded with a schema hold every field, so a filter on a top level field
+    # checks its column, a NumPy array for numeric fields. Otherwise rows are checked.
+    field = getattr(approval_filter, 'field', None)
+    if field is not None and field in batch.columns and (batch.schema or {}).get('fields'):
+        return approval_filter.check_values(batch.columns[field])
+    keep = getattr(approval_filter, 'keep', None)
+    return keep(rows) if keep is not None else list(map(approval_filter, rows))
+
+
+def _topic_partitions(offsets: Dict[Tuple[str, int], int]) -> List[confluent_kafka.TopicPartition]:
+    return [
+        confluent_kafka.TopicPartition(topic, partition, offset)
+        for (topic, partition), offset in offsets.items()
+    ]
+
+
+def _dedup_store(config):
+    # the set of recently seen ids of a KafkaConsumer, None without deduplication
+    window = config.get('aether_dedup_window')
+    if not window:
+        return None
+    store = config.get('aether_dedup_store') or 'bloom'
+    if store == 'lru':
+        return LRUIdSet(window)
+    if store == 'bloom':
+        return RotatingBloomFilter(window, config.get('aether_dedup_false_positive_rate'))
+    raise ValueError(f'Unknown aether_dedup_store {store}, expected bloom or lru')
+
+
+# Process pool workers, see KafkaConsumer._deserialize_in_pool
+
+_worker_deserializer: MessageDeserializer = None
+_worker_sent_schemas: set = set()
+
+
+def _init_deserialize_worker(
+    config, filter_configs, mask_configs, projection_configs, registry=None
+):
+    global _worker_deserializer, _worker_sent_schemas
+    _worker_deserializer = MessageDeserializer(config)
+    if registry is not None:  # set with set_schema_registry, instead of the configured url
+        _worker_deserializer.set_schema_registry(registry)
+    # each a list of (topic or pattern, config), in the order they were set
+    for topic, filter_config in filter_configs:
+        _worker_deserializer.set_topic_filter_config(topic, filter_config)
+    for topic, mask_config in mask_configs:
+        _worker_deserializer.set_topic_mask_config(topic, mask_config)
+    for topic, projection_config in projection_configs:
+        _worker_deserializer.set_topic_projection_config(topic, projection_config)
+    _worker_sent_schemas = set()
+
+
+def _deserialize_in_worker(task):
+    topic, value = task
+    package_result = _worker_deserializer.deserialize_value(topic, value)
+    fingerprint = package_result.get('fingerprint')
+    if fingerprint:
+        if (topic, fingerprint) in _worker_sent_schemas:
+            package_result['schema'] = None
+        else:
+            _worker_sent_schemas.add((topic, fingerprint))
+    return package_result
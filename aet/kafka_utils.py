@@ -17,18 +17,29 @@
 # under the License.
 
 import concurrent
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from inspect import Parameter, signature
 import io
 import json
+from math import ceil
+import os
 import socket
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Tuple
 
 from confluent_kafka import Producer
 from confluent_kafka.admin import AdminClient, NewTopic
 
-from spavro.datafile import DataFileWriter, DataFileReader
-from spavro.io import DatumWriter, DatumReader
-from spavro.io import validate
+from spavro.io import DatumWriter
+from spavro.schema import parse as parse_schema
 
+from .avro_utils import ContainerWriter, get_validator
+from .helpers import chunk_iterable
+from .id_headers import ID_HEADER, decode_ids, encode_ids, encoded_id_size
 from .logger import get_logger
+from .schema_registry import encode_wire_format
 
 LOG = get_logger('KafkaUtils')
 
@@ -131,45 +142,543 @@ def delete_topic(kadmin, topic_name):
             return False
 
 
-def kafka_callback(err=None, msg=None, _=None, **kwargs):
-    if err:
-        LOG.debug('ERROR %s', [err, msg, kwargs])
-    with io.BytesIO() as obj:
-        obj.write(msg.value())
-        reader = DataFileReader(obj, DatumReader())
-        for message in reader:
-            _id = message.get('id')
-            if err:
-                LOG.error(f'NO-SAVE: {_id} in | err {err.name()}')
+def kafka_callback(err=None, msg=None, context=None, **kwargs):
+    # Logs the ids of the documents of a message that could not be delivered. They come
+    # from its DeliveryContext, or from its contains_id header, never from the payload.
+    if not err:
+        return
+    LOG.debug('ERROR %s', [err, msg, kwargs])
+    if context is not None:
+        ids = context.ids
+    else:
+        ids = decode_ids(dict(msg.headers() or []).get(ID_HEADER))
+    for _id in ids:
+        LOG.error(f'NO-SAVE: {_id} in | err {err.name()}')
 
 
-def produce(docs, schema, topic_name, producer, callback=None):
+class DeliveryContext(object):
+    # what the delivery callback needs to know about a produced message, kept aside so
+    # it does not have to decode the payload
+    __slots__ = ('topic', 'ids', 'count', 'size', 'sent')
+
+    def __init__(self, topic: str, ids: List[Any], size: int):
+        self.topic = topic
+        self.ids = ids
+        self.count = len(ids)
+        self.size = size
+        self.sent = monotonic()
+
+
+class DeliveryStats(object):
+    # Delivery outcomes per topic: delivered and failed messages, their documents and
+    # bytes, and the latency from produce to delivery. Latency percentiles are taken
+    # over the last {window} deliveries of each topic.
+
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self._lock = Lock()
+        self._topics: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, context: DeliveryContext, failed: bool = False):
+        latency = monotonic() - context.sent
+        with self._lock:
+            topic = self._topics.get(context.topic)
+            if topic is None:
+                topic = self._topics[context.topic] = {
+                    'successes': 0,
+                    'failures': 0,
+                    'documents': 0,
+                    'failed_documents': 0,
+                    'bytes': 0,
+                    'latencies': deque(maxlen=self.window)
+                }
+            if failed:
+                topic['failures'] += 1
+                topic['failed_documents'] += context.count
+            else:
+                topic['successes'] += 1
+                topic['documents'] += context.count
+                topic['bytes'] += context.size
+            topic['latencies'].append(latency)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        # topic -> counts, and latency percentiles in milliseconds as latency_ms
+        with self._lock:
+            topics = {
+                name: {**topic, 'latencies': sorted(topic['latencies'])}
+                for name, topic in self._topics.items()
+            }
+        for topic in topics.values():
+            latencies = topic.pop('latencies')
+            topic['latency_ms'] = {
+                f'p{p}': _percentile(latencies, p) * 1000 if latencies else None
+                for p in self.PERCENTILES
+            }
+        return topics
+
+    def reset(self):
+        with self._lock:
+            self._topics.clear()
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    # nearest rank, of sorted values
+    return values[max(ceil(len(values) * percentile / 100) - 1, 0)]
+
+
+# the delivery statistics of produce and BatchingProducer, unless they are given others
+DELIVERY_STATS = DeliveryStats()
+
+# produce keeps its messages under the default message.max.bytes of Kafka brokers
+PRODUCE_MAX_BYTES = 1000000
+# the avro_size and contains_id headers, without the ids
+_HEADERS_OVERHEAD = 32
+
+
+def get_delivery_stats() -> Dict[str, Dict[str, Any]]:
+    return DELIVERY_STATS.stats()
+
+
+def delivery_callback(
+    callback: Callable,
+    context: DeliveryContext,
+    stats: DeliveryStats = None,
+    takes_context: bool = None
+) -> Callable:
+    # The on delivery callback of one message for Producer.produce. It records the
+    # outcome in {stats} and calls {callback} with {context} as third argument, when
+    # it takes one (as kafka_callback does), or with (err, msg) only. Callers sending
+    # many messages pass {takes_context}, see _takes_context, to inspect it once.
+    if takes_context is None:
+        takes_context = _takes_context(callback)
+    if takes_context:
+        def on_delivery(err, msg):
+            if stats is not None:
+                stats.record(context, err is not None)
+            callback(err, msg, context)
+    else:
+        def on_delivery(err, msg):
+            if stats is not None:
+                stats.record(context, err is not None)
+            callback(err, msg)
+    return on_delivery
+
+
+def _takes_context(callback: Callable) -> bool:
+    # whether {callback} takes a third argument, inspected once per produce call
+    try:
+        params = signature(callback).parameters.values()
+    except (TypeError, ValueError):  # some builtins have no signature
+        return False
+    if any(p.kind == Parameter.VAR_POSITIONAL for p in params):
+        return True
+    positional = (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)
+    return len([p for p in params if p.kind in positional]) >= 3
+
+
+def produce(
+    docs, schema, topic_name, producer, callback=None, registry=None, subject=None,
+    trusted=False, delivery_stats=DELIVERY_STATS, max_bytes=PRODUCE_MAX_BYTES,
+    max_docs=None, id_format='json'
+):
+    # Sends {docs} as Avro containers, a new one (and Kafka message) whenever the next
+    # document would take the current one, with its headers, over {max_bytes} or
+    # {max_docs}. With a schema {registry}, each document is sent as its own Kafka
+    # message in the registry wire format instead, which saves the schema in every
+    # payload. The schema is registered under {subject}, by default {topic_name}-value.
+    # Documents that do not validate against {schema} are left out, unless the caller
+    # vouches for them with {trusted}. Deliveries are counted in {delivery_stats}, the
+    # callback gets the DeliveryContext of the message. The ids of the documents are
+    # listed in the contains_id header, in {id_format} (see id_headers).
     if not callback:
         callback = kafka_callback
-    with io.BytesIO() as bytes_writer:
-        writer = DataFileWriter(
-            bytes_writer, DatumWriter(), schema, codec='deflate')
-        _ids = []
-        for row in docs:
+    validate = _validator(schema, trusted)
+    if registry is not None:
+        return _produce_wire_format(
+            docs, schema, topic_name, producer, callback, registry, subject, validate,
+            delivery_stats, id_format)
+    containers = _split_containers(
+        docs, schema, topic_name, validate, max_bytes, max_docs, id_format)
+    _send_encoded(producer, topic_name, callback, delivery_stats, [containers], id_format)
+
+
+def _split_containers(
+    docs, schema, topic_name, validate, max_bytes=None, max_docs=None, id_format='json'
+):
+    # Yields (container, ids) for {docs}, cut by count with chunk_iterable, then by
+    # compressed size, checked before each document with the average encoded document
+    # as its size. A single document over {max_bytes} still gets a container. Ids of
+    # invalid documents are kept, as the headers always did.
+    datum_writer = DatumWriter(schema)
+    for chunk in (chunk_iterable(docs, max_docs) if max_docs else [docs]):
+        buffer = io.BytesIO()
+        writer = ContainerWriter(buffer, datum_writer, schema)
+        _ids, headers_size, appended = [], _HEADERS_OVERHEAD, 0
+        for row in chunk:
             _id = row['id']
+            id_size = encoded_id_size(_id, id_format)
+            if max_bytes and appended and _over_limit(
+                writer,
+                (writer.raw_bytes + writer.buffer_writer.tell()) // appended,
+                headers_size + id_size,
+                max_bytes
+            ):
+                yield _close_container(buffer, writer), _ids
+                buffer = io.BytesIO()
+                writer = ContainerWriter(buffer, datum_writer, schema)
+                _ids, headers_size, appended = [], _HEADERS_OVERHEAD, 0
             _ids.append(_id)
-            msg = row
-            if validate(schema, msg):
-                writer.append(msg)
+            headers_size += id_size
+            if validate(row):
+                writer.append(row)
+                appended += 1
             else:
                 # Message doesn't have the proper format for the current schema.
                 LOG.debug(
                     f'SCHEMA_MISMATCH:NOT SAVED! TOPIC:{topic_name}, ID:{_id}')
-        writer.flush()
-        raw_bytes = bytes_writer.getvalue()
+        yield _close_container(buffer, writer), _ids
+
+
+def _over_limit(writer: ContainerWriter, next_size: int, headers_size: int, max_bytes: int) -> bool:
+    # Whether the next document, of about {next_size} encoded bytes, could take the
+    # container over {max_bytes}. The pending block is compressed when it might not
+    # fit, so only the next document is left to estimate, uncompressed.
+    if writer.estimated_size(next_size) + headers_size <= max_bytes:
+        return False
+    if writer.block_count:
+        writer.flush()  # compresses the pending block, its size is known from now on
+    return writer.estimated_size(next_size) + headers_size > max_bytes
+
 
+def _close_container(buffer, writer) -> bytes:
+    writer.flush()
+    return buffer.getvalue()
+
+
+def _send_container(producer, topic_name, raw_bytes, ids, callback, id_format='json'):
+    headers = {
+        'avro_size': str(len(ids)),
+        ID_HEADER: encode_ids(ids, id_format)
+    }
+    while True:
+        try:
+            producer.produce(topic_name, raw_bytes, callback=callback, headers=headers)
+            return
+        except BufferError:  # the local queue is full, wait for deliveries
+            producer.poll(0.1)
+
+
+def _validator(schema, trusted):
+    # the compiled validator of {schema}, or one accepting anything for trusted input
+    if trusted:
+        return _trust
+    return get_validator(schema)
+
+
+def _trust(datum) -> bool:
+    return True
+
+
+def _produce_wire_format(
+    docs, schema, topic_name, producer, callback, registry, subject, validate, delivery_stats,
+    id_format
+):
+    schema_id = registry.register(subject or f'{topic_name}-value', json.dumps(schema.to_json()))
+    datum_writer = DatumWriter(schema)
+    takes_context = _takes_context(callback)
     producer.poll(0)
-    producer.produce(
-        topic_name,
-        raw_bytes,
-        callback=callback,
-        headers={
-            'avro_size': str(len(_ids)),
-            'contains_id': json.dumps(_ids)
-        }
+    for row in docs:
+        _id = row['id']
+        if not validate(row):
+            # Message doesn't have the proper format for the current schema.
+            LOG.debug(f'SCHEMA_MISMATCH:NOT SAVED! TOPIC:{topic_name}, ID:{_id}')
+            continue
+        payload = encode_wire_format(schema_id, row, datum_writer)
+        context = DeliveryContext(topic_name, [_id], len(payload))
+        producer.produce(
+            topic_name,
+            payload,
+            callback=delivery_callback(callback, context, delivery_stats, takes_context),
+            headers={
+                'avro_size': '1',
+                ID_HEADER: encode_ids([_id], id_format)
+            }
+        )
+
+
+def produce_bulk(
+    docs, schema, topic_name, producer, callback=None, trusted=False,
+    delivery_stats=DELIVERY_STATS, max_bytes=PRODUCE_MAX_BYTES, max_docs=None,
+    workers: int = None, chunk_size: int = 10000, max_in_flight: int = None,
+    id_format: str = 'json'
+) -> int:
+    # Produces {docs} as produce does, for backfills: chunks of {chunk_size} documents
+    # are validated, encoded and compressed in a pool of {workers} processes (one per
+    # CPU by default), while this thread hands the finished containers to {producer}.
+    # Containers are sent in the order of {docs}, as the chunks are sent in the order
+    # they were taken, and do not span chunks. At most {max_in_flight} chunks (two per
+    # worker by default) are encoding or waiting to be sent, which bounds memory.
+    # workers=0 encodes on this thread. Returns the number of messages sent.
+    if not callback:
+        callback = kafka_callback
+    chunks = chunk_iterable(docs, chunk_size)
+    if workers == 0:
+        validate = _validator(schema, trusted)
+        return _send_encoded(
+            producer, topic_name, callback, delivery_stats,
+            (
+                _split_containers(
+                    chunk, schema, topic_name, validate, max_bytes, max_docs, id_format)
+                for chunk in chunks
+            ),
+            id_format
+        )
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_encode_worker,
+        initargs=(str(schema), topic_name, trusted, max_bytes, max_docs, id_format)
     )
+    try:
+        return _send_encoded(
+            producer, topic_name, callback, delivery_stats,
+            _bounded_map(pool, _encode_in_worker, chunks, max_in_flight or 2 * workers),
+            id_format
+        )
+    finally:
+        pool.shutdown(wait=True)
+
+
+def _bounded_map(pool, fn, items, limit):
+    # pool.map, in order, with no more than {limit} items submitted and not yet taken
+    futures = deque()
+    try:
+        for item in items:
+            if len(futures) >= limit:
+                yield futures.popleft().result()
+            futures.append(pool.submit(fn, item))
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _send_encoded(producer, topic_name, callback, delivery_stats, encoded, id_format) -> int:
+    # sends the containers of each chunk in {encoded}, (container, ids) each
+    takes_context = _takes_context(callback)
+    sent = 0
+    for containers in encoded:
+        producer.poll(0)
+        for raw_bytes, _ids in containers:
+            context = DeliveryContext(topic_name, _ids, len(raw_bytes))
+            _send_container(
+                producer,
+                topic_name,
+                raw_bytes,
+                _ids,
+                delivery_callback(callback, context, delivery_stats, takes_context),
+                id_format
+            )
+            sent += 1
+    return sent
+
+
+# Process pool workers, see produce_bulk
+
+_worker_encoder: tuple = None
+
+
+def _init_encode_worker(schema, topic_name, trusted, max_bytes, max_docs, id_format):
+    global _worker_encoder
+    schema = parse_schema(schema)
+    _worker_encoder = (
+        schema, topic_name, _validator(schema, trusted), max_bytes, max_docs, id_format)
+
+
+def _encode_in_worker(chunk) -> List[Tuple[bytes, List[Any]]]:
+    return list(_split_containers(chunk, *_worker_encoder))
+
+
+class _PendingContainer(object):
+    # the documents of a topic encoded so far, and their ids
+    __slots__ = ('schema', 'buffer', 'writer', 'ids', 'started')
+
+    def __init__(self, schema, datum_writer, codec, compression_level):
+        self.schema = schema
+        self.buffer = io.BytesIO()
+        self.writer = ContainerWriter(
+            self.buffer, datum_writer, schema, codec, compression_level)
+        self.ids: List[Any] = []
+        self.started = monotonic()
+
+    def append(self, doc):
+        self.writer.append(doc)
+        self.ids.append(doc['id'])
+
+    def close(self) -> bytes:
+        self.writer.flush()
+        return self.buffer.getvalue()
+
+
+class BatchingProducer(object):
+    # Accumulates documents per topic and sends them as one Avro container, as produce
+    # does, once {max_docs} documents or {max_bytes} of encoded data are pending, or
+    # {linger_ms} passed since the first of them. Documents are encoded as they are
+    # added, with a datum writer kept per topic. A background thread sends containers
+    # that lingered long enough; without it (background=False) they wait for the next
+    # produce or flush. Send order is kept per topic. Usable from several threads.
+    # Deliveries are counted in {delivery_stats}, as those of produce.
+
+    def __init__(
+        self,
+        producer,
+        max_docs: int = 1000,
+        max_bytes: int = 1 << 20,
+        linger_ms: int = 100,
+        codec: str = 'deflate',
+        compression_level: int = None,
+        callback=None,
+        background: bool = True,
+        delivery_stats: DeliveryStats = DELIVERY_STATS,
+        id_format: str = 'json'
+    ):
+        self.producer = producer
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.linger_ms = linger_ms
+        self.codec = codec
+        self.compression_level = compression_level
+        self.callback = callback or kafka_callback
+        self._takes_context = _takes_context(self.callback)
+        self.delivery_stats = delivery_stats
+        self.id_format = id_format
+        self._pending: Dict[str, _PendingContainer] = {}
+        self._datum_writers: Dict[str, Any] = {}  # topic -> (schema, DatumWriter)
+        self._lock = Condition()
+        self._closed = False
+        self.containers = 0
+        self.documents = 0
+        self._thread = None
+        if background:
+            self._thread = Thread(target=self._run, name='BatchingProducer', daemon=True)
+            self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def produce(
+        self,
+        docs: Iterable[Dict[str, Any]],
+        schema,
+        topic_name: str,
+        trusted: bool = False
+    ):
+        # Adds {docs}, which must validate against {schema}, to the pending container of
+        # {topic_name}. A new schema for the topic sends what was pending first.
+        # {trusted} documents are not validated.
+        validate = _validator(schema, trusted)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError('BatchingProducer is closed')
+            pending = self._pending.get(topic_name)
+            if pending is not None and not _same_schema(pending.schema, schema):
+                self._send(topic_name)
+                pending = None
+            for doc in docs:
+                if not validate(doc):
+                    # Message doesn't have the proper format for the current schema.
+                    LOG.debug(f'SCHEMA_MISMATCH:NOT SAVED! TOPIC:{topic_name}, ID:{doc.get("id")}')
+                    continue
+                if pending is None:
+                    pending = self._pending[topic_name] = _PendingContainer(
+                        schema,
+                        self._datum_writer(topic_name, schema),
+                        self.codec,
+                        self.compression_level
+                    )
+                    self._lock.notify()  # a new linger deadline
+                pending.append(doc)
+                if len(pending.ids) >= self.max_docs or pending.writer.size >= self.max_bytes:
+                    self._send(topic_name)
+                    pending = None
+            self._send_lingering()
+
+    def _datum_writer(self, topic_name, schema) -> DatumWriter:
+        # spavro prepares a writer for the schema, kept while the topic keeps its schema
+        cached = self._datum_writers.get(topic_name)
+        if cached is None or not _same_schema(cached[0], schema):
+            cached = self._datum_writers[topic_name] = (schema, DatumWriter(schema))
+        return cached[1]
+
+    def _send(self, topic_name):
+        # with the lock held, so containers of a topic are sent in order
+        pending = self._pending.pop(topic_name)
+        raw_bytes = pending.close()
+        callback = delivery_callback(
+            self.callback,
+            DeliveryContext(topic_name, pending.ids, len(raw_bytes)),
+            self.delivery_stats,
+            self._takes_context
+        )
+        self.producer.poll(0)
+        _send_container(
+            self.producer, topic_name, raw_bytes, pending.ids, callback, self.id_format)
+        self.containers += 1
+        self.documents += len(pending.ids)
+
+    def _send_lingering(self) -> float:
+        # sends the containers pending for linger_ms, returns the seconds until the
+        # next one is due, None if nothing is pending
+        now = monotonic()
+        linger = self.linger_ms / 1000
+        for topic_name in [t for t, p in self._pending.items() if now - p.started >= linger]:
+            self._send(topic_name)
+        if not self._pending:
+            return None
+        return max(min(p.started for p in self._pending.values()) + linger - now, 0)
+
+    def _run(self):
+        with self._lock:
+            while not self._closed:
+                self._lock.wait(self._send_lingering())
+
+    def flush(self, timeout: float = None) -> int:
+        # sends every pending container, then waits for their delivery like
+        # Producer.flush. Returns the number of messages still in the queue.
+        with self._lock:
+            for topic_name in list(self._pending):
+                self._send(topic_name)
+        if timeout is None:
+            return self.producer.flush()
+        return self.producer.flush(timeout)
+
+    def pending(self) -> int:
+        # documents added but not sent yet
+        with self._lock:
+            return sum(len(p.ids) for p in self._pending.values())
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'containers': self.containers,
+            'documents': self.documents,
+            'pending': self.pending()
+        }
+
+    def close(self, timeout: float = None) -> int:
+        # stops the background thread, then flushes. Returns what flush returns.
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        if self._thread is not None:
+            self._thread.join()
+        return self.flush(timeout)
+
+
+def _same_schema(a, b) -> bool:
+    return a is b or str(a) == str(b)
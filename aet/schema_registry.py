@@ -0,0 +1,233 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Confluent Schema Registry wire format: a 0 byte, the id of the writer schema as a
+# 4 byte big endian integer, then a single Avro encoded datum. The schema itself is
+# looked up by id in a registry, and cached, as ids never change their schema.
+
+from abc import ABCMeta, abstractmethod
+import io
+import json
+import os
+from struct import Struct
+from threading import Lock
+from typing import (
+    Any,
+    Dict
+)
+
+import requests
+from spavro.io import BinaryEncoder, DatumWriter
+
+from .exceptions import SchemaRegistryException
+from .helpers import LRUCache
+from .logger import get_logger
+
+LOG = get_logger('Registry')
+
+WIRE_MAGIC = b'\x00'
+_SCHEMA_ID = Struct('>I')
+WIRE_HEADER_SIZE = 1 + _SCHEMA_ID.size
+
+
+def read_schema_id(value: bytes) -> int:
+    # the schema id of a wire format payload, its datum starts at WIRE_HEADER_SIZE
+    if len(value) < WIRE_HEADER_SIZE or value[:1] != WIRE_MAGIC:
+        raise SchemaRegistryException('Not a Schema Registry wire format payload')
+    return _SCHEMA_ID.unpack_from(value, 1)[0]
+
+
+def wire_format_header(schema_id: int) -> bytes:
+    return WIRE_MAGIC + _SCHEMA_ID.pack(schema_id)
+
+
+def encode_wire_format(schema_id: int, datum: Any, datum_writer: DatumWriter) -> bytes:
+    # {datum_writer} has its writers_schema set to the schema registered as {schema_id}
+    buf = io.BytesIO()
+    buf.write(wire_format_header(schema_id))
+    datum_writer.write(datum, BinaryEncoder(buf))
+    return buf.getvalue()
+
+
+def canonical_schema(schema: Any) -> str:
+    # schemas are compared and stored as compact JSON with sorted keys
+    if isinstance(schema, (str, bytes)):
+        schema = json.loads(schema)
+    return json.dumps(schema, sort_keys=True, separators=(',', ':'))
+
+
+class SchemaRegistry(metaclass=ABCMeta):
+    # The interface of a registry client. Schemas are exchanged as JSON strings.
+
+    @abstractmethod
+    def get_schema(self, schema_id: int) -> str:
+        pass
+
+    @abstractmethod
+    def register(self, subject: str, schema: str) -> int:
+        # returns the id of {schema}, registering it under {subject} if needed
+        pass
+
+
+class HTTPSchemaRegistry(SchemaRegistry):
+    # A client of the Confluent Schema Registry REST API
+
+    CONTENT_TYPE = 'application/vnd.schemaregistry.v1+json'
+
+    def __init__(self, url: str, session: requests.Session = None, timeout: float = 10):
+        self.url = url.rstrip('/')
+        self.session = session or requests.Session()
+        self.timeout = timeout
+
+    def get_schema(self, schema_id: int) -> str:
+        res = self.session.get(f'{self.url}/schemas/ids/{schema_id}', timeout=self.timeout)
+        if res.status_code != 200:
+            raise SchemaRegistryException(
+                f'Could not get schema {schema_id}: {res.status_code} {res.text}')
+        return res.json()['schema']
+
+    def register(self, subject: str, schema: str) -> int:
+        res = self.session.post(
+            f'{self.url}/subjects/{subject}/versions',
+            data=json.dumps({'schema': canonical_schema(schema)}),
+            headers={'Content-Type': self.CONTENT_TYPE},
+            timeout=self.timeout
+        )
+        if res.status_code != 200:
+            raise SchemaRegistryException(
+                f'Could not register schema for {subject}: {res.status_code} {res.text}')
+        return res.json()['id']
+
+
+class FileSchemaRegistry(SchemaRegistry):
+    # A stand-in registry kept in a directory, for tests and local development.
+    # Each schema is stored as {id}.avsc, subjects.json maps subjects to their ids.
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _schema_path(self, schema_id: int) -> str:
+        return os.path.join(self.path, f'{schema_id}.avsc')
+
+    def _ids(self):
+        return sorted(
+            int(name[:-5]) for name in os.listdir(self.path)
+            if name.endswith('.avsc') and name[:-5].isdigit()
+        )
+
+    def get_schema(self, schema_id: int) -> str:
+        try:
+            with open(self._schema_path(schema_id)) as f:
+                return f.read()
+        except FileNotFoundError:
+            raise SchemaRegistryException(f'Unknown schema id {schema_id}')
+
+    def register(self, subject: str, schema: str) -> int:
+        schema = canonical_schema(schema)
+        with self._lock:
+            subjects_path = os.path.join(self.path, 'subjects.json')
+            subjects: Dict[str, list] = {}
+            if os.path.exists(subjects_path):
+                with open(subjects_path) as f:
+                    subjects = json.load(f)
+            ids = self._ids()
+            schema_id = next((x for x in ids if self.get_schema(x) == schema), None)
+            if schema_id is None:
+                schema_id = (ids[-1] if ids else 0) + 1
+                with open(self._schema_path(schema_id), 'w') as f:
+                    f.write(schema)
+            if schema_id not in subjects.setdefault(subject, []):
+                subjects[subject].append(schema_id)
+                with open(subjects_path, 'w') as f:
+                    json.dump(subjects, f)
+            return schema_id
+
+
+class CachedSchemaRegistry(SchemaRegistry):
+    # Wraps a registry client with an in-process LRU cache and, optionally, a cache on
+    # disk that survives restarts. Registered ids are cached per (subject, schema).
+
+    def __init__(self, client: SchemaRegistry, cache_size: int = 1000, cache_dir: str = None):
+        self.client = client
+        self.cache_dir = cache_dir
+        self._schemas = LRUCache(cache_size)
+        self._ids = LRUCache(cache_size)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_schema(self, schema_id: int) -> str:
+        schema = self._schemas.get(schema_id)
+        if schema is not None:
+            return schema
+        schema = self._read_disk_cache(schema_id)
+        if schema is None:
+            schema = self.client.get_schema(schema_id)
+            self._write_disk_cache(schema_id, schema)
+        self._schemas.put(schema_id, schema)
+        return schema
+
+    def register(self, subject: str, schema: str) -> int:
+        key = (subject, canonical_schema(schema))
+        schema_id = self._ids.get(key)
+        if schema_id is None:
+            schema_id = self.client.register(subject, schema)
+            self._ids.put(key, schema_id)
+        return schema_id
+
+    def _read_disk_cache(self, schema_id):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, f'{schema_id}.avsc')) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_disk_cache(self, schema_id, schema):
+        if not self.cache_dir:
+            return
+        path = os.path.join(self.cache_dir, f'{schema_id}.avsc')
+        try:
+            # written aside and renamed, so readers never see a partial file
+            with open(f'{path}.{os.getpid()}.tmp', 'w') as f:
+                f.write(schema)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+        except OSError as err:
+            LOG.error(f'Could not cache schema {schema_id} in {self.cache_dir}: {err}')
+
+    def stats(self) -> Dict[str, int]:
+        return self._schemas.stats()
+
+
+def get_schema_registry(
+    url: str,
+    cache_size: int = 1000,
+    cache_dir: str = None
+) -> CachedSchemaRegistry:
+    # http(s) urls are Confluent Schema Registries, file:// urls the directory of a
+    # FileSchemaRegistry.
+    if url.startswith('http://') or url.startswith('https://'):
+        client = HTTPSchemaRegistry(url)
+    elif url.startswith('file://'):
+        client = FileSchemaRegistry(url[len('file://'):])
+    else:
+        raise ValueError(
+            f'Unsupported schema registry url {url}, expected http://, https:// or file://')
+    return CachedSchemaRegistry(client, cache_size=cache_size, cache_dir=cache_dir)
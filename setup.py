@@ -50,10 +50,14 @@ setup(
         'spavro',
         'webtest',
     ],
+    extras_require={
+        'columnar': ['numpy'],
+    },
     tests_require=[
         'fakeredis',
         'flake8',
         'flake8-quotes',
+        'numpy',
         'pytest',
         'pytest-cov',
         'pytest-lazy-fixture',
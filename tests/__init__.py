@@ -401,6 +401,85 @@ def send_plain_messages(producer, topic, schema, messages, encoding, is_json=Tru
     producer.flush()
 
 
+def avro_container(schema, messages, codec='deflate'):
+    # serialize messages into a single Avro container, as our producers do
+    if isinstance(schema, dict):
+        schema = ParseSchema(json.dumps(schema))
+    bytes_writer = io.BytesIO()
+    writer = DataFileWriter(bytes_writer, DatumWriter(), schema, codec=codec)
+    for msg in messages:
+        writer.append(msg)
+    writer.flush()
+    raw_bytes = bytes_writer.getvalue()
+    writer.close()
+    return raw_bytes
+
+
+class FakeKafkaMessage(object):
+    # stands in for confluent_kafka.Message in offline tests
+
+    def __init__(self, value, topic='test', partition=0, offset=0, key=None, headers=None):
+        self._value = value
+        self._topic = topic
+        self._partition = partition
+        self._offset = offset
+        self._key = key
+        self._headers = headers
+
+    def value(self):
+        return self._value
+
+    def topic(self):
+        return self._topic
+
+    def partition(self):
+        return self._partition
+
+    def offset(self):
+        return self._offset
+
+    def key(self):
+        return self._key
+
+    def headers(self):
+        return self._headers
+
+    def error(self):
+        return None
+
+
+class FakeProducer(object):
+    # stands in for confluent_kafka.Producer in offline tests, keeps what is produced.
+    # Delivery callbacks run on poll and flush, with {error} when it is set.
+
+    def __init__(self, error=None):
+        self.produced = []
+        self.undelivered = []
+        self.error = error
+
+    def poll(self, timeout=None):
+        delivered, self.undelivered = self.undelivered, []
+        for callback, msg in delivered:
+            callback(self.error, msg)
+        return len(delivered)
+
+    def produce(self, topic, value=None, key=None, callback=None, headers=None, **kwargs):
+        msg = FakeKafkaMessage(
+            value,
+            topic=topic,
+            offset=len(self.produced),
+            key=key,
+            headers=list((headers or {}).items())
+        )
+        self.produced.append(msg)
+        if callback is not None:
+            self.undelivered.append((callback, msg))
+
+    def flush(self, timeout=None):
+        self.poll()
+        return 0
+
+
 def send_avro_messages(producer, topic, schema, messages):
     bytes_writer = io.BytesIO()
     writer = DataFileWriter(bytes_writer, DatumWriter(), schema, codec='deflate')
@@ -639,6 +718,7 @@ def offline_consumer():
     _configs = deepcopy(KafkaConsumer.ADDITIONAL_CONFIG)
     _configs['aether_emit_flag_required'] = True  # we don't need to test the all_pass state
     consumer._set_config(_configs)
+    consumer._init_caches()
     return consumer
 
 
@@ -0,0 +1,853 @@
+# Copyright (C) 2019 by eHealth Africa : http://www.eHealthAfrica.org
+#
+# See the NOTICE file distributed with this work for additional information
+# regarding copyright ownership.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY
+# KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations
+# under the License.
+
+# Micro benchmarks for the hot paths of the consumer and producer.
+# They are not collected by pytest. Run them from the repository root with:
+#
+#   python -m tests.benchmarks [name ...]
+
+from copy import deepcopy
+from dataclasses import asdict, dataclass
+from fnmatch import fnmatchcase
+import io
+from itertools import compress
+import json
+import os
+import sys
+import tempfile
+import time
+from timeit import repeat
+import tracemalloc
+import uuid
+from typing import Callable, Dict, List
+
+from jsonpath_ng import parse
+from spavro import datafile
+from spavro.io import validate
+from spavro.schema import AvroException, parse as parse_schema
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, see bench_batch_filter
+    np = None
+
+from aet.avro_utils import (
+    CachedDataFileReader,
+    PayloadReader,
+    get_validator,
+    validate_all
+)
+from aet.kafka import (
+    KafkaConsumer,
+    Message,
+    MessageMeta,
+    PartitionedConsumer,
+    PrefetchingConsumer
+)
+from aet.kafka_utils import (
+    BatchingProducer,
+    DeliveryContext,
+    DeliveryStats,
+    delivery_callback,
+    kafka_callback,
+    produce,
+    produce_bulk
+)
+from aet.schema_registry import get_schema_registry
+from aet.filters import (
+    MISSING,
+    ApprovalFilter,
+    Range,
+    compile_accessor,
+    compile_check,
+    compile_mask_plan
+)
+from aet.helpers import LRUCache, TopicConfigMap
+from aet.id_headers import ID_FORMATS, decode_ids, encode_ids
+
+from . import FakeKafkaMessage, FakeProducer, avro_container
+from .assets.schemas import test_schemas
+
+BENCHMARKS: Dict[str, Callable] = {}
+
+
+def benchmark(fn):
+    BENCHMARKS[fn.__name__.replace('bench_', '', 1)] = fn
+    return fn
+
+
+def best_of(fn, number=1000, runs=5) -> float:
+    # best time per call in microseconds
+    return min(repeat(fn, number=number, repeat=runs)) / number * 1e6
+
+
+def report(title, results: Dict[str, float], unit='us/call', rate=False):
+    # the speed up is relative to the first result, {rate} figures are higher is better
+    print(f'\n{title}')
+    baseline = next(iter(results.values()))
+    for name, value in results.items():
+        speed_up = value / baseline if rate else baseline / value
+        print(f'    {name:<32} {value:>12.3f} {unit}  ({speed_up:.1f}x)')
+
+
+def sample_messages(source, count=100):
+    return test_schemas[source]['mocker'](count=count)
+
+
+# Masking
+
+def legacy_mask(schema, mask_query, mask_levels, emit_level):
+    # the closure built by KafkaConsumer.get_mask_from_schema before masks were compiled
+    try:
+        emit_index = mask_levels.index(emit_level)
+    except ValueError:
+        emit_index = -1
+    expr = parse('$.fields.[*].%s.`parent`' % mask_query)
+    restricted_fields = [(match.value) for match in expr.find(schema)]
+    restriction_map = [[obj.get('name'), obj.get(mask_query)] for obj in restricted_fields]
+    failing_values = [
+        i[1] for i in restriction_map if mask_levels.index(i[1]) > emit_index]
+
+    def mask(msg):
+        for name, field_level in restriction_map:
+            if msg.get(name, None) is not None:
+                if field_level in failing_values:
+                    msg.pop(name, None)
+        return msg
+    return mask
+
+
+@benchmark
+def bench_masking():
+    cases = [
+        ('TestBooleanPass', [0, 1, 2, 3, 4, 5], 2),
+        ('TestTopSecret', ['public', 'confidential', 'secret', 'top secret', 'ufos'], 'public'),
+    ]
+    for source, levels, emit_level in cases:
+        schema = test_schemas[source]['schema']
+        messages = sample_messages(source)
+        legacy = legacy_mask(schema, 'aetherMaskingLevel', levels, emit_level)
+        compiled = compile_mask_plan(schema, 'aetherMaskingLevel', levels, emit_level).apply
+        assert [legacy(m) for m in deepcopy(messages)] == \
+            [compiled(m) for m in deepcopy(messages)]
+
+        def run(mask):
+            # every call masks fresh copies, so the copy is part of each figure
+            def _fn():
+                for m in messages:
+                    mask(dict(m))
+            return _fn
+        report(f'masking {source}, per 100 records', {
+            'legacy closure': best_of(run(legacy)),
+            'compiled MaskPlan': best_of(run(compiled)),
+        })
+
+
+# Emit filter
+
+def legacy_approval_filter(path, pass_conditions):
+    # the filter built by KafkaConsumer.get_approval_filter before paths were compiled
+    def check(x):
+        return x in pass_conditions
+    expr = parse(path)
+
+    def approval_filter(msg):
+        values = [match.value for match in expr.find(msg)]
+        if not len(values) > 0:
+            return False
+        return check(values[0])
+    return approval_filter
+
+
+def compiled_approval_filter(path, pass_conditions):
+    get_value = compile_accessor(path)
+    check = compile_check(pass_conditions)
+
+    def approval_filter(msg):
+        value = get_value(msg)
+        if value is MISSING:
+            return False
+        return check(value)
+    return approval_filter
+
+
+@benchmark
+def bench_approval_filter():
+    messages = sample_messages('TestEnumPass')
+    for path in ['$.publish', '$.missing']:
+        pass_conditions = ['yes', 'maybe']
+        legacy = legacy_approval_filter(path, pass_conditions)
+        compiled = compiled_approval_filter(path, pass_conditions)
+        assert [legacy(m) for m in messages] == [compiled(m) for m in messages]
+
+        def run(_filter):
+            def _fn():
+                for m in messages:
+                    _filter(m)
+            return _fn
+        report(f'approval filter {path}, per 100 records', {
+            'jsonpath_ng find': best_of(run(legacy)),
+            'compiled accessor': best_of(run(compiled)),
+        })
+
+
+@benchmark
+def bench_batch_filter():
+    # a topic where 1% of the records are emitted
+    rows = [{'id': str(x), 'score': x % 100, 'state': f's{x % 100}'} for x in range(10000)]
+    for path, pass_conditions in [('$.state', ['s0']), ('$.score', Range(high=1, inclusive=False))]:
+        approval_filter = ApprovalFilter(path, pass_conditions)
+        per_record = compiled_approval_filter(path, pass_conditions)
+        assert [per_record(r) for r in rows] == list(approval_filter.keep(rows))
+        results = {
+            'per record closure': best_of(lambda: [r for r in rows if per_record(r)], 10),
+            'keep, a block at once': best_of(
+                lambda: list(compress(rows, approval_filter.keep(rows))), 10)
+        }
+        if np is not None and path == '$.score':
+            column = np.array([r['score'] for r in rows], dtype='int64')
+            results['numpy column'] = best_of(lambda: approval_filter.check_values(column), 10)
+        report(f'emit filter {path}, {len(rows)} records', {
+            name: value / 1000 for name, value in results.items()}, 'ms')
+
+
+# Deserialization
+
+def offline_consumer(**config):
+    consumer = KafkaConsumer.__new__(KafkaConsumer)
+    consumer.config = {**KafkaConsumer.ADDITIONAL_CONFIG, **config}
+    consumer._init_caches()
+    return consumer
+
+
+def sample_batch(source='TestBooleanPass', containers=200, records=100):
+    schema = test_schemas[source]['schema']
+    return [
+        FakeKafkaMessage(avro_container(schema, sample_messages(source, records)), offset=x)
+        for x in range(containers)
+    ]
+
+
+@benchmark
+def bench_parallel_deserialize():
+    batch = sample_batch()
+    results = {}
+    for workers in [0, 2, 4]:
+        consumer = offline_consumer(aether_deserialize_workers=workers)
+        consumer.consume = lambda *args, **kwargs: batch
+        consumer.poll_and_deserialize()  # warm up caches and worker processes
+        results[f'{workers or "no"} workers'] = best_of(
+            consumer.poll_and_deserialize, number=1, runs=3) / 1000
+        consumer._shutdown_pool()
+    report('poll_and_deserialize, 200 containers x 100 records', results, 'ms/batch')
+
+
+@benchmark
+def bench_prefetch():
+    # Kafka fetches and sink writes are simulated by sleeping, which releases the GIL
+    # like the network calls they stand for. Decoding is real.
+    batches, fetch_s, handle_s = 20, 0.02, 0.02
+    batch = sample_batch(containers=20)
+
+    def slow_consume(num_messages=1, timeout=1):
+        time.sleep(fetch_s)
+        return batch
+
+    def run(prefetch):
+        consumer = offline_consumer()
+        consumer.consume = slow_consume
+        consumer.seek = lambda tp: None
+        source = PrefetchingConsumer(consumer, timeout=0.1).start() if prefetch else consumer
+        start = time.perf_counter()
+        for x in range(batches):
+            assert len(source.poll_and_deserialize()) == 2000
+            time.sleep(handle_s)
+        elapsed = time.perf_counter() - start
+        if prefetch:
+            source.stop()
+        return elapsed / batches * 1000
+
+    report(f'{batches} batches of 20 containers, {fetch_s * 1000:.0f} ms fetch + '
+           f'{handle_s * 1000:.0f} ms handling each', {
+               'consume then handle': run(False),
+               'prefetched': run(True),
+           }, 'ms/batch')
+
+
+@benchmark
+def bench_partitioned():
+    # 4 partitions; the sink write of each handled chunk is simulated by a sleep, which
+    # releases the GIL like the I/O it stands for. Decoding is real, and mostly holds it.
+    partitions, batches, write_s = 4, 10, 0.01
+    schema = test_schemas['TestBooleanPass']['schema']
+    batch = [
+        FakeKafkaMessage(
+            avro_container(schema, sample_messages('TestBooleanPass', 100)),
+            partition=x % partitions, offset=x // partitions)
+        for x in range(8 * partitions)
+    ]
+
+    def handle(messages):
+        time.sleep(write_s)
+
+    def serial():
+        consumer = offline_consumer()
+        consumer.consume = lambda num_messages, timeout: batch
+        for x in range(batches):
+            messages = consumer.poll_and_deserialize()
+            for p in range(partitions):
+                handle([m for m in messages if m.partition == p])
+
+    def partitioned():
+        consumer = offline_consumer()
+        consumer.consume = lambda num_messages, timeout: batch
+        consumer.commit = lambda offsets, asynchronous: None
+        source = PartitionedConsumer(consumer, handle)
+        for x in range(batches):
+            source.poll()
+        source.stop()
+
+    report(f'{batches} batches of {len(batch)} containers over {partitions} partitions, '
+           f'{write_s * 1000:.0f} ms write per partition', {
+               'serial': best_of(serial, number=1, runs=3) / 1000 / batches,
+               'worker per partition': best_of(partitioned, number=1, runs=3) / 1000 / batches,
+           }, 'ms/batch')
+
+
+@benchmark
+def bench_commits():
+    # A synchronous commit waits for the broker, simulated by a 1 ms sleep.
+    count = 10000
+    messages = [Message(offset=x, partition=0, topic='test') for x in range(count)]
+    calls = []
+
+    def commit(offsets=None, asynchronous=True, **kwargs):
+        calls.append(asynchronous)
+        if not asynchronous:
+            time.sleep(0.001)
+
+    def per_message():
+        for m in messages:
+            commit(offsets=[m], asynchronous=False)
+
+    def managed():
+        consumer = offline_consumer(aether_commit_manager=True)
+        consumer.commit = commit
+        for m in messages:
+            consumer.commit_manager.track(m.topic, m.partition, m.offset)
+        for x in range(0, count, 100):  # handled in batches of 100
+            consumer.mark_handled(messages[x:x + 100])
+        consumer.commit_manager.commit(asynchronous=False)
+
+    results = {}
+    for name, fn in [('sync commit per message', per_message), ('commit manager', managed)]:
+        calls.clear()
+        elapsed = best_of(fn, number=1, runs=3) / 1000
+        results[f'{name}, {len(calls) // 3} commits'] = elapsed
+    report(f'{count} messages handled', results, 'ms')
+
+
+@benchmark
+def bench_topic_patterns():
+    # 200 tenant rules, looked up for 1000 topics
+    rules = [(f'tenant-{x}-*', x) for x in range(200)]
+    topics = [f'tenant-{x % 200}-events-{x}' for x in range(1000)]
+    configs = TopicConfigMap()
+
+    def scan():
+        for topic in topics:
+            next(value for pattern, value in rules if fnmatchcase(topic, pattern))
+
+    def first_lookup():
+        configs.__init__()
+        for pattern, value in rules:
+            configs.set(pattern, value)
+        for topic in topics:
+            configs.get(topic)
+
+    def memoized():
+        for topic in topics:
+            configs.get(topic)
+
+    report(f'{len(topics)} topic lookups, {len(rules)} patterns', {
+        'fnmatch scan': best_of(scan, number=1, runs=3) / 1000,
+        'single matcher, first lookup': best_of(first_lookup, number=1, runs=3) / 1000,
+        'memoized': best_of(memoized, number=10) / 1000
+    }, 'ms')
+
+
+def wide_schema(width=50):
+    return {
+        'name': 'Wide',
+        'type': 'record',
+        'fields': [{'name': 'id', 'type': 'string'}] + [
+            {'name': f'field{x}', 'type': ['null', 'string']} for x in range(width)
+        ]
+    }
+
+
+def wide_batch(width=50, containers=100, records=100):
+    schema = wide_schema(width)
+    rows = [
+        {'id': str(x), **{f'field{y}': f'value-{x}-{y}' for y in range(width)}}
+        for x in range(records)
+    ]
+    return [FakeKafkaMessage(avro_container(schema, rows), offset=x) for x in range(containers)]
+
+
+@benchmark
+def bench_projection():
+    batch = wide_batch()
+    results = {}
+    for name, fields in [('all 51 fields', None), ('projected to 3 fields', ['id', 'field1'])]:
+        consumer = offline_consumer(
+            aether_masking_schema_annotation=None,
+            aether_emit_flag_required=True,
+            aether_emit_flag_field_path='$.field2',
+            aether_emit_flag_values=[None],
+            aether_projection_fields=fields
+        )
+        consumer.consume = lambda *args, **kwargs: batch
+        consumer.poll_and_deserialize()
+        results[name] = best_of(consumer.poll_and_deserialize, number=1, runs=3) / 1000
+    report('poll_and_deserialize, 100 containers x 100 records', results, 'ms/batch')
+
+
+@benchmark
+def bench_decoders():
+    cases = [
+        ('TestBooleanPass', sample_batch('TestBooleanPass', containers=50)),
+        ('TestEnumPass', sample_batch('TestEnumPass', containers=50)),
+        ('Wide, 51 fields', wide_batch(containers=20)),
+    ]
+    for name, batch in cases:
+        results = {}
+        decoded = []
+        for backend in ['spavro', 'compiled']:
+            consumer = offline_consumer(
+                aether_masking_schema_annotation=None,
+                aether_avro_decoder=backend
+            )
+            consumer.consume = lambda *args, **kwargs: batch
+            messages = consumer.poll_and_deserialize()
+            decoded.append([m.value for m in messages])
+            seconds = best_of(consumer.poll_and_deserialize, number=1, runs=3) / 1e6
+            results[backend] = len(messages) / seconds / 1000
+        assert decoded[0] == decoded[1]
+        report(f'poll_and_deserialize {name}', results, 'k records/s', rate=True)
+
+
+@benchmark
+def bench_columnar():
+    batch = sample_batch(containers=50)
+    consumer = offline_consumer(
+        aether_emit_flag_required=True,
+        aether_emit_flag_field_path='$.publish',
+        aether_masking_schema_emit_level=2,
+        aether_avro_decoder='compiled'
+    )
+    consumer.consume = lambda *args, **kwargs: batch
+    report('50 containers x 100 records', {
+        'poll_and_deserialize': best_of(consumer.poll_and_deserialize, number=1, runs=5) / 1000,
+        'poll_and_deserialize_columnar': best_of(
+            consumer.poll_and_deserialize_columnar, number=1, runs=5) / 1000,
+    }, 'ms/batch')
+
+
+# Payload sniffing
+
+def legacy_open_value(consumer, value):
+    # non Avro payloads before sniffing: a failed container read, then a JSON parse
+    obj = io.BytesIO()
+    obj.write(value)
+    try:
+        CachedDataFileReader(obj, consumer._schema_cache)
+    except AvroException:
+        text = obj.getvalue().decode('utf-8', 'strict')
+        try:
+            return json.loads(text)
+        except json.decoder.JSONDecodeError:
+            return text
+
+
+@benchmark
+def bench_sniffing():
+    consumer = offline_consumer()
+    for name, value in [
+        ('JSON document', json.dumps(sample_messages('TestBooleanPass', 2)[0]).encode()),
+        ('plain text', b'a log line that is not JSON'),
+    ]:
+        assert legacy_open_value(consumer, value) == \
+            consumer.deserialize_value('test', value)['messages'][0]
+        report(f'deserialize_value, {name}', {
+            'try Avro first': best_of(lambda: legacy_open_value(consumer, value), 10000),
+            'sniffed': best_of(lambda: consumer.deserialize_value('test', value), 10000),
+        })
+
+
+# Schema Registry wire format
+
+@benchmark
+def bench_wire_format():
+    schema = test_schemas['TestBooleanPass']['schema']
+    docs = sample_messages('TestBooleanPass', 100)
+    with tempfile.TemporaryDirectory() as path:
+        registry = get_schema_registry(f'file://{path}')
+        producer = FakeProducer()
+        produce(docs, parse_schema(json.dumps(schema)), 'test', producer, registry=registry)
+        wire = [m.value() for m in producer.produced]
+        containers = [avro_container(schema, [doc]) for doc in docs]
+        report('one record per Kafka message, payload size', {
+            'Avro container': sum(len(v) for v in containers) / len(docs),
+            'registry wire format': sum(len(v) for v in wire) / len(docs),
+        }, 'bytes')
+        consumer = offline_consumer(aether_masking_schema_annotation=None)
+        consumer.set_schema_registry(registry)
+        assert [consumer.deserialize_value('t', v)['messages'] for v in wire] == \
+            [consumer.deserialize_value('t', v)['messages'] for v in containers]
+        report('one record per Kafka message, deserialize_value', {
+            'Avro container': best_of(
+                lambda: [consumer.deserialize_value('t', v) for v in containers], 100),
+            'registry wire format': best_of(
+                lambda: [consumer.deserialize_value('t', v) for v in wire], 100),
+        }, 'us/100 msgs')
+
+
+@benchmark
+def bench_batching_producer():
+    # documents handed over one at a time, as a job emitting records as it goes would
+    schema = parse_schema(json.dumps(test_schemas['TestBooleanPass']['schema']))
+    docs = sample_messages('TestBooleanPass', 2000)
+
+    def per_doc(producer):
+        for doc in docs:
+            produce([doc], schema, 'test', producer)
+
+    def batching(producer, **options):
+        with BatchingProducer(producer, max_docs=500, linger_ms=60000, **options) as batcher:
+            for doc in docs:
+                batcher.produce([doc], schema, 'test')
+
+    def overhead(producer):
+        # payload and header bytes per document
+        size = sum(
+            len(m.value()) + sum(len(k) + len(v) for k, v in m.headers())
+            for m in producer.produced
+        )
+        return size / len(docs)
+
+    timings, sizes = {}, {}
+    for name, fn in [
+        ('produce, a container per doc', per_doc),
+        ('BatchingProducer', batching),
+        ('BatchingProducer, deflate level 1', lambda p: batching(p, compression_level=1)),
+    ]:
+        timings[name] = best_of(lambda: fn(FakeProducer()), number=1, runs=3) / len(docs)
+        producer = FakeProducer()
+        fn(producer)
+        sizes[name] = overhead(producer)
+    report(f'{len(docs)} documents produced one by one, CPU', timings, 'us/doc')
+    report('bytes sent per document', sizes, 'bytes')
+
+
+@benchmark
+def bench_validation():
+    # the per row check produce makes before encoding a document
+    for name, test_schema in test_schemas.items():
+        results = {}
+        schema = parse_schema(json.dumps(test_schema['schema']))
+        docs = sample_messages(name, 1000)
+        compiled = get_validator(schema)
+        for label, fn in [
+            ('spavro.io.validate', lambda: [validate(schema, doc) for doc in docs]),
+            ('compiled, per row', lambda: [get_validator(schema)(doc) for doc in docs]),
+            ('compiled, cached callable', lambda: [compiled(doc) for doc in docs]),
+            ('compiled, whole batch', lambda: validate_all(schema, docs)),
+        ]:
+            results[label] = best_of(fn, number=5, runs=3) / len(docs)
+        report(f'{name}, validation per row, CPU', results, 'us/row')
+
+
+@benchmark
+def bench_delivery_callbacks():
+    # the producer side cost of delivery reports, for containers of 100 documents
+    schema = parse_schema(json.dumps(test_schemas['TestBooleanPass']['schema']))
+    producer = FakeProducer()
+    for _ in range(100):
+        produce(sample_messages('TestBooleanPass', 100), schema, 'test', producer)
+    messages = producer.produced
+    schemas = LRUCache(64)
+
+    def decoding_callback(err=None, msg=None, _=None):
+        # as kafka_callback was, reading every record for its id
+        for message in CachedDataFileReader(PayloadReader(msg.value()), schemas):
+            if err:
+                print(message.get('id'))
+
+    def with_context():
+        stats = DeliveryStats()
+        for msg in messages:
+            context = DeliveryContext('test', [], len(msg.value()))
+            # produce inspects the callback once per call, not per message
+            delivery_callback(kafka_callback, context, stats, True)(None, msg)
+
+    results = {
+        'decoding the payload': best_of(
+            lambda: [decoding_callback(None, m) for m in messages], number=3, runs=3),
+        'context and stats': best_of(with_context, number=3, runs=3)
+    }
+    report(f'{len(messages)} delivery reports, CPU', {
+        name: value / len(messages) for name, value in results.items()
+    }, 'us/message')
+
+
+@benchmark
+def bench_produce_split():
+    # a backfill of 20k documents in one call, against a 1 MB message limit
+    schema = parse_schema(json.dumps(test_schemas['TestBooleanPass']['schema']))
+    docs = sample_messages('TestBooleanPass', 20000)
+
+    def sizes(producer):
+        return [
+            len(m.value()) + sum(len(k) + len(v) for k, v in m.headers())
+            for m in producer.produced
+        ]
+
+    timings, largest = {}, {}
+    for name, options in [
+        ('one container', {'max_bytes': None}),
+        ('chunks of 5000 docs', {'max_bytes': None, 'max_docs': 5000}),
+        ('max_bytes=1000000', {'max_bytes': 1000000}),
+        ('max_bytes=100000', {'max_bytes': 100000}),
+    ]:
+        timings[name] = best_of(
+            lambda: produce(docs, schema, 'test', FakeProducer(), **options),
+            number=1, runs=3) / len(docs)
+        producer = FakeProducer()
+        produce(docs, schema, 'test', producer, **options)
+        largest[f'{name} ({len(producer.produced)} messages)'] = max(sizes(producer)) / 1024
+    report(f'{len(docs)} documents in one produce call, CPU', timings, 'us/doc')
+    report('largest message, with headers', largest, 'KiB')
+
+
+@benchmark
+def bench_produce_bulk():
+    # a backfill encoded on the calling thread, or by worker processes
+    schema = parse_schema(json.dumps(test_schemas['TestBooleanPass']['schema']))
+    docs = sample_messages('TestBooleanPass', 50000)
+    results = {'produce': best_of(
+        lambda: produce(docs, schema, 'test', FakeProducer()), number=1, runs=3)}
+    for workers in [0, 2, 4]:
+        results[f'produce_bulk, workers={workers}'] = best_of(
+            lambda: produce_bulk(docs, schema, 'test', FakeProducer(), workers=workers),
+            number=1, runs=3)
+    report(f'{len(docs)} documents on {os.cpu_count()} CPUs, wall time', {
+        name: value / len(docs) for name, value in results.items()
+    }, 'us/doc')
+
+
+@benchmark
+def bench_id_headers():
+    # the contains_id header of a 10k document container
+    for name, ids in [
+        ('uuid4 ids', [str(uuid.uuid4()) for _ in range(10000)]),
+        ('sequential ids', [f'household-{i:08}' for i in range(10000)]),
+    ]:
+        sizes, encode, decode = {}, {}, {}
+        for id_format in ID_FORMATS:
+            value = encode_ids(ids, id_format)
+            sizes[id_format] = len(value) / 1024
+            encode[id_format] = best_of(lambda: encode_ids(ids, id_format), number=3, runs=3)
+            decode[id_format] = best_of(lambda: decode_ids(value), number=3, runs=3)
+        report(f'{name}, header size', sizes, 'KiB')
+        report(f'{name}, encode, CPU', encode, 'us')
+        report(f'{name}, decode, CPU', decode, 'us')
+
+
+@benchmark
+def bench_dedup():
+    # 100 containers of 100 records polled once, then replayed
+    schema = parse_schema(json.dumps(test_schemas['TestBooleanPass']['schema']))
+    producer = FakeProducer()
+    for _ in range(100):
+        produce(sample_messages('TestBooleanPass', 100), schema, 'test', producer)
+    batch = producer.produced
+    first, replay = {}, {}
+    for name, config in [
+        ('no dedup', {}),
+        ('bloom, 1M ids, 0.1%', {'aether_dedup_window': 1000000}),
+        ('lru, 1M ids', {'aether_dedup_window': 1000000, 'aether_dedup_store': 'lru'}),
+    ]:
+        consumer = offline_consumer(aether_emit_flag_required=False, **config)
+        consumer.consume = lambda *args, **kwargs: batch
+        consumer.poll_and_deserialize()  # warm up the schema cache
+
+        def poll():
+            consumer._init_caches()
+            consumer.poll_and_deserialize()
+            return consumer
+
+        first[name] = best_of(poll, number=1, runs=3) / 10000
+        consumer = poll()
+        replay[name] = best_of(consumer.poll_and_deserialize, number=1, runs=3) / 10000
+    report('first delivery, CPU', first, 'us/record')
+    report('replay, CPU', replay, 'us/record')
+
+
+# Message memory
+
+@dataclass
+class LegacyMessage:
+    # Message as it was before records of a container shared their metadata
+    key: str = None
+    value: str = None
+    offset: int = None
+    topic: str = None
+    partition: int = None
+    schema: str = None
+    headers: List = None
+
+
+def allocated_kb(fn) -> float:
+    # memory still allocated by the result of fn(), in KiB
+    tracemalloc.start()
+    result = fn()  # noqa  (keeps the result alive while we measure)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current / 1024
+
+
+def peak_kb(fn) -> float:
+    # the highest memory allocated while fn() runs, in KiB
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+@benchmark
+def bench_payload_copies():
+    # One large block per container, as written by producers with a large sync interval.
+    # The peaks include the records of the block, the difference is in the payload copies.
+    schema = wide_schema(10)
+    rows = [
+        {'id': str(y), **{f'field{x}': f'value {x} of row {y}' for x in range(10)}}
+        for y in range(20000)
+    ]
+    sync_interval, datafile.SYNC_INTERVAL = datafile.SYNC_INTERVAL, 1 << 30
+    try:
+        payloads = {codec: avro_container(schema, rows, codec) for codec in ['null', 'deflate']}
+    finally:
+        datafile.SYNC_INTERVAL = sync_interval
+
+    def read(make_reader, value):
+        cache = LRUCache(4)
+
+        def fn():
+            reader = CachedDataFileReader(make_reader(value), cache, 'compiled')
+            return sum(len(block) for block in reader.iter_blocks())
+        fn()  # compiles the decoder
+        return fn
+
+    def copied(value):  # as payloads used to be read
+        obj = io.BytesIO()
+        obj.write(value)
+        return obj
+
+    for codec, value in payloads.items():
+        report(f'{codec} container of {len(value) // 1024} KiB, peak memory while decoding', {
+            'copied into a BytesIO': peak_kb(read(copied, value)),
+            'PayloadReader': peak_kb(read(PayloadReader, value)),
+        }, 'KiB')
+
+
+@benchmark
+def bench_poll_budgets():
+    # 20 containers of 2000 wide records, handled (and dropped) a poll at a time
+    schema = wide_schema(10)
+    rows = [
+        {'id': str(y), **{f'field{x}': f'value {x} of row {y}' for x in range(10)}}
+        for y in range(2000)
+    ]
+    incoming = [FakeKafkaMessage(avro_container(schema, rows), offset=x) for x in range(20)]
+
+    def drain(**budgets):
+        def fn():
+            consumer = offline_consumer(aether_emit_flag_required=False)
+            pending = [incoming]
+            consumer.consume = lambda *args, **kwargs: pending.pop() if pending else []
+            count, largest = 0, 0
+            while True:
+                messages = consumer.poll_and_deserialize(num_messages=20, **budgets)
+                if not messages:
+                    return count, largest
+                count, largest = count + len(messages), max(largest, len(messages))
+        return fn
+
+    results = {}
+    for name, budgets in [
+        ('unbounded', {}),
+        ('max_records=5000', {'max_records': 5000}),
+        ('max_records=500', {'max_records': 500}),
+        (f'max_bytes={len(incoming[0].value()) * 2}', {'max_bytes': len(incoming[0].value()) * 2})
+    ]:
+        count, largest = drain(**budgets)()
+        assert count == 40000
+        results[f'{name} ({largest} per poll)'] = peak_kb(drain(**budgets))
+    report(f'{len(incoming)} containers of {len(rows)} records, peak memory', results, 'KiB')
+
+
+@benchmark
+def bench_message_memory():
+    containers, records = 1000, 100
+    schema = test_schemas['TestBooleanPass']['schema']
+    bodies = sample_messages('TestBooleanPass', records)
+    headers = [('avro_size', b'100')]
+
+    def legacy():
+        return [
+            LegacyMessage(b'key', body, offset, 'topic', 0, schema, headers)
+            for offset in range(containers) for body in bodies
+        ]
+
+    def shared():
+        out = []
+        for offset in range(containers):
+            meta = MessageMeta(b'key', offset, 'topic', 0, schema, headers)
+            out.extend(Message.with_meta(body, meta) for body in bodies)
+        return out
+
+    assert asdict(legacy()[150]) == asdict(shared()[150])
+    # Record bodies are shared by both, so the figures are the cost of the wrappers.
+    # The slotted Message also keeps __dict__ and __weakref__ slots, 16 bytes per
+    # record, so it still takes other attributes and weak references as the
+    # dataclass did. Without them it would save that much more.
+    report(f'{containers * records} Messages, {records} records per container', {
+        'dataclass per record': allocated_kb(legacy),
+        'slotted, shared metadata': allocated_kb(shared),
+    }, 'KiB')
+
+
+def main(names):
+    for name in (names or BENCHMARKS.keys()):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -16,15 +16,81 @@
 # specific language governing permissions and limitations
 # under the License.
 
+from collections import Counter
+from concurrent.futures import Future
 from copy import copy
+import dataclasses
+import gc
+import math
+import pickle
+import re
+from threading import Barrier, Thread, current_thread
 import types
+import uuid
+import weakref
 
+import confluent_kafka
 import requests
 
 from . import *  # noqa
 from aet.job import JobStatus
 from aet.logger import get_logger
-from aet.kafka import KafkaConsumer, FilterConfig, MaskConfig
+from aet import columnar
+from aet.avro_utils import (
+    CachedDataFileReader,
+    PayloadReader,
+    build_projected_reader,
+    build_schema_entry,
+    decode_datum,
+    get_validator,
+    validate_all
+)
+from aet.exceptions import MessageHandlingException, SchemaRegistryException
+from aet.filters import (
+    MISSING,
+    And,
+    ApprovalFilter,
+    In,
+    IsNull,
+    Not,
+    Or,
+    Predicate,
+    Range,
+    Regex,
+    compile_accessor,
+    compile_check
+)
+from aet.helpers import LRUCache, LRUIdSet, RotatingBloomFilter, TopicConfigMap
+from aet.id_headers import ContainedIds, decode_ids, encode_ids, encoded_id_size
+from aet.kafka_utils import (
+    BatchingProducer,
+    DeliveryStats,
+    kafka_callback,
+    produce,
+    produce_bulk
+)
+from aet.schema_registry import (
+    CachedSchemaRegistry,
+    FileSchemaRegistry,
+    SchemaRegistry,
+    encode_wire_format,
+    get_schema_registry
+)
+from aet import kafka as aet_kafka
+from aet import kafka_utils as aet_kafka_utils
+from aet.kafka import (
+    CommitManager,
+    KafkaConsumer,
+    FilterConfig,
+    MaskConfig,
+    Message,
+    PartitionedConsumer,
+    PrefetchingConsumer,
+    ProjectionConfig,
+    sniff_payload
+)
+from jsonpath_ng import parse as jsonpath_parse
+from spavro.io import validate as spavro_validate
 from aether.python.redis.task import LOG as task_log
 
 from aet.logger import wrap_logger
@@ -282,6 +348,234 @@ def test_get_approval_filter(offline_consumer, field_path, field_value, pass_msg
     assert(_filter(fail_msg) is not True)
 
 
+@pytest.mark.unit
+@pytest.mark.parametrize('path', [
+    '$',
+    '$.approved',
+    '$.a.b',
+    '$.a[1]',
+    '$.a[0].b',
+    "$['a']",
+    '$.a[*]',  # not simple, handled by jsonpath_ng
+    '$..b',
+])
+@pytest.mark.parametrize('msg', [
+    {'approved': True},
+    {'approved': None},
+    {'a': {'b': 'yes'}},
+    {'a': [{'b': 1}, 2]},
+    {'a': 'b'},
+    {'a': [1]},
+    [],
+])
+def test_compiled_accessor(path, msg):
+    matches = [m.value for m in jsonpath_parse(path).find(msg)]
+    expected = matches[0] if matches else MISSING
+    assert(compile_accessor(path)(msg) == expected)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('pass_conditions,value,result', [
+    ([True], True, True),
+    ([True], 1, True),
+    (['yes', 'maybe'], 'no', False),
+    (['yes', 'maybe'], ['yes'], False),
+    ([['yes']], ['yes'], True),
+    ('yes', 'yes', True),
+])
+def test_compiled_check(pass_conditions, value, result):
+    assert(compile_check(pass_conditions)(value) is result)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('pass_conditions,passing', [
+    (['yes', 1], ['yes', 1, True]),
+    ('yes', ['yes']),
+    ([['yes']], [['yes']]),
+    (In(('yes',)), ['yes']),
+    (Range(1, 5), [1, 3, 3.5, 5, True]),
+    (Range(1, 5, inclusive=False), [1, 3, 3.5, True]),
+    (Range(low=3), [3, 3.5, 5, 100]),
+    (Regex('^y'), ['yes']),
+    (IsNull(), [None]),
+    (Not(IsNull()), ['yes', 'no', 1, 3, 3.5, 5, 100, True, ['yes'], {'a': 1}]),
+    (Range(1, 5) & ~In((3,)), [1, 3.5, 5, True]),
+    (Or(IsNull(), Regex('no')), [None, 'no']),
+    (And(), ['yes', 'no', None, 1, 3, 3.5, 5, 100, True, ['yes'], {'a': 1}]),
+])
+def test_approval_filter__predicates(pass_conditions, passing):
+    values = ['yes', 'no', None, 1, 3, 3.5, 5, 100, True, ['yes'], {'a': 1}]
+    rows = [{'a': v} for v in values] + [{'b': 1}, 'text']
+    approval_filter = ApprovalFilter('$.a', pass_conditions)
+    expected = [v in passing for v in values] + [False, False]
+    assert([approval_filter(row) for row in rows] == expected)
+    assert(list(approval_filter.keep(rows)) == expected)
+    assert(list(ApprovalFilter('$.a[0]', pass_conditions).keep([{'a': [v]} for v in values])) ==
+           expected[:-2])
+
+
+@pytest.mark.unit
+def test_predicate__abstract():
+    with pytest.raises(TypeError):
+        Predicate()
+
+
+@pytest.mark.unit
+@pytest.mark.skipif(columnar.np is None, reason='numpy is not installed')
+def test_approval_filter__numeric_column():
+    column = columnar.np.array([0, 1, 2, 3, 4, 5], dtype='int64')
+    for pass_conditions, expected in [
+        ([1, 3, 'x'], [False, True, False, True, False, False]),
+        (Range(2, 4), [False, False, True, True, True, False]),
+        (Range(high=2) | Range(low=5), [True, True, True, False, False, True]),
+        (~IsNull(), [True] * 6),
+    ]:
+        keep = ApprovalFilter('$.a', pass_conditions).check_values(column)
+        assert(isinstance(keep, columnar.np.ndarray))
+        assert(keep.tolist() == expected)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('decoder', ['spavro', 'compiled'])
+def test_approval_filter__consumer(offline_consumer, decoder):
+    schema = {
+        'name': 'Scored',
+        'type': 'record',
+        'fields': [
+            {'name': 'id', 'type': 'string'},
+            {'name': 'score', 'type': 'long'}
+        ]
+    }
+    offline_consumer._add_config({'aether_avro_decoder': decoder})
+    offline_consumer._init_caches()
+    rows = [{'id': str(x), 'score': x} for x in range(100)]
+    incoming = [FakeKafkaMessage(avro_container(schema, rows))]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    offline_consumer.set_topic_filter_config('test', FilterConfig(
+        check_condition_path='$.score',
+        pass_conditions=Range(10, 20, inclusive=False),
+        requires_approval=True
+    ))
+    messages = offline_consumer.poll_and_deserialize()
+    assert([m.value['score'] for m in messages] == list(range(10, 20)))
+    batch, = offline_consumer.poll_and_deserialize_columnar()
+    assert(list(batch.columns['score']) == list(range(10, 20)))
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('value,payload_format', [
+    (avro_container(test_schemas['TestBooleanPass']['schema'], []), 'avro'),
+    (b'\x00\x00\x00\x00\x01\x02', 'confluent'),
+    (b'\x00', 'text'),
+    (b'{"a": 1}', 'json'),
+    (b' \n[1, 2]', 'json'),
+    (b'123', 'text'),
+    (b'plain text', 'text'),
+    (b'', 'text'),
+])
+def test_sniff_payload(value, payload_format):
+    assert(sniff_payload(value) == payload_format)
+
+
+@pytest.mark.unit
+def test_message_deserialize__mixed_payloads(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    payloads = [
+        (avro_container(sample_schema, mocker(count=2)), None),
+        (b'{"a": 1}', {'a': 1}),
+        (b' ["a"]', ['a']),
+        (b'"quoted"', 'quoted'),
+        (b'12', 12),
+        (b'null', None),
+        (b'nothing to parse', 'nothing to parse'),
+        (b'[broken', '[broken'),
+    ]
+    for value, expected in payloads[1:]:
+        assert(offline_consumer.deserialize_value('test', value)['messages'] == [expected])
+    avro_result = offline_consumer.deserialize_value('test', payloads[0][0])
+    assert(avro_result['format'] == 'avro')
+    assert(avro_result['messages'][0]['publish'] is True)
+    assert(offline_consumer.get_payload_format_stats() == {
+        'avro': 1, 'confluent': 0, 'json': 3, 'text': 4})
+    # the non standard constants json.loads accepts are read as floats, as they were
+    for value, expected in [(b'Infinity', math.inf), (b'-Infinity', -math.inf)]:
+        assert(offline_consumer.deserialize_value('test', value)['messages'] == [expected])
+    assert(math.isnan(offline_consumer.deserialize_value('test', b'NaN')['messages'][0]))
+    assert(offline_consumer.deserialize_value('test', b'Nope')['messages'] == ['Nope'])
+
+
+@pytest.mark.unit
+def test_schema_registry__file_and_cache(tmpdir, sample_schema):
+    registry = FileSchemaRegistry(str(tmpdir.join('registry')))
+    schema_id = registry.register('test-value', json.dumps(sample_schema))
+    assert(registry.register('other-value', sample_schema) == schema_id)
+    assert(registry.register('test-value', {**sample_schema, 'name': 'Other'}) == schema_id + 1)
+    assert(json.loads(registry.get_schema(schema_id)) == sample_schema)
+    with pytest.raises(SchemaRegistryException):
+        registry.get_schema(100)
+
+    cache_dir = str(tmpdir.join('cache'))
+    cached = CachedSchemaRegistry(registry, cache_dir=cache_dir)
+    assert(cached.get_schema(schema_id) == registry.get_schema(schema_id))
+    assert(cached.get_schema(schema_id) == registry.get_schema(schema_id))
+    assert(cached.stats()['hits'] == 1)
+    # the disk cache answers once the registry is gone
+    empty = FileSchemaRegistry(str(tmpdir.join('empty')))
+    offline = CachedSchemaRegistry(empty, cache_dir=cache_dir)
+    assert(offline.get_schema(schema_id) == registry.get_schema(schema_id))
+    with pytest.raises(SchemaRegistryException):
+        offline.get_schema(schema_id + 1)
+    # an interface, clients implement both methods
+    with pytest.raises(TypeError):
+        SchemaRegistry()
+
+
+@pytest.mark.unit
+def test_schema_registry__wire_format(offline_consumer, tmpdir, sample_schema):
+    offline_consumer._add_config({
+        'aether_emit_flag_required': True,
+        'aether_emit_flag_field_path': '$.publish',
+    })
+    docs = test_schemas['TestBooleanPass']['mocker'](count=4)
+    producer = FakeProducer()
+    registry = get_schema_registry('file://' + str(tmpdir.join('registry')))
+    schema = ParseSchema(json.dumps(sample_schema))
+    produce(docs, schema, 'test', producer, registry=registry)
+    assert(len(producer.produced) == 4)
+    payload = producer.produced[0].value()
+    assert(sniff_payload(payload) == 'confluent')
+    assert(len(payload) < len(avro_container(sample_schema, docs[:1])))
+    kafka_callback(msg=producer.produced[0])  # ids are read from the headers
+
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced
+    # without a registry wire format payloads are read as text
+    assert(len(offline_consumer.poll_and_deserialize()) == 4)
+    offline_consumer.set_schema_registry(registry)
+    messages = offline_consumer.poll_and_deserialize()
+    # filtered and masked as the records of an Avro container
+    expected = offline_consumer.deserialize_value('test', avro_container(sample_schema, docs))
+    assert([m.value for m in messages] == expected['messages'])
+    assert(messages[0].schema == sample_schema)
+    # counted as they were read, without a registry as text
+    assert(offline_consumer.get_payload_format_stats() == {
+        'avro': 1, 'confluent': 4, 'json': 0, 'text': 4})
+    batches = offline_consumer.poll_and_deserialize_columnar()
+    assert(batches[0].to_records() == [m.value for m in messages])
+    # worker processes resolve schemas with the registry set on the consumer
+    offline_consumer._add_config({'aether_deserialize_workers': 1})
+    offline_consumer._get_pool()
+    offline_consumer.set_schema_registry(registry)
+    assert(offline_consumer._pool is None)  # restarted with the registry
+    try:
+        assert(offline_consumer.poll_and_deserialize() == messages)
+    finally:
+        offline_consumer._shutdown_pool()
+    # urls without a scheme are rejected, not taken for a directory
+    with pytest.raises(ValueError):
+        get_schema_registry('schema-registry:8081')
+
+
 @pytest.mark.unit
 def test_message_deserialize__failure(offline_consumer):
     msg = 'a utf-16 string'.encode('utf-16')
@@ -340,6 +634,1307 @@ def test_msk_msg_custom_map(offline_consumer,
     assert(len(masked.keys()) == (expected_count)), ('%s %s' % (emit_level, masked))
 
 
+@pytest.mark.unit
+def test_schema_cache__reuses_schema(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = [
+        FakeKafkaMessage(avro_container(sample_schema, mocker(count=10)), offset=x)
+        for x in range(3)
+    ]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    messages = offline_consumer.poll_and_deserialize()
+    assert(len(messages) == 15)  # half of each container is approved
+    assert(all([m.schema == sample_schema for m in messages]))
+    stats = offline_consumer.get_schema_cache_stats()
+    assert(stats['misses'] == 1)
+    assert(stats['hits'] == 2)
+    assert(stats['size'] == 1)
+
+
+@pytest.mark.unit
+def test_schema_cache__topic_config_change(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = [FakeKafkaMessage(avro_container(sample_schema, mocker(count=10)))]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    assert(len(offline_consumer.poll_and_deserialize()) == 5)
+    offline_consumer.set_topic_filter_config('test', FilterConfig(
+        check_condition_path='$.publish',
+        pass_conditions=[True, False],
+        requires_approval=True
+    ))
+    assert(len(offline_consumer.poll_and_deserialize()) == 10)
+
+
+@pytest.mark.unit
+def test_parallel_deserialize__keeps_order(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = []
+    for x in range(12):
+        incoming.append(FakeKafkaMessage(
+            avro_container(sample_schema, mocker(count=10)), partition=x % 2, offset=x // 2))
+    incoming.append(FakeKafkaMessage(json.dumps({'id': 'json'}).encode('utf-8'), offset=6))
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    serial = offline_consumer.poll_and_deserialize()
+    offline_consumer._add_config({
+        'aether_deserialize_workers': 2,
+        'aether_deserialize_chunk_size': 3
+    })
+    try:
+        parallel = offline_consumer.poll_and_deserialize()
+        # a schema sent with the results of another thread is read here
+        offline_consumer._pool_schemas.clear()
+        assert(offline_consumer.poll_and_deserialize() == serial)
+        # threads sharing the consumer, as under PartitionedConsumer, share one pool
+        offline_consumer._shutdown_pool()
+        barrier = Barrier(8)
+        pools = []
+
+        def get_pool():
+            barrier.wait()
+            pools.append(offline_consumer._get_pool())
+
+        threads = [Thread(target=get_pool) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert(len(set(map(id, pools))) == 1)
+    finally:
+        offline_consumer._shutdown_pool()
+    assert(len(serial) == 61)
+    assert(parallel == serial)
+    assert(parallel[0].schema == sample_schema)
+    assert(parallel[-1].value == {'id': 'json'})
+
+
+@pytest.mark.unit
+def test_iter_deserialize__stop_early(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = [
+        FakeKafkaMessage(avro_container(sample_schema, mocker(count=10)), partition=p, offset=o)
+        for o in range(3) for p in range(2)
+    ]
+    seeks = []
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    offline_consumer.seek = lambda tp: seeks.append((tp.topic, tp.partition, tp.offset))
+    messages = offline_consumer.iter_deserialize()
+    first = [next(messages) for x in range(7)]
+    # only the first two containers have been opened
+    stats = offline_consumer.get_schema_cache_stats()
+    assert(stats['hits'] + stats['misses'] == 2)
+    assert([(m.partition, m.offset) for m in first] == [(0, 0)] * 5 + [(1, 0)] * 2)
+    messages.close()
+    # partition 1 restarts at the half read container
+    assert(sorted(seeks) == [('test', 0, 1), ('test', 1, 0)])
+
+
+@pytest.mark.unit
+def test_iter_deserialize__no_rewind_when_exhausted(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = [FakeKafkaMessage(avro_container(sample_schema, mocker(count=10)))]
+    seeks = []
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    offline_consumer.seek = lambda tp: seeks.append(tp)
+    messages = offline_consumer.iter_deserialize()
+    assert(len([next(messages) for x in range(5)]) == 5)
+    messages.close()
+    assert(seeks == [])
+
+
+@pytest.mark.unit
+def test_iter_deserialize__consumes_when_started(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_required': False})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    consumed = []
+    offline_consumer.consume = lambda *args, **kwargs: consumed.append(1) or [
+        FakeKafkaMessage(avro_container(sample_schema, mocker(count=4)))
+    ]
+    # a stream dropped before it is started consumes nothing
+    offline_consumer.iter_deserialize().close()
+    assert(consumed == [])
+    assert(len(list(offline_consumer.iter_deserialize())) == 4)
+    assert(consumed == [1])
+
+
+@pytest.mark.unit
+def test_message__shared_metadata(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = [FakeKafkaMessage(avro_container(sample_schema, mocker(count=4)), key='k')]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    first, second, *_ = offline_consumer.poll_and_deserialize()
+    assert(first._meta is second._meta)
+    assert((first.key, first.offset, first.topic, first.partition) == ('k', 0, 'test', 0))
+    assert(first.schema == sample_schema)
+    # writes only change the message written to
+    first.offset = 10
+    assert((first.offset, second.offset) == (10, 0))
+    assert(first._meta is not second._meta)
+    # still a dataclass, with the fields it always had
+    assert(dataclasses.asdict(second)['offset'] == 0)
+    moved = dataclasses.replace(second, offset=20)
+    assert((moved.offset, moved.key, second.offset) == (20, 'k', 0))
+    assert([f.name for f in dataclasses.fields(Message)][:3] == ['key', 'value', 'offset'])
+    # construction, equality and copies work as with the former dataclass
+    msg = Message('k', {'a': 1}, 10, 'test', 0, None, None)
+    assert(msg == Message(key='k', value={'a': 1}, offset=10, topic='test', partition=0))
+    assert(msg != Message('k', {'a': 2}, 10, 'test', 0, None, None))
+    assert(pickle.loads(pickle.dumps(msg)) == msg)
+    assert(repr(msg).startswith("Message(key='k', value={'a': 1}, offset=10"))
+    msg.other = 1  # other attributes can be set, as on any dataclass
+    assert(msg.other == 1)
+
+
+@pytest.mark.unit
+def test_poll_and_deserialize_columnar(offline_consumer, sample_schema):
+    offline_consumer._add_config({
+        'aether_emit_flag_required': True,
+        'aether_emit_flag_field_path': '$.publish',
+        'aether_masking_schema_emit_level': 2
+    })
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    counter_schema = {
+        'name': 'Counter',
+        'type': 'record',
+        'fields': [
+            {'name': 'count', 'type': 'long'},
+            {'name': 'publish', 'type': 'boolean'}
+        ]
+    }
+    incoming = [
+        FakeKafkaMessage(avro_container(sample_schema, mocker(count=10)), offset=0, key='a'),
+        FakeKafkaMessage(avro_container(counter_schema, [
+            {'count': x, 'publish': x % 2 == 0} for x in range(6)]), offset=1),
+        FakeKafkaMessage(avro_container(sample_schema, mocker(count=4)), offset=2, partition=1),
+        FakeKafkaMessage(json.dumps({'id': 'json'}).encode('utf-8'), offset=3),
+    ]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    expected = offline_consumer.poll_and_deserialize()
+    batches = offline_consumer.poll_and_deserialize_columnar()
+    assert([(b.topic, len(b)) for b in batches] == [('test', 7), ('test', 3), ('test', 1)])
+    boolean_pass, counter, _json = batches
+    # the same records as poll_and_deserialize, grouped by schema
+    assert(boolean_pass.to_records() == [m.value for m in expected if 'field1' in m.value])
+    assert(counter.to_records() == [m.value for m in expected if 'count' in m.value])
+    assert(_json.to_records() == [{'id': 'json'}])
+    # masked fields are dropped as whole columns
+    assert(list(boolean_pass.columns) == ['id', 'publish', 'field1', 'field2'])
+    assert(list(boolean_pass.offsets) == [0] * 5 + [2] * 2)
+    assert(list(boolean_pass.partitions) == [0] * 5 + [1] * 2)
+    assert(boolean_pass.keys == ['a'] * 5 + [None] * 2)
+    assert(list(counter.columns['count']) == [0, 2, 4])
+    if columnar.np is not None:
+        assert(counter.columns['count'].dtype == columnar.np.int64)
+        assert(isinstance(boolean_pass.columns['id'], list))
+
+
+@pytest.mark.unit
+def test_prefetching_consumer(offline_consumer):
+    def fake_batch(offset):
+        return [
+            FakeKafkaMessage(json.dumps({'id': offset + x}).encode('utf-8'), offset=offset + x)
+            for x in range(3)
+        ]
+
+    batches = iter([fake_batch(x) for x in range(0, 30, 3)])
+    consumed = []
+
+    def consume(num_messages=1, timeout=1):
+        batch = next(batches, [])
+        if batch:
+            consumed.append(batch)
+        else:
+            sleep(timeout)
+        return batch
+
+    committed, seeks = [], []
+    offline_consumer.consume = consume
+    offline_consumer.commit = lambda offsets, asynchronous: committed.append(
+        [(tp.topic, tp.partition, tp.offset) for tp in offsets])
+    offline_consumer.seek = lambda tp: seeks.append((tp.topic, tp.partition, tp.offset))
+    prefetch = PrefetchingConsumer(offline_consumer, timeout=0.01, queue_depth=2).start()
+    def wait_for_queue():
+        for x in range(200):
+            if prefetch.stats()['batches'] == 2:
+                break
+            sleep(0.01)
+
+    wait_for_queue()
+    sleep(0.05)
+    # the queue is full, so the thread waits instead of consuming more
+    assert(len(consumed) == 2)
+    assert(prefetch.stats() == {'batches': 2, 'bytes': sum(len(m.value()) for m in consumed[0] * 2)})
+    assert(prefetch.commit() is None)  # nothing handed out yet
+    assert([m.value for m in prefetch.poll_and_deserialize()] == [{'id': x} for x in range(3)])
+    prefetch.commit()
+    assert(committed == [[('test', 0, 3)]])
+    assert(prefetch.poll_and_deserialize()[0].offset == 3)
+    wait_for_queue()
+    prefetch.stop()
+    # batches still queued are dropped and their partition rewound, never committed
+    assert(len(consumed) == 4)
+    assert(seeks == [('test', 0, 6)])
+    assert(prefetch.stats() == {'batches': 0, 'bytes': 0})
+    prefetch.commit()
+    assert(committed[-1] == [('test', 0, 6)])
+
+
+@pytest.mark.unit
+def test_prefetching_consumer__revoke(offline_consumer):
+    def fake_batch(offset):
+        # two messages of each of two partitions
+        return [
+            FakeKafkaMessage(
+                json.dumps({'id': offset + x}).encode('utf-8'), partition=p, offset=offset + x)
+            for x in range(2) for p in range(2)
+        ]
+
+    batches = [fake_batch(x) for x in range(0, 6, 2)]
+    size = sum(len(m.value()) for m in batches[0])
+
+    def consume(num_messages=1, timeout=1):
+        if batches:
+            return batches.pop(0)
+        sleep(timeout)
+        return []
+
+    callbacks, committed, revoked = {}, [], []
+    offline_consumer.subscribe = lambda topics, **kwargs: callbacks.update(kwargs)
+    offline_consumer.consume = consume
+    offline_consumer.commit = lambda offsets, asynchronous: committed.append(
+        (sorted((tp.partition, tp.offset) for tp in offsets), asynchronous))
+    prefetch = PrefetchingConsumer(offline_consumer, timeout=0.01, queue_depth=3)
+    prefetch.subscribe(['test'], on_revoke=lambda c, ps: revoked.append(ps[0].partition))
+    prefetch.start()
+    for x in range(200):
+        if prefetch.stats()['batches'] == 3:
+            break
+        sleep(0.01)
+    assert(len(prefetch.poll_and_deserialize()) == 4)
+    # a revoked partition commits what was handed out, synchronously, and its queued
+    # messages are dropped
+    callbacks['on_revoke'](offline_consumer, [confluent_kafka.TopicPartition('test', 1)])
+    assert(committed == [([(1, 2)], False)])
+    assert(revoked == [1])
+    assert(prefetch.stats() == {'batches': 2, 'bytes': size})
+    assert([(m.partition, m.offset) for m in prefetch.poll_and_deserialize()] == [(0, 2), (0, 3)])
+    # nothing is committed for lost partitions
+    callbacks['on_lost'](offline_consumer, [confluent_kafka.TopicPartition('test', 0)])
+    assert(prefetch.stats() == {'batches': 0, 'bytes': 0})
+    assert(prefetch.commit() is None)
+    assert(len(committed) == 1)
+    prefetch.stop()
+
+@pytest.mark.unit
+def test_partitioned_consumer(offline_consumer):
+    tps = [confluent_kafka.TopicPartition('test', x) for x in range(3)]
+
+    def fake_batch(offset):
+        # two messages of each partition
+        return [
+            FakeKafkaMessage(
+                json.dumps({'id': offset + x}).encode('utf-8'), partition=p, offset=offset + x)
+            for x in range(2) for p in range(3)
+        ]
+
+    batches = [fake_batch(x) for x in range(0, 10, 2)]
+    callbacks = {}
+    committed, seeks, handled = [], [], []
+    offline_consumer.subscribe = lambda topics, **kwargs: callbacks.update(kwargs)
+    offline_consumer.consume = lambda num_messages, timeout: batches.pop(0) if batches else []
+    offline_consumer.commit = lambda offsets, asynchronous: committed.append(
+        sorted((tp.partition, tp.offset) for tp in offsets))
+    offline_consumer.seek = lambda tp: seeks.append((tp.partition, tp.offset))
+    fail_at = {(1, 4)}
+
+    def handler(messages):
+        if (messages[0].partition, messages[0].offset) in fail_at:
+            fail_at.clear()
+            raise ValueError('failed')
+        sleep(0.01)
+        handled.append((current_thread().name, messages[0].partition, [m.offset for m in messages]))
+
+    partitioned = PartitionedConsumer(offline_consumer, handler)
+    partitioned.subscribe(['test'])
+    callbacks['on_assign'](offline_consumer, tps)
+    assert(partitioned.stats()['workers'] == 3)
+    partitioned.poll()
+    partitioned.poll()
+    partitioned.flush()
+    assert(partitioned.handled_offsets() == {('test', 0): 4, ('test', 1): 4, ('test', 2): 4})
+    partitioned.commit()
+    assert(committed == [[(0, 4), (1, 4), (2, 4)]])
+    partitioned.poll()  # the handler fails for the chunk of partition 1 at offset 4
+    partitioned.poll()
+    partitioned.flush()
+    with pytest.raises(ValueError):
+        partitioned.poll()
+    # the partition is rewound to the failed chunk, the rest of it was dropped
+    assert(seeks == [(1, 4)])
+    assert(partitioned.handled_offsets() == {('test', 0): 8, ('test', 2): 8})
+    batches[:0] = [fake_batch(4)[1::3], fake_batch(6)[1::3]]  # partition 1, from offset 4
+    for x in range(3):
+        partitioned.poll()  # not raised again
+    # revoked partitions finish their chunks, commit, and their workers stop
+    workers = {tp: partitioned._workers[tp].thread for tp in partitioned._workers}
+    callbacks['on_revoke'](offline_consumer, tps[:2])
+    assert(committed[-1] == [(0, 10), (1, 10)])
+    assert(not workers[('test', 0)].is_alive() and workers[('test', 2)].is_alive())
+    assert(partitioned.stats() == {'workers': 1, 'partitions': 1, 'queued': 0})
+    # each partition is handled in order, by a single thread
+    for partition in range(3):
+        chunks = [(t, o) for t, p, o in handled if p == partition]
+        assert(len({t for t, _ in chunks}) == 1)
+        offsets = [o for _, chunk in chunks for o in chunk]
+        assert(offsets == list(range(10)))
+    assert(len({t for t, _, _ in handled}) == 3)
+    partitioned.stop()
+    assert(committed[-1] == [(2, 10)])
+    assert(not workers[('test', 2)].is_alive())
+
+
+@pytest.mark.unit
+def test_partitioned_consumer__bounded_workers(offline_consumer):
+    partitioned = PartitionedConsumer(offline_consumer, lambda messages: None, max_workers=2)
+    partitioned._assign([confluent_kafka.TopicPartition('test', x) for x in range(5)])
+    assert(partitioned.stats()['workers'] == 2)
+    assert(sorted(len(w.partitions) for w in set(partitioned._workers.values())) == [2, 3])
+    offline_consumer.commit = lambda offsets, asynchronous: None
+    partitioned._revoke([confluent_kafka.TopicPartition('test', x) for x in range(5)])
+    assert(partitioned.stats() == {'workers': 0, 'partitions': 0, 'queued': 0})
+
+class FakeCommitConsumer(object):
+    def __init__(self):
+        self.commits = []
+
+    def commit(self, offsets, asynchronous):
+        self.commits.append((asynchronous, sorted((tp.partition, tp.offset) for tp in offsets)))
+
+
+@pytest.mark.unit
+def test_commit_manager():
+    now = [0]
+    consumer = FakeCommitConsumer()
+    commits = CommitManager(consumer, every_messages=3, interval_ms=1000, clock=lambda: now[0])
+
+    def message(partition, offset):
+        return Message(offset=offset, partition=partition, topic='test')
+
+    for offset in [0, 1, 2, 5]:  # offsets need not be contiguous (i.e. compacted topics)
+        commits.track('test', 0, offset)
+    commits.track('test', 1, 10, handled=True)  # all its records were filtered out
+    commits.mark_handled([message(0, 1), message(0, 2)])
+    assert(commits.committable() == {('test', 1): 11})  # offset 0 is still being handled
+    assert(consumer.commits == [])
+    commits.mark_handled([message(0, 0)])  # 3 handled, commits asynchronously
+    assert(consumer.commits == [(True, [(0, 3), (1, 11)])])
+    commits.mark_handled([message(0, 5)])
+    assert(len(consumer.commits) == 1)
+    now[0] = 1.5  # or once the interval passed
+    commits.maybe_commit()
+    assert(consumer.commits[-1] == (True, [(0, 6)]))
+    # rewound messages are forgotten, then tracked again when they are consumed again
+    commits.track('test', 0, 6)
+    commits.track('test', 0, 7)
+    commits.rewind('test', 0, 6)
+    commits.mark_handled([message(0, 7)])
+    assert(commits.committable() == {})
+    commits.track('test', 0, 6)
+    commits.track('test', 0, 7)
+    commits.mark_handled([message(0, 6), message(0, 7)])
+    assert(consumer.commits[-1] == (True, [(0, 8)]))
+    assert(commits.commit(asynchronous=False) is None)  # nothing new
+
+
+@pytest.mark.unit
+def test_commit_manager__consumer(offline_consumer, sample_schema):
+    offline_consumer._add_config({
+        'aether_commit_manager': True,
+        'aether_commit_every_messages': 1000,
+        'aether_emit_flag_field_path': '$.publish',
+        'aether_emit_flag_values': [True]
+    })
+    offline_consumer._init_caches()
+    committed = FakeCommitConsumer()
+    offline_consumer.commit = committed.commit
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    published = [dict(m, publish=True) for m in mocker(count=4)]
+    withheld = [dict(m, publish=False) for m in mocker(count=2)]
+    incoming = [
+        FakeKafkaMessage(avro_container(sample_schema, published), offset=0),
+        FakeKafkaMessage(avro_container(sample_schema, withheld), offset=1),
+        FakeKafkaMessage(avro_container(sample_schema, published), offset=2, partition=1),
+    ]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    messages = offline_consumer.poll_and_deserialize()
+    assert(len(messages) == 8)
+    offline_consumer.mark_handled(messages[:4])
+    # the withheld container yields nothing, it is handled once read
+    assert(offline_consumer.commit_manager.committable() == {('test', 0): 2})
+    callbacks = offline_consumer._rebalance_callbacks()
+    callbacks['on_revoke'](offline_consumer, [confluent_kafka.TopicPartition('test', 0)])
+    assert(committed.commits == [(False, [(0, 2)])])
+    offline_consumer.mark_handled(messages[4:])
+    offline_consumer.commit_manager.commit(asynchronous=False)
+    assert(committed.commits[-1] == (False, [(1, 3)]))
+    # columnar batches are marked by their rows (partition 0 was revoked, then delivered again)
+    batches = offline_consumer.poll_and_deserialize_columnar()
+    offline_consumer.mark_handled(batches[0])
+    offline_consumer.commit_manager.commit(asynchronous=False)
+    assert(committed.commits[-1] == (False, [(0, 2)]))
+
+
+@pytest.mark.unit
+def test_commit_manager__job():
+    class CommittingJob(BaseJob):
+        name = 'committing'
+        schema = '{}'
+        _resources = []
+
+        def _get_messages(self, config):
+            sleep(0.01)
+            return [Message(offset=self.value, partition=0, topic='test')]
+
+        def _handle_messages(self, config, messages):
+            self.value += 1
+
+    class RecordingManager(object):
+        def __init__(self):
+            self.marked = []
+            self.commits = []
+
+        def mark_handled(self, messages):
+            self.marked.extend(messages)
+
+        def commit(self, asynchronous=True):
+            self.commits.append(asynchronous)
+
+    CommittingJob.commit_manager = RecordingManager()
+    job = CommittingJob('j', 'tenant', None, mock.MagicMock())
+    job.config = {'id': 'j'}
+    while not job.commit_manager.marked:
+        sleep(0.01)
+    job.stop().join()
+    assert(len(job.commit_manager.marked) == job.value)
+    assert(job.commit_manager.commits == [False])  # synchronously, once stopped
+
+
+@pytest.mark.unit
+def test_commit_manager__job_failure():
+    class FailingJob(BaseJob):
+        name = 'failing'
+        schema = '{}'
+        _resources = []
+        offset = 0
+
+        def _get_messages(self, config):
+            sleep(0.01)
+            messages = [
+                Message(offset=self.offset + x, partition=0, topic='test') for x in range(2)]
+            for m in messages:
+                self.commit_manager.track(m.topic, m.partition, m.offset)
+            self.offset += 2
+            return messages
+
+        def _handle_messages(self, config, messages):
+            if messages[0].offset == 0:
+                raise MessageHandlingException('failed')
+            self.value += 1
+
+    consumer = FakeCommitConsumer()
+    FailingJob.commit_manager = CommitManager(
+        consumer, every_messages=10 ** 6, interval_ms=10 ** 9)
+    job = FailingJob('j', 'tenant', None, mock.MagicMock())
+    job.config = {'id': 'j'}
+    while job.value < 2:
+        sleep(0.01)
+    job.stop().join()
+    # the failed batch was skipped, it does not hold back the commits after it
+    asynchronous, [(partition, offset)] = consumer.commits[-1]
+    assert(not asynchronous and offset >= 6)
+    assert(job.commit_manager.committable() == {})
+
+@pytest.mark.unit
+def test_topic_config_map():
+    configs = TopicConfigMap()
+    configs.set('tenant-*.events', 'glob')
+    configs.set('^tenant-[0-9]+\\.', 'regex')
+    configs.set('tenant-1.events', 'exact')
+    assert(len(configs) == 3)
+    assert('tenant-*.events' in configs)
+    assert(configs.get('tenant-1.events') == 'exact')
+    assert(configs.get('tenant-2.events') == 'glob')   # the first matching pattern wins
+    assert(configs.get('tenant-2.audit') == 'regex')
+    assert(configs.get('tenant-a.audit') is None)
+    calls = []
+
+    def default():
+        calls.append(1)
+        return 'default'
+
+    assert(configs.get('other', default) == 'default')
+    assert(configs.get('other', default) == 'default')
+    assert(len(calls) == 1)  # resolved once
+    configs.set('oth?r', 'glob')
+    assert(configs.get('other', default) == 'glob')
+    assert(configs.matches('oth?r', 'other'))
+    assert(not configs.matches('oth?r', 'others'))
+    assert(configs.matches('^oth', 'others'))
+    assert(configs.items()[0] == ('tenant-1.events', 'exact'))
+    # invalid patterns are rejected when set
+    with pytest.raises(re.error):
+        configs.set('^bad[', 'invalid')
+    assert('^bad[' not in configs and configs.get('bad') is None)
+    # groups and back references keep their meaning, inline flags work
+    configs.set('^(x)\\1$', 'repeated')
+    configs.set('^(?i)LOUD', 'flags')
+    assert(configs.get('xx') == 'repeated' and configs.get('xy') is None)
+    assert(configs.get('loud') == 'flags')
+    assert(configs.get('tenant-3.events') == 'glob')
+
+
+@pytest.mark.unit
+def test_topic_config__patterns(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    container = avro_container(sample_schema, mocker(count=10))
+    incoming = [
+        FakeKafkaMessage(container, topic=topic)
+        for topic in ['tenant-1', 'tenant-2', 'other']
+    ]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    assert(len(offline_consumer.poll_and_deserialize()) == 15)
+    # a pattern replaces the filters already built for the topics it matches
+    offline_consumer.set_topic_filter_config('tenant-*', FilterConfig(
+        check_condition_path='$.publish',
+        pass_conditions=[True, False],
+        requires_approval=True
+    ))
+    offline_consumer.set_topic_filter_config('^tenant-2$', FilterConfig(
+        check_condition_path=None, pass_conditions=None, requires_approval=False))
+    messages = offline_consumer.poll_and_deserialize()
+    counts = Counter(msg.topic for msg in messages)
+    assert(counts == {'tenant-1': 10, 'tenant-2': 10, 'other': 5})
+    entry = offline_consumer._schema_cache.values()[0]
+    assert(set(entry.filters) == {'tenant-1', 'tenant-2', 'other'})
+    # built once per topic and schema, not once per poll
+    approval_filter = entry.filters['tenant-1']
+    offline_consumer.poll_and_deserialize_columnar()
+    plan = entry.plans['tenant-1']
+    offline_consumer.poll_and_deserialize_columnar()
+    assert(entry.filters['tenant-1'] is approval_filter)
+    assert(entry.plans['tenant-1'] is plan)
+    # pool workers are given the patterns too
+    aet_kafka._init_deserialize_worker(
+        offline_consumer.config, offline_consumer._topic_filter_configs.items(), [], [])
+    worker_config = aet_kafka._worker_deserializer._get_topic_filter_config('tenant-9')
+    assert(worker_config.pass_conditions == [True, False])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('decoder', ['spavro', 'compiled'])
+def test_iter_blocks(sample_schema, monkeypatch, decoder):
+    monkeypatch.setattr('spavro.datafile.SYNC_INTERVAL', 200)  # blocks of a few records
+    rows = test_schemas['TestBooleanPass']['mocker'](count=20)
+    reader = CachedDataFileReader(
+        PayloadReader(avro_container(sample_schema, rows)), LRUCache(), decoder)
+    blocks = list(reader.iter_blocks())
+    assert(len(blocks) > 2)
+    assert([row for block in blocks for row in block] == rows)
+
+
+@pytest.mark.unit
+def test_poll_budgets(offline_consumer, sample_schema, monkeypatch):
+    monkeypatch.setattr('spavro.datafile.SYNC_INTERVAL', 200)
+    offline_consumer._add_config({
+        'aether_emit_flag_required': False,
+        'aether_commit_manager': True,
+        'aether_commit_every_messages': 1000
+    })
+    offline_consumer._init_caches()
+    committed = FakeCommitConsumer()
+    offline_consumer.commit = committed.commit
+    seeks = []
+    offline_consumer.seek = lambda tp: seeks.append((tp.partition, tp.offset))
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    containers = [avro_container(sample_schema, mocker(count=10)) for _ in range(4)]
+    consumed = [[FakeKafkaMessage(c, offset=x) for x, c in enumerate(containers)]]
+    offline_consumer.consume = lambda *args, **kwargs: consumed.pop(0) if consumed else []
+    # records: a container is split over polls, nothing is consumed while records are left
+    first = offline_consumer.poll_and_deserialize(num_messages=4, max_records=15)
+    assert([m.offset for m in first] == [0] * 10 + [1] * 5)
+    offline_consumer.mark_handled(first)
+    manager = offline_consumer.commit_manager
+    assert(manager.committable() == {('test', 0): 1})  # offset 1 is held
+    second = offline_consumer.poll_and_deserialize(max_records=15)
+    assert([m.offset for m in second] == [1] * 5 + [2] * 10)
+    offline_consumer.mark_handled(second)
+    assert(manager.committable() == {('test', 0): 3})
+    # bytes: a message over budget is opened only if it is the first one of the call
+    third = offline_consumer.poll_and_deserialize(max_bytes=1)
+    assert([m.offset for m in third] == [3] * 10)
+    assert(offline_consumer.poll_and_deserialize(max_bytes=1) == [])
+    # bytes and records, what is carried over goes back to Kafka on a rebalance
+    consumed.append([FakeKafkaMessage(c, offset=x + 4) for x, c in enumerate(containers)])
+    fourth = offline_consumer.poll_and_deserialize(
+        max_bytes=len(containers[0]) * 2, max_records=5)
+    assert([m.offset for m in fourth] == [4] * 5)
+    offline_consumer._rebalance_callbacks()['on_revoke'](offline_consumer, [])
+    assert(seeks[-1] == (0, 4))
+    assert(offline_consumer.poll_and_deserialize(max_records=5) == [])
+    # unbudgeted polls still drain what was carried over first
+    consumed.append([FakeKafkaMessage(c, offset=x + 4) for x, c in enumerate(containers)])
+    assert(len(offline_consumer.poll_and_deserialize(max_records=25)) == 25)
+    assert(len(offline_consumer.poll_and_deserialize()) == 15)
+
+
+@pytest.mark.unit
+def test_poll_budgets__mixed_poll_styles(offline_consumer, sample_schema):
+    offline_consumer._add_config({
+        'aether_emit_flag_required': False,
+        'aether_commit_manager': True,
+        'aether_commit_every_messages': 1000
+    })
+    offline_consumer._init_caches()
+    offline_consumer.commit = FakeCommitConsumer().commit
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    log = [
+        FakeKafkaMessage(avro_container(sample_schema, mocker(count=2)), offset=x)
+        for x in range(6)
+    ]
+    position = [0]
+
+    def consume(num_messages=1, timeout=1):
+        taken = log[position[0]:position[0] + num_messages]
+        position[0] += len(taken)
+        return taken
+
+    def seek(tp):
+        position[0] = next((x for x, m in enumerate(log) if m.offset() >= tp.offset), len(log))
+
+    offline_consumer.consume = consume
+    offline_consumer.seek = seek
+    manager = offline_consumer.commit_manager
+    # a columnar poll rewinds what was carried over, the split container comes in full
+    first = offline_consumer.poll_and_deserialize(num_messages=3, max_records=3)
+    assert([m.offset for m in first] == [0, 0, 1])
+    offline_consumer.mark_handled(first)
+    batch, = offline_consumer.poll_and_deserialize_columnar(num_messages=3)
+    assert(list(batch.offsets) == [1, 1, 2, 2, 3, 3])
+    rest = offline_consumer.poll_and_deserialize(num_messages=3)
+    assert([m.offset for m in rest] == [4, 4, 5, 5])
+    # iter_deserialize yields what was carried over before consuming
+    seek(confluent_kafka.TopicPartition('test', 0, 0))
+    first = offline_consumer.poll_and_deserialize(num_messages=3, max_records=3)
+    assert([m.offset for m in first] == [0, 0, 1])
+    offline_consumer.mark_handled(first)
+    assert(manager.committable() == {('test', 0): 1})  # offset 1 is held
+    stream = offline_consumer.iter_deserialize(num_messages=3)
+    second = [next(stream), next(stream)]
+    stream.close()
+    assert([m.offset for m in second] == [1, 2])
+    offline_consumer.mark_handled(second)
+    assert(manager.committable() == {('test', 0): 2})  # offset 2 is held
+    third = list(offline_consumer.iter_deserialize(num_messages=3))
+    assert([m.offset for m in third] == [2])
+    offline_consumer.mark_handled(third)
+    fourth = list(offline_consumer.iter_deserialize(num_messages=3))
+    assert([m.offset for m in fourth] == [3, 3, 4, 4, 5, 5])
+    offline_consumer.mark_handled(fourth)
+    assert(manager.committable() == {('test', 0): 6})
+
+
+class FullQueueProducer(FakeProducer):
+    # refuses every other message, as a producer with a full local queue
+    def __init__(self):
+        super(FullQueueProducer, self).__init__()
+        self.refused = 0
+
+    def produce(self, *args, **kwargs):
+        if self.refused <= len(self.produced):
+            self.refused += 1
+            raise BufferError('Local: Queue full')
+        super(FullQueueProducer, self).produce(*args, **kwargs)
+
+
+@pytest.mark.unit
+def test_batching_producer(offline_consumer, sample_schema):
+    offline_consumer._add_config({
+        'aether_emit_flag_required': False,
+        'aether_masking_schema_emit_level': 5
+    })
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=30)
+    producer = FullQueueProducer()
+    batching = BatchingProducer(producer, max_docs=10, linger_ms=60000, background=False)
+    batching.produce(docs[:25], schema, 'test')
+    assert(len(producer.produced) == 2)
+    assert(batching.pending() == 5)
+    # a new schema for the topic sends what is pending
+    other = ParseSchema(json.dumps({**sample_schema, 'name': 'Other'}))
+    batching.produce(docs[25:27] + [{'id': 1}], other, 'test')
+    assert(len(producer.produced) == 3)
+    assert(batching.stats() == {'containers': 3, 'documents': 25, 'pending': 2})
+    batching.produce(docs[27:], other, 'other')
+    batching.flush()
+    assert(batching.stats() == {'containers': 5, 'documents': 30, 'pending': 0})
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced
+    messages = offline_consumer.poll_and_deserialize()
+    assert([m.value for m in messages] == docs)
+    assert([m.topic for m in messages] == ['test'] * 27 + ['other'] * 3)
+    headers = dict(producer.produced[0].headers())
+    assert(json.loads(headers['contains_id']) == [d['id'] for d in docs[:10]])
+    assert(headers['avro_size'] == '10')
+    kafka_callback(msg=producer.produced[0])
+    batching.close()
+    with pytest.raises(RuntimeError):
+        batching.produce(docs, schema, 'test')
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('codec,compression_level', [
+    ('null', None),
+    ('deflate', 1),
+    ('deflate', 9),
+    ('xz', 6),
+])
+def test_batching_producer__thresholds(offline_consumer, sample_schema, codec, compression_level):
+    offline_consumer._add_config({
+        'aether_emit_flag_required': False,
+        'aether_masking_schema_emit_level': 5
+    })
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=6)
+    producer = FakeProducer()
+    # every document is over 1 byte
+    with BatchingProducer(producer, max_bytes=1, codec=codec,
+                          compression_level=compression_level) as batching:
+        batching.produce(docs[:2], schema, 'test')
+        assert(len(producer.produced) == 2)
+    # the background thread sends containers once they lingered
+    with BatchingProducer(producer, linger_ms=10, codec=codec,
+                          compression_level=compression_level) as batching:
+        batching.produce(docs[2:], schema, 'test')
+        for _ in range(200):
+            if len(producer.produced) == 3:
+                break
+            sleep(0.01)
+        assert(len(producer.produced) == 3)
+        assert(batching.pending() == 0)
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced
+    assert([m.value for m in offline_consumer.poll_and_deserialize()] == docs)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('store', [RotatingBloomFilter(100), LRUIdSet(100)])
+def test_seen_id_stores(store):
+    ids = [f'id-{i}' for i in range(250)]
+    store.add_all(ids[:100])
+    assert(store.contains_all(ids[:100]) and store.contains_all([]))
+    assert(not store.contains_all(ids[:101]))
+    store.add_all(ids[100:250])
+    # at least the last 100 are remembered, at most the last 200
+    assert(store.contains_all(ids[150:]))
+    forgotten = sum(not store.contains_all([_id]) for _id in ids[:50])
+    if isinstance(store, RotatingBloomFilter):
+        # ids are hashed with hash(), so false positives vary from run to run
+        assert(forgotten >= 45)
+        assert(store.stats()['bytes'] < 1000)
+    else:
+        assert(forgotten == 50)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('store', ['bloom', 'lru'])
+def test_poll__dedup(store, offline_consumer, sample_schema):
+    offline_consumer._add_config({
+        'aether_emit_flag_required': False,
+        'aether_dedup_window': 1000,
+        'aether_dedup_store': store
+    })
+    offline_consumer._init_caches()
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=100)
+    producer = FakeProducer()
+    produce(docs[:50], schema, 'test', producer, id_format='binary')
+    produce(docs[50:], schema, 'test', producer)
+    produce(docs[:50], schema, 'test', producer, id_format='binary')  # a retry
+    produce(docs[40:60], schema, 'test', producer)  # all seen, but not in this poll yet
+    produce(docs[:50], schema, 'other', producer)  # another topic, same ids
+    produce(docs[:10] + [{'id': 'new'}], schema, 'test', producer)
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced
+    messages = offline_consumer.poll_and_deserialize()
+    assert(len(messages) == 100 + 20 + 50 + 11)
+    assert(offline_consumer.get_dedup_stats() == {'containers': 1, 'documents': 50})
+    # a replay
+    assert(offline_consumer.poll_and_deserialize() == [])
+    assert(offline_consumer.poll_and_deserialize_columnar() == [])
+    assert(offline_consumer.get_dedup_stats() == {'containers': 13, 'documents': 512})
+    # a malformed avro_size header only turns the check off
+    seen = producer.produced[1]
+    headers = [(k, b'abc' if k == 'avro_size' else v) for k, v in seen.headers()]
+    offline_consumer.consume = lambda *args, **kwargs: [
+        FakeKafkaMessage(seen.value(), headers=headers)]
+    assert(len(offline_consumer.poll_and_deserialize()) == 50)
+
+    # ids are only remembered once their container was handed over completely
+    offline_consumer._init_caches()
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced[:1]
+    offline_consumer.seek = lambda *args: None
+    stream = offline_consumer.iter_deserialize()
+    next(stream)
+    stream.close()
+    assert(len(offline_consumer.poll_and_deserialize()) == 50)
+    assert(offline_consumer.poll_and_deserialize() == [])
+
+    # skipped containers are handled, in their place in the partition
+    offline_consumer._add_config({'aether_commit_manager': True})
+    offline_consumer._init_caches()
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced[:3]
+    messages = offline_consumer.poll_and_deserialize()
+    assert(len(messages) == 100)
+    offline_consumer.mark_handled(messages[:50])
+    assert(offline_consumer.commit_manager.committable() == {('test', 0): 1})
+    offline_consumer.mark_handled(messages[50:])
+    assert(offline_consumer.commit_manager.committable() == {('test', 0): 3})
+    with pytest.raises(ValueError):
+        offline_consumer._add_config({'aether_dedup_store': 'disk'})
+        offline_consumer._init_caches()
+
+
+@pytest.mark.unit
+def test_projection__topic_config(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_field_path': '$.publish'})
+    mocker = test_schemas['TestBooleanPass']['mocker']
+    incoming = [FakeKafkaMessage(avro_container(sample_schema, mocker(count=10)))]
+    offline_consumer.consume = lambda *args, **kwargs: incoming
+    offline_consumer.set_topic_projection_config('test', ProjectionConfig(['id', 'field1']))
+    messages = offline_consumer.poll_and_deserialize()
+    assert(len(messages) == 5)
+    for msg in messages:
+        # the emit flag is decoded too, field1 is masked at level 0
+        assert(set(msg.value.keys()) == set(['id', 'publish']))
+        assert([f['name'] for f in msg.schema['fields']] == ['id', 'publish', 'field1'])
+
+
+@pytest.mark.unit
+def test_projection__nested_and_named():
+    schema = {
+        'name': 'Outer',
+        'type': 'record',
+        'fields': [
+            {'name': 'id', 'type': 'string'},
+            {'name': 'inner', 'type': ['null', {
+                'name': 'Inner',
+                'type': 'record',
+                'fields': [
+                    {'name': 'a', 'type': 'string'},
+                    {'name': 'b', 'type': 'long'}
+                ]
+            }]},
+            {'name': 'items', 'type': {'type': 'array', 'items': 'Inner'}}
+        ]
+    }
+    msg = {'id': 'x', 'inner': {'a': 'a', 'b': 1}, 'items': [{'a': 'c', 'b': 2}]}
+    reader_schema, datum_reader = build_projected_reader(schema, ['$.items[*].b'])
+    assert(reader_schema['fields'][0]['type']['items']['fields'] == [
+        {'name': 'b', 'type': 'long'}])
+    reader = CachedDataFileReader(io.BytesIO(avro_container(schema, [msg])), LRUCache())
+    reader.set_datum_reader(datum_reader)
+    assert(list(reader) == [{'items': [{'b': 2}]}])
+    with pytest.raises(ValueError):
+        build_projected_reader(schema, ['$..b'])
+
+
+@pytest.mark.unit
+def test_compiled_decoder__all_types():
+    schema = {
+        'name': 'Node',
+        'namespace': 'test',
+        'type': 'record',
+        'fields': [
+            {'name': 'flag', 'type': 'boolean'},
+            {'name': 'count', 'type': 'int'},
+            {'name': 'big', 'type': 'long'},
+            {'name': 'ratio', 'type': 'float'},
+            {'name': 'exact', 'type': 'double'},
+            {'name': 'raw', 'type': 'bytes'},
+            {'name': 'level', 'type': {'type': 'enum', 'name': 'Level', 'symbols': ['A', 'B']}},
+            {'name': 'hash', 'type': {'type': 'fixed', 'name': 'Hash', 'size': 2}},
+            {'name': 'levels', 'type': {'type': 'map', 'values': 'Level'}},
+            {'name': 'hashes', 'type': {'type': 'array', 'items': 'test.Hash'}},
+            {'name': 'date', 'type': {'type': 'int', 'logicalType': 'date'}},
+            {'name': 'child', 'type': ['null', 'Node']}
+        ]
+    }
+    child = {
+        'flag': False, 'count': 0, 'big': -1, 'ratio': 0.5, 'exact': 0.1, 'raw': b'',
+        'level': 'A', 'hash': b'ab', 'levels': {}, 'hashes': [], 'date': 1, 'child': None
+    }
+    msg = {
+        'flag': True, 'count': -300, 'big': 2 ** 40, 'ratio': 1.5, 'exact': 2.25,
+        'raw': b'\x00\xff', 'level': 'B', 'hash': b'cd', 'levels': {'é': 'A', 'b': 'B'},
+        'hashes': [b'ef'] * 100, 'date': 3, 'child': child
+    }
+    for codec in ['null', 'deflate']:
+        container = avro_container(schema, [msg, child] * 50, codec=codec)
+        expected = list(CachedDataFileReader(io.BytesIO(container), LRUCache()))
+        reader = CachedDataFileReader(io.BytesIO(container), LRUCache(), 'compiled')
+        assert(list(reader) == expected)
+        assert(expected[0] == msg)
+        for backend in ['spavro', 'compiled']:
+            reader = CachedDataFileReader(PayloadReader(container), LRUCache(), backend)
+            assert(list(reader) == expected)
+    # datums are decoded in place, at their offset in the payload
+    payload = encode_wire_format(7, msg, DatumWriter(ParseSchema(json.dumps(schema))))
+    for backend in ['spavro', 'compiled']:
+        entry = build_schema_entry(json.dumps(schema).encode('utf-8'), backend=backend)
+        assert(decode_datum(entry.datum_reader, payload, 5) == msg)
+
+
+@pytest.mark.unit
+def test_compiled_validator():
+    schema = {
+        'name': 'Node',
+        'namespace': 'test',
+        'type': 'record',
+        'fields': [
+            {'name': 'flag', 'type': 'boolean'},
+            {'name': 'count', 'type': 'int'},
+            {'name': 'big', 'type': 'long'},
+            {'name': 'ratio', 'type': 'float'},
+            {'name': 'raw', 'type': 'bytes'},
+            {'name': 'level', 'type': {'type': 'enum', 'name': 'Level', 'symbols': ['A', 'B']}},
+            {'name': 'hash', 'type': {'type': 'fixed', 'name': 'Hash', 'size': 2}},
+            {'name': 'levels', 'type': {'type': 'map', 'values': 'Level'}},
+            {'name': 'hashes', 'type': {'type': 'array', 'items': 'test.Hash'}},
+            {'name': 'date', 'type': {'type': 'int', 'logicalType': 'date'}},
+            {'name': 'child', 'type': ['null', 'Node']}
+        ]
+    }
+    child = {
+        'flag': False, 'count': 0, 'big': -1, 'ratio': 0.5, 'raw': b'',
+        'level': 'A', 'hash': b'ab', 'levels': {}, 'hashes': [], 'date': 1, 'child': None
+    }
+    msg = {**child, 'count': -300, 'levels': {'a': 'B'}, 'hashes': [b'ef'], 'child': child}
+    changes = [
+        {}, {'flag': 1}, {'count': True}, {'count': 2 ** 31}, {'big': 2 ** 63 - 1},
+        {'big': 2 ** 63}, {'ratio': 1}, {'ratio': '1'}, {'raw': 'x'}, {'level': 'C'},
+        {'level': ['A']}, {'hash': b'abc'}, {'levels': {1: 'A'}}, {'levels': {'a': 'C'}},
+        {'hashes': (b'ab',)}, {'hashes': [b'a']}, {'date': 1.0},
+        {'child': {**child, 'level': 'C'}}, {'child': []}, {'extra': None}
+    ]
+    spavro_schema = ParseSchema(json.dumps(schema))
+    validate = get_validator(spavro_schema)
+    for change in changes:
+        datum = {**msg, **change}
+        assert(validate(datum) == spavro_validate(spavro_schema, datum)), change
+    assert(validate(msg) and not validate(None) and not validate({**msg, 'flag': None}))
+    # compiled once per schema
+    assert(get_validator(spavro_schema) is validate)
+    assert(get_validator(json.dumps(schema)) is get_validator(schema))
+    assert(validate_all(spavro_schema, [msg, child, {}]) == [True, True, False])
+    for name, test_schema in test_schemas.items():
+        spavro_schema = ParseSchema(json.dumps(test_schema['schema']))
+        for doc in test_schema['mocker'](count=10) + [{}]:
+            assert(get_validator(spavro_schema)(doc) == spavro_validate(spavro_schema, doc))
+
+
+@pytest.mark.unit
+def test_produce__trusted(monkeypatch, sample_schema):
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=4)
+    producer = FakeProducer()
+    produce(docs + [{'id': 1}], schema, 'test', producer)
+    assert(json.loads(dict(producer.produced[0].headers())['avro_size']) == 5)
+
+    def fail(schema):
+        raise AssertionError('trusted input is not validated')
+
+    monkeypatch.setattr(aet_kafka_utils, 'get_validator', fail)
+    produce(docs, schema, 'test', producer, trusted=True)
+    with BatchingProducer(producer, background=False) as batching:
+        batching.produce(docs, schema, 'test', trusted=True)
+    counts = [
+        len(list(CachedDataFileReader(io.BytesIO(m.value()), LRUCache())))
+        for m in producer.produced
+    ]
+    assert(counts == [4, 4, 4])
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('max_bytes,max_docs', [(4000, None), (20000, 50), (None, 30)])
+def test_produce__split(max_bytes, max_docs, sample_schema):
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=300)
+    producer = FakeProducer()
+    produce(docs + [{'id': 1}], schema, 'test', producer,
+            max_bytes=max_bytes, max_docs=max_docs)
+    assert(len(producer.produced) > 1)
+    received, ids, sizes = [], [], []
+    for msg in producer.produced:
+        headers = dict(msg.headers())
+        sizes.append(len(msg.value()) + sum(len(k) + len(v) for k, v in headers.items()))
+        assert(sizes[-1] <= (max_bytes or sizes[-1]))
+        assert(int(headers['avro_size']) <= (max_docs or len(docs) + 1))
+        received += list(CachedDataFileReader(io.BytesIO(msg.value()), LRUCache()))
+        ids += json.loads(headers['contains_id'])
+    assert(received == docs)
+    assert(ids == [doc['id'] for doc in docs] + [1])
+    # the estimate fills containers, rather than cutting them early
+    if max_bytes and not max_docs:
+        assert(min(sizes[:-1]) > max_bytes * 0.9)
+
+
+@pytest.mark.unit
+def test_produce_bulk(sample_schema):
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=300)
+    results = {}
+    for workers in [0, 2]:
+        producer = FakeProducer()
+        sent = produce_bulk(iter(docs + [{'id': 1}]), schema, 'test', producer,
+                            max_bytes=4000, workers=workers, chunk_size=70, max_in_flight=2)
+        assert(sent == len(producer.produced))
+        results[workers] = [
+            (json.loads(dict(m.headers())['contains_id']),
+             list(CachedDataFileReader(io.BytesIO(m.value()), LRUCache())))
+            for m in producer.produced
+        ]
+    assert(results[0] == results[2])
+    assert([_id for ids, _ in results[2] for _id in ids] == [d['id'] for d in docs] + [1])
+    assert([doc for _, msgs in results[2] for doc in msgs] == docs)
+
+    class CountingPool(object):
+        submitted = 0
+
+        def submit(self, fn, item):
+            self.submitted += 1
+            future = Future()
+            future.set_result(fn(item))
+            return future
+
+    pool = CountingPool()
+    for taken, item in enumerate(aet_kafka_utils._bounded_map(pool, str, range(10), 3)):
+        assert(item == str(taken))
+        assert(pool.submitted <= taken + 3)
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('id_format', ['json', 'binary', 'binary+zlib'])
+def test_id_headers(id_format):
+    uuids = [str(uuid.uuid4()) for _ in range(50)]
+    ids = uuids + ['doc-1', 'doc-10', 'é', '', 'ABCDEFAB-0000-0000-0000-000000000000',
+                   0, -1, 2 ** 70, 1.5, True, None] + [f'doc-{i:05}' for i in range(50)]
+    value = encode_ids(ids, id_format)
+    assert(decode_ids(value) == ids)
+    assert(decode_ids(value.encode('utf-8') if isinstance(value, str) else value) == ids)
+    contained = ContainedIds(value)
+    assert(len(contained) == len(ids))
+    assert(contained[-1] == 'doc-00049' and uuids[3] in contained)
+    assert(contained == ids)
+    assert(all(encoded_id_size(_id, id_format) >= len(encode_ids([_id], id_format)) - 3
+               for _id in ids))
+    if id_format != 'json':
+        assert(len(encode_ids(uuids, id_format)) < len(json.dumps(uuids)) / 2)
+    assert(decode_ids(encode_ids([], id_format)) == [])
+    with pytest.raises(ValueError):
+        encode_ids(ids, 'xml')
+
+
+@pytest.mark.unit
+def test_id_headers__produce(offline_consumer, sample_schema):
+    offline_consumer._add_config({'aether_emit_flag_required': False})
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=100)
+    ids = [doc['id'] for doc in docs]
+    producer = FakeProducer()
+    produce(docs[:50], schema, 'test', producer, id_format='binary+zlib')
+    produce(docs[50:], schema, 'test', producer)
+    headers = [dict(m.headers())['contains_id'] for m in producer.produced]
+    assert(isinstance(headers[0], bytes) and isinstance(headers[1], str))
+    assert(len(headers[0]) < len(headers[1]) / 2)
+    kafka_callback(confluent_kafka.KafkaError(1), producer.produced[0])
+    offline_consumer.consume = lambda *args, **kwargs: producer.produced
+    messages = offline_consumer.poll_and_deserialize()
+    assert(len(messages) == 100)
+    get_ids = offline_consumer.get_contained_ids
+    assert(get_ids(messages[0]) == ids[:50] and get_ids(messages[-1]) == ids[50:])
+    assert(get_ids(producer.produced[0]) == ids[:50])
+    assert(get_ids(FakeKafkaMessage(b'', headers=[])) is None)
+
+
+@pytest.mark.unit
+def test_delivery_stats(sample_schema):
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=4)
+    ids = [doc['id'] for doc in docs]
+    stats = DeliveryStats(window=3)
+    contexts, outcomes = [], []
+    producer = FakeProducer()
+    produce(docs, schema, 'test', producer,
+            callback=lambda err, msg, context: contexts.append(context),
+            delivery_stats=stats)
+    produce(docs[:1], schema, 'test', producer,
+            callback=lambda err, msg: outcomes.append(err), delivery_stats=stats)
+    producer.flush()
+    assert(outcomes == [None])
+    assert(contexts[0].ids == ids and contexts[0].count == 4)
+    assert(contexts[0].size == len(producer.produced[0].value()))
+
+    error = confluent_kafka.KafkaError(confluent_kafka.KafkaError._MSG_TIMED_OUT)
+    failing = FakeProducer(error=error)
+    with BatchingProducer(failing, background=False, delivery_stats=stats) as batching:
+        batching.produce(docs, schema, 'other')
+        batching.produce(docs, schema, 'test')
+    # the default callback takes the ids of failed documents from the context
+    kafka_callback(error, failing.produced[0], contexts[0])
+    kafka_callback(error, failing.produced[0])
+    result = stats.stats()
+    assert(result['test']['successes'] == 2 and result['test']['documents'] == 5)
+    assert(result['test']['failures'] == 1 and result['test']['failed_documents'] == 4)
+    assert(result['other']['failures'] == 1 and result['other']['successes'] == 0)
+    assert(result['test']['bytes'] == sum(len(m.value()) for m in producer.produced))
+    latency = result['test']['latency_ms']
+    assert(0 <= latency['p50'] <= latency['p90'] <= latency['p99'])
+    stats.reset()
+    assert(stats.stats() == {})
+
+
+@pytest.mark.unit
+def test_delivery_callbacks__not_kept(sample_schema):
+    schema = ParseSchema(json.dumps(sample_schema))
+    docs = test_schemas['TestBooleanPass']['mocker'](count=2)
+
+    class Sink(object):
+        __hash__ = None  # unhashable callables are fine
+
+        def __init__(self):
+            self.contexts = []
+
+        def __call__(self, err, msg, context):
+            self.contexts.append(context)
+
+        def on_delivery(self, err, msg, context):
+            self.contexts.append(context)
+
+    sink = Sink()
+    producer = FakeProducer()
+    produce(docs, schema, 'test', producer, callback=sink)
+    produce(docs, schema, 'test', producer, callback=sink.on_delivery)
+    producer.flush()
+    assert(len(sink.contexts) == 2)
+    # callbacks are not held once their messages are delivered
+    ref = weakref.ref(sink)
+    del sink
+    gc.collect()
+    assert(ref() is None)
+    payload = b'0123456789'
+    reader = PayloadReader(payload)
+    assert(reader.payload is payload)
+    assert(reader.read(2) == b'01')
+    view = reader.read_view(3)
+    assert(view.obj is payload)  # not a copy
+    assert(bytes(view) == b'234')
+    assert(reader.tell() == 5)
+    assert(bytes(reader.read_view()) == b'56789')
+    assert(reader.read_view(1).nbytes == 0)
+    assert(not reader.writable())
+    with pytest.raises(io.UnsupportedOperation):
+        reader.write(b'x')
+
+
+@pytest.mark.unit
+@pytest.mark.parametrize('fields', [None, ['id'], ['$.inner.a', 'items']])
+def test_compiled_decoder__consumer(fields, offline_consumer):
+    schema = {
+        'name': 'Outer',
+        'type': 'record',
+        'fields': [
+            {'name': 'id', 'type': 'string'},
+            {'name': 'inner', 'type': ['null', {
+                'name': 'Inner',
+                'type': 'record',
+                'fields': [
+                    {'name': 'a', 'type': 'string'},
+                    {'name': 'b', 'type': {'type': 'map', 'values': 'long'}}
+                ]
+            }]},
+            {'name': 'items', 'type': {'type': 'array', 'items': 'Inner'}},
+            {'name': 'tail', 'type': 'double'}
+        ]
+    }
+    msg = {
+        'id': 'x',
+        'inner': {'a': 'a', 'b': {'x': 1}},
+        'items': [{'a': 'c', 'b': {}}],
+        'tail': 0.5
+    }
+    container = avro_container(schema, [msg, {**msg, 'inner': None}])
+    results = []
+    for backend in ['spavro', 'compiled']:
+        offline_consumer._add_config({'aether_avro_decoder': backend})
+        offline_consumer._init_caches()
+        if fields:
+            offline_consumer.set_topic_projection_config('topic', ProjectionConfig(fields))
+        results.append(offline_consumer.deserialize_value('topic', container))
+    assert(results[0]['messages'] == results[1]['messages'])
+    assert(results[0]['schema'] == results[1]['schema'])
+    offline_consumer._add_config({'aether_avro_decoder': 'missing'})
+    with pytest.raises(ValueError):
+        offline_consumer._init_caches()
+
+
+@pytest.mark.unit
+def test_msk_msg_nested_records(offline_consumer):
+    schema = {
+        'name': 'Outer',
+        'type': 'record',
+        'fields': [
+            {'name': 'id', 'type': 'string'},
+            {'name': 'secret', 'type': 'string', 'aetherMaskingLevel': 3},
+            {'name': 'inner', 'type': ['null', {
+                'name': 'Inner',
+                'type': 'record',
+                'fields': [
+                    {'name': 'a', 'type': 'string', 'aetherMaskingLevel': 1},
+                    {'name': 'b', 'type': 'string', 'aetherMaskingLevel': 2}
+                ]
+            }]},
+            {'name': 'items', 'type': {'type': 'array', 'items': 'Inner'}}
+        ]
+    }
+    msg = {
+        'id': 'x',
+        'secret': 's',
+        'inner': {'a': 'a', 'b': 'b'},
+        'items': [{'a': 'a', 'b': 'b'}, {'a': 'a', 'b': 'b'}]
+    }
+    offline_consumer._add_config({'aether_masking_schema_emit_level': 1})
+    config = offline_consumer._default_mask_config()
+    mask = offline_consumer.get_mask_from_schema(schema, config)
+    masked = mask(msg)
+    assert(masked == {
+        'id': 'x',
+        'inner': {'a': 'a'},
+        'items': [{'a': 'a'}, {'a': 'a'}]
+    })
+
+
+@pytest.mark.unit
+def test_msk_plan_shared(offline_consumer, sample_schema):
+    config = offline_consumer._default_mask_config()
+    mask_a = offline_consumer.get_mask_from_schema(sample_schema, config, 'fingerprint')
+    mask_b = offline_consumer.get_mask_from_schema(sample_schema, config, 'fingerprint')
+    assert(mask_a.__self__ is mask_b.__self__)
+    assert(mask_a.__self__.drop == frozenset(['field1', 'field2', 'field3', 'field4', 'field5']))
+
+
 ######
 #
 #  Resource Tests